@@ -0,0 +1,240 @@
+import csv
+import numpy as np
+
+from scipy import sparse
+from sqlalchemy import select
+
+from utils.database import session
+from utils.logger import get_logger
+from model.answer import AnswerType1
+from model.disease import Disease
+from model.image import Image
+from model.question import QuestionType1
+
+
+logger = get_logger(__name__)
+
+
+# category codes of type 1 answers without a disease
+NO_DISEASE = -1
+NOT_APPLICABLE = -2
+
+
+def count_matrix(items, categories, n_items, n_categories, weights=None):
+    """
+    Builds a sparse item x category matrix where the cell (i, c) holds the number of ratings (or the sum of rating
+    weights) assigning item i to category c.
+
+    :param items: Array of item indices, one entry per rating.
+    :param categories: Array of category indices, one entry per rating.
+    :param n_items: Number of items.
+    :param n_categories: Number of categories.
+    :param weights: Optional array of rating weights.
+    :return: scipy.sparse CSR matrix.
+    """
+    if weights is None:
+        weights = np.ones(len(items))
+    return sparse.csr_matrix((weights, (items, categories)), shape=(n_items, n_categories), dtype=float)
+
+
+def fleiss_kappa(counts):
+    """
+    Fleiss' kappa generalized to a varying number of raters per item. Items rated only once carry no information about
+    agreement and are ignored.
+
+    :param counts: Sparse item x category count matrix, see `count_matrix`.
+    :return: A tuple (kappa, category kappas) where category kappas is an array with a kappa for each category, NaN
+        for categories that were never chosen.
+    """
+    n_raters = np.asarray(counts.sum(axis=1)).ravel()
+    rated = n_raters >= 2
+    counts, n_raters = counts[rated], n_raters[rated]
+    if len(n_raters) == 0:
+        return np.nan, np.full(counts.shape[1], np.nan)
+
+    squares = np.asarray(counts.multiply(counts).sum(axis=1)).ravel()
+    observed = ((squares - n_raters) / (n_raters * (n_raters - 1))).mean()
+    proportions = np.asarray(counts.sum(axis=0)).ravel() / n_raters.sum()
+    expected = (proportions ** 2).sum()
+    kappa = (observed - expected) / (1 - expected) if expected < 1 else np.nan
+
+    # category specific kappa, 1 - disagreement on the category relative to the disagreement expected by chance
+    disagreement = counts.T @ n_raters - np.asarray(counts.multiply(counts).sum(axis=0)).ravel()
+    chance = (n_raters * (n_raters - 1)).sum() * proportions * (1 - proportions)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        category_kappas = np.where(chance > 0, 1 - disagreement / chance, np.nan)
+    return kappa, category_kappas
+
+
+def krippendorff_alpha(counts):
+    """
+    Krippendorff's alpha for nominal data computed from the coincidence matrix of the categories. Units rated only once
+    are not pairable and are ignored.
+
+    :param counts: Sparse item x category count matrix, see `count_matrix`.
+    :return: Alpha.
+    """
+    n_raters = np.asarray(counts.sum(axis=1)).ravel()
+    pairable = n_raters >= 2
+    counts, n_raters = counts[pairable], n_raters[pairable]
+    if len(n_raters) == 0:
+        return np.nan
+
+    # coincidences o_ck = sum_u (n_uc * n_uk - [c == k] * n_uc) / (m_u - 1), only the diagonal and the totals are needed
+    scale = sparse.diags(1 / (n_raters - 1))
+    coincidence_diagonal = np.asarray((scale @ (counts.multiply(counts) - counts)).sum(axis=0)).ravel()
+    category_totals = np.asarray(counts.sum(axis=0)).ravel()
+    total = category_totals.sum()
+    expected = total ** 2 - (category_totals ** 2).sum()
+    if expected == 0:
+        return np.nan
+    return 1 - (total - 1) * (total - coincidence_diagonal.sum()) / expected
+
+
+def weighted_agreement(weighted_counts, weight_squares):
+    """
+    Pairwise agreement where every pair of ratings of an item counts with the product of the raters' certainties, so
+    agreement between confident raters weighs more than agreement between unsure ones. Chance agreement is estimated
+    from certainty weighted category proportions, like in Fleiss' kappa.
+
+    :param weighted_counts: Sparse item x category matrix of summed certainties, see `count_matrix`.
+    :param weight_squares: Array with the sum of squared certainties of each item.
+    :return: A tuple (observed agreement, chance corrected agreement).
+    """
+    totals = np.asarray(weighted_counts.sum(axis=1)).ravel()
+    pair_weights = totals ** 2 - weight_squares
+    rated = pair_weights > 0
+    if not rated.any():
+        return np.nan, np.nan
+
+    weighted_counts, totals = weighted_counts[rated], totals[rated]
+    weight_squares, pair_weights = weight_squares[rated], pair_weights[rated]
+    agreeing = np.asarray(weighted_counts.multiply(weighted_counts).sum(axis=1)).ravel() - weight_squares
+    observed = agreeing.sum() / pair_weights.sum()
+    proportions = np.asarray(weighted_counts.sum(axis=0)).ravel() / totals.sum()
+    expected = (proportions ** 2).sum()
+    return observed, (observed - expected) / (1 - expected) if expected < 1 else np.nan
+
+
+class Agreement:
+    """
+    Measures agreement between raters on type 1 questions, where each rater picks a diagnosis for a segmentation map and
+    rates the certainty of the pick. Answers without a disease and answers marking the image as not applicable are
+    categories of their own.
+    """
+
+    @staticmethod
+    def load_ratings():
+        """
+        Loads all type 1 answers in a single query.
+
+        :return: A dictionary of equally long arrays `question`, `user`, `category` (indices into the returned
+            `questions`, `users` and `categories` lists) and `certainty`, together with lists `questions`, `users`,
+            `categories` (disease ids or one of NO_DISEASE, NOT_APPLICABLE) and `datasets` (dataset of each question).
+        """
+        rows = session.execute(
+            select(AnswerType1.question_id, AnswerType1.user_id, AnswerType1.disease_id, AnswerType1.invalid,
+                   AnswerType1.certainty, Image.dataset)
+            .join(QuestionType1, QuestionType1.id == AnswerType1.question_id)
+            .join(Image, Image.id == QuestionType1.image_id)
+        ).all()
+
+        if len(rows) == 0:
+            columns = [np.array([], dtype=np.int64)] * 6
+        else:
+            columns = [np.array(column) for column in zip(*rows)]
+        question_ids, user_ids, disease_ids, invalid, certainties, datasets = columns
+
+        disease_ids = np.where(disease_ids == None, NO_DISEASE, disease_ids)
+        disease_ids = np.where(invalid == True, NOT_APPLICABLE, disease_ids).astype(np.int64)
+        questions, question_index = np.unique(question_ids.astype(np.int64), return_inverse=True)
+        users, user_index = np.unique(user_ids.astype(np.int64), return_inverse=True)
+        categories, category_index = np.unique(disease_ids, return_inverse=True)
+        question_datasets = np.empty(len(questions), dtype=object)
+        question_datasets[question_index] = datasets
+
+        logger.info(f"Loaded {len(rows)} ratings of {len(questions)} questions by {len(users)} raters.")
+        return {
+            "question": question_index,
+            "user": user_index,
+            "category": category_index,
+            "certainty": np.where(certainties == None, 0, certainties).astype(float),
+            "questions": questions.tolist(),
+            "users": users.tolist(),
+            "categories": categories.tolist(),
+            "datasets": question_datasets.tolist()
+        }
+
+    @staticmethod
+    def compute(ratings=None):
+        """
+        Computes Fleiss' kappa, Krippendorff's alpha and certainty weighted agreement over all type 1 answers and per
+        dataset, together with category specific kappas for each disease.
+
+        :param ratings: Ratings as returned by `load_ratings`. Loaded from the database if not given.
+        :return: A list of dictionaries with keys scope, category, questions, ratings, fleiss_kappa,
+            krippendorff_alpha, weighted_agreement and weighted_kappa. Rows with a category hold category specific
+            kappas only.
+        """
+        if ratings is None:
+            ratings = Agreement.load_ratings()
+
+        disease_names = dict(session.execute(select(Disease.id, Disease.token)).all())
+        disease_names.update({NO_DISEASE: "none", NOT_APPLICABLE: "not_applicable"})
+        category_names = [disease_names.get(category, str(category)) for category in ratings["categories"]]
+
+        n_questions, n_categories = len(ratings["questions"]), len(ratings["categories"])
+        question_datasets = np.array(ratings["datasets"], dtype=object)
+        rating_datasets = question_datasets[ratings["question"]] if n_questions > 0 else np.array([], dtype=object)
+        scopes = [("all", np.ones(len(ratings["question"]), dtype=bool))]
+        scopes += [(f"dataset {dataset}", rating_datasets == dataset) for dataset in sorted(set(ratings["datasets"]))]
+
+        report = list()
+        for scope, mask in scopes:
+            items, categories = ratings["question"][mask], ratings["category"][mask]
+            certainties = ratings["certainty"][mask]
+            counts = count_matrix(items, categories, n_questions, n_categories)
+            weighted_counts = count_matrix(items, categories, n_questions, n_categories, weights=certainties)
+            weight_squares = np.bincount(items, weights=certainties ** 2, minlength=n_questions)
+
+            kappa, category_kappas = fleiss_kappa(counts)
+            observed, weighted_kappa = weighted_agreement(weighted_counts, weight_squares)
+            report.append({
+                "scope": scope,
+                "category": None,
+                "questions": int(len(np.unique(items))),
+                "ratings": int(mask.sum()),
+                "fleiss_kappa": float(kappa),
+                "krippendorff_alpha": float(krippendorff_alpha(counts)),
+                "weighted_agreement": float(observed),
+                "weighted_kappa": float(weighted_kappa)
+            })
+            chosen = np.bincount(categories, minlength=n_categories)
+            for c in np.flatnonzero(chosen):
+                report.append({
+                    "scope": scope,
+                    "category": category_names[c],
+                    "questions": int(len(np.unique(items[categories == c]))),
+                    "ratings": int(chosen[c]),
+                    "fleiss_kappa": float(category_kappas[c]),
+                    "krippendorff_alpha": None,
+                    "weighted_agreement": None,
+                    "weighted_kappa": None
+                })
+        return report
+
+    @staticmethod
+    def save(report, filepath):
+        """
+        Saves an agreement report produced by `compute` to a csv file.
+
+        :param report: A list of report dictionaries.
+        :param filepath: Path of the csv file.
+        :return: None
+        """
+        with open(filepath, "w", newline="") as fout:
+            writer = csv.DictWriter(fout, fieldnames=["scope", "category", "questions", "ratings", "fleiss_kappa",
+                                                      "krippendorff_alpha", "weighted_agreement", "weighted_kappa"])
+            writer.writeheader()
+            writer.writerows(report)
+        logger.info(f"Agreement report saved to {filepath}.")
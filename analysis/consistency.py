@@ -0,0 +1,132 @@
+import csv
+
+from datetime import datetime
+from sqlalchemy import select, func, case, and_
+
+from utils.database import session, get_session, upsert
+from utils.logger import get_logger
+from model.answer import AnswerType1, AnswerType2, ControlAnswer
+from model.consistency import RaterConsistency, ConsistencyCounters, COUNTER_COLUMNS
+from model.question import QuestionType2
+from model.user import User
+
+
+logger = get_logger(__name__)
+
+
+class Consistency:
+
+    # maximal number of raters whose answers are loaded at once
+    chunk_size = 500
+
+    @staticmethod
+    def update(user_ids=None, session=None):
+        """
+        Recomputes consistency counters of the given raters from all their answers and stores them in the
+        `rater_consistency` table, e.g. for results imported before the table existed. Counters are kept up to date
+        during result import by `ConsistencyCounters.apply`. The caller commits.
+
+        :param user_ids: Ids of the raters to update. All raters are updated if None.
+        :param session: Session to use, the application session by default.
+        :return: None
+        """
+        session = get_session(session)
+        if user_ids is None:
+            user_ids = session.execute(select(User.id)).scalars().all()
+        user_ids = sorted(user_ids)
+        now = datetime.now()
+        for i in range(0, len(user_ids), Consistency.chunk_size):
+            chunk = user_ids[i:i + Consistency.chunk_size]
+            counters = {user_id: dict.fromkeys(COUNTER_COLUMNS, 0) for user_id in chunk}
+            for row in Consistency._type1_counters(chunk, session):
+                counters[row["user_id"]].update(row)
+            for row in Consistency._type2_counters(chunk, session):
+                counters[row["user_id"]].update(row)
+            rows = [dict(user_id=user_id, updated_at=now, **{column: row[column] for column in COUNTER_COLUMNS})
+                    for user_id, row in counters.items()]
+            upsert(RaterConsistency.__table__, rows, index_elements=["user_id"], update_columns=COUNTER_COLUMNS,
+                   session=session)
+            ConsistencyCounters.update_means(chunk, now, session)
+
+    @staticmethod
+    def _type1_counters(user_ids, session):
+        """
+        Compares regular and control survey answers of the raters in a single aggregate query, see
+        `ConsistencyCounters.compare_type1`.
+        """
+        consistent = and_(
+            func.coalesce(AnswerType1.disease_id, -1) == func.coalesce(ControlAnswer.disease_id, -1),
+            func.coalesce(AnswerType1.invalid, False) == func.coalesce(ControlAnswer.invalid, False)
+        )
+        rows = session.execute(
+            select(AnswerType1.user_id, func.count(),
+                   func.sum(case((consistent, 1), else_=0)),
+                   func.coalesce(func.sum(func.abs(AnswerType1.certainty - ControlAnswer.certainty)), 0))
+            .join(ControlAnswer, and_(ControlAnswer.question_id == AnswerType1.question_id,
+                                      ControlAnswer.user_id == AnswerType1.user_id))
+            .where(AnswerType1.user_id.in_(user_ids))
+            .group_by(AnswerType1.user_id)
+        ).all()
+        return [{"user_id": user_id, "t1_repeated": repeated, "t1_consistent": n_consistent,
+                 "t1_certainty_diff_sum": certainty_diff_sum}
+                for user_id, repeated, n_consistent, certainty_diff_sum in rows]
+
+    @staticmethod
+    def _type2_counters(user_ids, session):
+        """
+        Counts repeated pair agreement and intransitive triads over all type 2 answers of the raters.
+        """
+        rows = session.execute(
+            select(AnswerType2.user_id, QuestionType2.group, AnswerType2.winner_id, AnswerType2.loser_id)
+            .join(QuestionType2, QuestionType2.id == AnswerType2.question_id)
+            .where(AnswerType2.user_id.in_(user_ids))
+        ).all()
+        return ConsistencyCounters.count_type2([tuple(row) for row in rows])
+
+    @staticmethod
+    def get_report():
+        """
+        Returns stored consistency counters with derived rates.
+
+        :return: A list of dictionaries with the `rater_consistency` columns, the user name, `t1_agreement` (share of
+            control answers equal to the regular answer), `t2_agreement` (share of agreeing pairs of repeated picks)
+            and `t2_intransitivity` (share of intransitive triads). Rates are None when there is nothing to compare.
+        """
+        rows = session.execute(
+            select(RaterConsistency, User.name).join(User, User.id == RaterConsistency.user_id)
+            .order_by(RaterConsistency.user_id)
+        ).all()
+        report = list()
+        for consistency, name in rows:
+            report.append({
+                "user_id": consistency.user_id,
+                "name": name,
+                "t1_repeated": consistency.t1_repeated,
+                "t1_agreement": consistency.t1_consistent / consistency.t1_repeated if consistency.t1_repeated
+                else None,
+                "t1_certainty_diff": consistency.t1_certainty_diff,
+                "t2_repeated": consistency.t2_repeated,
+                "t2_agreement": consistency.t2_consistent / consistency.t2_repeated if consistency.t2_repeated
+                else None,
+                "t2_triads": consistency.t2_triads,
+                "t2_intransitivity": consistency.t2_intransitive / consistency.t2_triads if consistency.t2_triads
+                else None
+            })
+        return report
+
+    @staticmethod
+    def save(report, filepath):
+        """
+        Saves a consistency report produced by `get_report` to a csv file.
+
+        :param report: A list of report dictionaries.
+        :param filepath: Path of the csv file.
+        :return: None
+        """
+        with open(filepath, "w", newline="") as fout:
+            writer = csv.DictWriter(fout, fieldnames=["user_id", "name", "t1_repeated", "t1_agreement",
+                                                      "t1_certainty_diff", "t2_repeated", "t2_agreement", "t2_triads",
+                                                      "t2_intransitivity"])
+            writer.writeheader()
+            writer.writerows(report)
+        logger.info(f"Consistency report saved to {filepath}.")
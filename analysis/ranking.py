@@ -0,0 +1,270 @@
+import csv
+import os
+import warnings
+import numpy as np
+
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy import select, func
+from sqlalchemy.orm import aliased
+
+from utils.database import session
+from utils.logger import get_logger
+from model.answer import AnswerType2
+from model.image import Image
+
+
+logger = get_logger(__name__)
+
+
+def get_network_name(filename):
+    """
+    Extracts the network name from a segmentation map filename like <number>-<network>-<dataset>.<extension>.
+
+    :param filename: Segmentation map filename.
+    :return: Network name or None if the filename does not follow the pattern.
+    """
+    parts = filename.split('.')[0].split('-')
+    if len(parts) < 3:
+        return None
+    return '-'.join(parts[1:-1])
+
+
+def win_matrix(winners, losers, counts, n_items):
+    """
+    Builds a matrix W where W[i, j] is the number of times item i was picked over item j.
+
+    :param winners: Array of winning item indices.
+    :param losers: Array of losing item indices, same length as `winners`.
+    :param counts: Array with the number of comparisons for each (winner, loser) entry.
+    :param n_items: Number of ranked items.
+    :return: A (n_items, n_items) float array.
+    """
+    flat = np.bincount(winners * n_items + losers, weights=counts, minlength=n_items * n_items)
+    return flat.reshape(n_items, n_items)
+
+
+def bradley_terry(wins, max_iter=1000, tol=1e-9, prior=0.1):
+    """
+    Fits Bradley-Terry strengths to a win matrix with the MM algorithm (Hunter, 2004). Each iteration updates all
+    strengths at once: p_i = W_i / sum_j N_ij / (p_i + p_j), where W_i is the number of wins of item i and N_ij the
+    number of comparisons between items i and j.
+
+    :param wins: Win matrix, see `win_matrix`.
+    :param max_iter: Maximal number of iterations.
+    :param tol: Iteration stops when the largest change of log-strengths falls below this value.
+    :param prior: Number of virtual wins added for every compared pair of items in both directions, so that items that
+        never won or never lost still get finite scores.
+    :return: Log-strengths centered to zero mean. Items without comparisons get NaN.
+    """
+    wins = np.asarray(wins, dtype=float)
+    n_compared = wins + wins.T
+    wins = wins + prior * (n_compared > 0)
+    n_compared = wins + wins.T
+    total_wins = wins.sum(axis=1)
+    active = n_compared.sum(axis=1) > 0
+
+    p = np.ones(len(wins))
+    for _ in range(max_iter):
+        denominator = (n_compared / (p[:, None] + p[None, :])).sum(axis=1)
+        p_new = np.where(active, total_wins / np.where(active, denominator, 1), 1)
+        p_new /= np.exp(np.log(p_new[active]).mean())
+        change = np.abs(np.log(p_new[active]) - np.log(p[active])).max(initial=0)
+        p = p_new
+        if change < tol:
+            break
+
+    scores = np.log(p)
+    scores[~active] = np.nan
+    return scores - np.nanmean(scores) if active.any() else scores
+
+
+def elo(wins, k=32, initial=1500, max_iter=1000, tol=1e-6):
+    """
+    Fits Elo ratings to a win matrix in batch mode. Instead of replaying comparisons one by one, which makes ratings
+    depend on the order of answers, every epoch applies the summed Elo updates of all comparisons at once, scaled by
+    the number of comparisons of each item, until ratings stop changing.
+
+    :param wins: Win matrix, see `win_matrix`.
+    :param k: Elo K-factor.
+    :param initial: Mean rating.
+    :param max_iter: Maximal number of epochs.
+    :param tol: Epochs stop when the largest rating change falls below this value.
+    :return: Ratings centered to `initial`. Items without comparisons get NaN.
+    """
+    wins = np.asarray(wins, dtype=float)
+    n_compared = wins + wins.T
+    games = n_compared.sum(axis=1)
+    active = games > 0
+    total_wins = wins.sum(axis=1)
+
+    ratings = np.zeros(len(wins))
+    for _ in range(max_iter):
+        expected = 1 / (1 + 10 ** ((ratings[None, :] - ratings[:, None]) / 400))
+        delta = k * (total_wins - (n_compared * expected).sum(axis=1)) / np.maximum(games, 1)
+        ratings += delta
+        if np.abs(delta).max(initial=0) < tol:
+            break
+
+    ratings[~active] = np.nan
+    return ratings - np.nanmean(ratings) + initial if active.any() else ratings
+
+
+class Rankings:
+    """
+    Ranks segmentation networks from type 2 answers, where a user picks the more useful of two segmentation maps of the
+    same image. Each pick is one comparison between the networks that produced the maps.
+    """
+
+    methods = {"bt": bradley_terry, "elo": elo}
+
+    @staticmethod
+    def load_comparisons():
+        """
+        Loads type 2 answers aggregated by compared image pairs.
+
+        :return: A tuple (networks, comparisons) where `networks` is a list of network names and `comparisons` is a
+            dictionary of equally long arrays `winner` and `loser` (indices into `networks`), `count` (number of picks)
+            and `group` (image group id).
+        """
+        winner, loser = aliased(Image), aliased(Image)
+        rows = session.execute(
+            select(winner.filename, loser.filename, winner.group_id, func.count())
+            .select_from(AnswerType2)
+            .join(winner, AnswerType2.winner_id == winner.id)
+            .join(loser, AnswerType2.loser_id == loser.id)
+            .group_by(winner.id, loser.id)
+        ).all()
+
+        networks, indices = list(), dict()
+        comparisons = {"winner": [], "loser": [], "count": [], "group": []}
+        skipped = set()
+        for winner_filename, loser_filename, group_id, count in rows:
+            pair = list()
+            for filename in (winner_filename, loser_filename):
+                network = get_network_name(filename)
+                if network is None:
+                    skipped.add(filename)
+                    break
+                if network not in indices:
+                    indices[network] = len(networks)
+                    networks.append(network)
+                pair.append(indices[network])
+            if len(pair) != 2:
+                continue
+            comparisons["winner"].append(pair[0])
+            comparisons["loser"].append(pair[1])
+            comparisons["count"].append(count)
+            comparisons["group"].append(-1 if group_id is None else group_id)
+
+        if len(skipped) != 0:
+            logger.warning(f"Skipped comparisons with {len(skipped)} images whose filenames do not contain a network "
+                           f"name, e.g. {sorted(skipped)[0]}.")
+        comparisons = {
+            "winner": np.array(comparisons["winner"], dtype=np.int64),
+            "loser": np.array(comparisons["loser"], dtype=np.int64),
+            "count": np.array(comparisons["count"], dtype=float),
+            "group": np.array(comparisons["group"], dtype=np.int64)
+        }
+        logger.info(f"Loaded {int(comparisons['count'].sum())} comparisons of {len(networks)} networks.")
+        return networks, comparisons
+
+    @staticmethod
+    def rank(method="bt", by_group=False, n_bootstrap=1000, confidence=0.95, workers=None, seed=None):
+        """
+        Ranks networks over all comparisons and, optionally, within each image group.
+
+        :param method: Ranking method, `bt` for Bradley-Terry log-strengths or `elo` for Elo ratings.
+        :param by_group: Whether to rank networks within each image group as well.
+        :param n_bootstrap: Number of bootstrap resamples used for confidence intervals, 0 disables them.
+        :param confidence: Confidence level of the intervals.
+        :param workers: Number of worker processes used for bootstrapping. Defaults to the number of processors.
+        :param seed: Seed of the random generator used for bootstrapping.
+        :return: A list of dictionaries with keys scope, rank, network, score, ci_low, ci_high and comparisons, sorted
+            by scope and rank. Scope is `all` or `group <id>`.
+        """
+        if method not in Rankings.methods:
+            logger.error(f"Unknown ranking method '{method}'. Supported methods are {list(Rankings.methods)}.")
+            raise ValueError(f"Unknown ranking method '{method}'. Supported methods are {list(Rankings.methods)}.")
+
+        networks, comparisons = Rankings.load_comparisons()
+        n_items = len(networks)
+        scopes = [("all", np.ones(len(comparisons["count"]), dtype=bool))]
+        if by_group:
+            scopes += [(f"group {group}", comparisons["group"] == group) for group in np.unique(comparisons["group"])]
+        matrices = [
+            win_matrix(comparisons["winner"][mask], comparisons["loser"][mask], comparisons["count"][mask], n_items)
+            for _, mask in scopes
+        ]
+
+        intervals = [None] * len(scopes)
+        if n_bootstrap > 0 and n_items > 0:
+            # split resamples of every scope into chunks so that a single scope is bootstrapped by all workers
+            n_chunks = max(1, min(n_bootstrap, (workers or os.cpu_count() or 1) * 4 // len(scopes)))
+            chunk_sizes = np.diff(np.linspace(0, n_bootstrap, n_chunks + 1).astype(int))
+            seeds = np.random.SeedSequence(seed).spawn(len(scopes) * n_chunks)
+            jobs = [(wins, method, int(size), seeds[s * n_chunks + c])
+                    for s, wins in enumerate(matrices) for c, size in enumerate(chunk_sizes)]
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                samples = list(executor.map(_bootstrap_job, jobs))
+
+            alpha = (1 - confidence) / 2
+            for s in range(len(scopes)):
+                scope_samples = np.concatenate(samples[s * n_chunks:(s + 1) * n_chunks])
+                with warnings.catch_warnings():
+                    # networks not compared within a scope have only NaN scores
+                    warnings.simplefilter("ignore", RuntimeWarning)
+                    intervals[s] = (np.nanquantile(scope_samples, alpha, axis=0),
+                                    np.nanquantile(scope_samples, 1 - alpha, axis=0))
+
+        ranking = list()
+        for (scope, _), wins, interval in zip(scopes, matrices, intervals):
+            scores = Rankings.methods[method](wins)
+            n_compared = (wins + wins.T).sum(axis=1)
+            order = [i for i in np.argsort(-scores) if not np.isnan(scores[i])]
+            for rank, i in enumerate(order, start=1):
+                ranking.append({
+                    "scope": scope,
+                    "rank": rank,
+                    "network": networks[i],
+                    "score": float(scores[i]),
+                    "ci_low": None if interval is None else float(interval[0][i]),
+                    "ci_high": None if interval is None else float(interval[1][i]),
+                    "comparisons": int(n_compared[i])
+                })
+        return ranking
+
+    @staticmethod
+    def save(ranking, filepath):
+        """
+        Saves a ranking produced by `rank` to a csv file.
+
+        :param ranking: A list of ranking dictionaries.
+        :param filepath: Path of the csv file.
+        :return: None
+        """
+        with open(filepath, "w", newline="") as fout:
+            writer = csv.DictWriter(fout, fieldnames=["scope", "rank", "network", "score", "ci_low", "ci_high",
+                                                      "comparisons"])
+            writer.writeheader()
+            writer.writerows(ranking)
+        logger.info(f"Ranking saved to {filepath}.")
+
+
+def _bootstrap_job(job):
+    """
+    Computes scores for bootstrap resamples of a win matrix. Resampling comparisons with replacement is equivalent to
+    drawing the win matrix from a multinomial distribution over its cells, so a resample costs O(n_items^2) regardless
+    of the number of comparisons.
+    """
+    wins, method, n_samples, seed = job
+    rng = np.random.default_rng(seed)
+    samples = np.full((n_samples, len(wins)), np.nan)
+    total = int(wins.sum())
+    if total == 0:
+        return samples
+
+    probabilities = wins.ravel() / total
+    for b in range(n_samples):
+        resampled = rng.multinomial(total, probabilities).reshape(wins.shape).astype(float)
+        samples[b] = Rankings.methods[method](resampled)
+    return samples
@@ -0,0 +1,76 @@
+"""
+Measures the overhead of logging on question and survey generation. The same synthetic dataset is loaded into a fresh
+sqlite database for every run, and the generation stages are timed with logging switched off (CRITICAL), at the
+default level (INFO) and with per question messages (DEBUG). The overhead is the difference of median times relative
+to the run without logging.
+
+    python benchmarks/bench_logging.py --n_groups 20 --n_runs 5
+"""
+import statistics
+import sys
+import tempfile
+import time
+
+import click
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.database import session, configure, create_schema   # noqa: E402
+from utils.logger import set_levels, set_log_directory           # noqa: E402
+from model.image import Images                                   # noqa: E402
+from model.question import Questions                             # noqa: E402
+from benchmarks.synthetic import make_dataset                    # noqa: E402
+
+
+LEVELS = ["CRITICAL", "INFO", "DEBUG"]
+
+
+def run(directory, dataset_dir, name, level, questions_per_survey):
+    from generators.surveygeneratortype1 import SurveyGenerator as SurveyGeneratorType1
+    from generators.surveygeneratortype2 import SurveyGenerator as SurveyGeneratorType2
+
+    configure(url=f"sqlite:///{directory}/{name}.db")
+    create_schema()
+    set_levels("CRITICAL")
+    Images.load_images(dataset_dir, extensions=[".png"])
+    session.expunge_all()
+
+    set_levels(level)
+    start = time.perf_counter()
+    Questions.generate(question_types=["1", "2"], n_repeat=5)
+    for survey_type in ["regular", "control"]:
+        SurveyGeneratorType1(question_types=["1"], survey_type=survey_type,
+                             questions_per_survey=questions_per_survey).generate_all()
+    SurveyGeneratorType2().generate_all()
+    elapsed = time.perf_counter() - start
+    set_levels("CRITICAL")
+    session.remove()
+    return elapsed
+
+
+@click.command()
+@click.option("--n_groups", type=int, default=20, help="Number of image groups in the synthetic dataset.")
+@click.option("--questions_per_survey", type=int, default=10)
+@click.option("--n_runs", type=int, default=5, help="Runs per log level, the median time is reported.")
+def main(n_groups, questions_per_survey, n_runs):
+    with tempfile.TemporaryDirectory() as directory:
+        # records are still written to a file, as they are by the tool, but not to the log directory of the repository
+        set_log_directory(directory)
+        dataset_dir = make_dataset(directory, n_groups, size=(64, 64))
+        times = {level: list() for level in LEVELS}
+        # levels are interleaved so that a slower period of the machine affects all of them
+        for i in range(n_runs):
+            for level in LEVELS:
+                times[level].append(run(directory, dataset_dir, f"{level}-{i}", level, questions_per_survey))
+        set_log_directory(None)
+    baseline = statistics.median(times["CRITICAL"])
+    print(f"{'level':<10} {'median s':>9} {'overhead':>9}")
+    for level in LEVELS:
+        median = statistics.median(times[level])
+        print(f"{level:<10} {median:>9.3f} {(median - baseline) / baseline:>9.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""
+Benchmarks the whole pipeline on synthetic data: loading DRIVE, STARE and CHASE style datasets, generating type 1 and
+type 2 questions, generating regular, control and type 2 surveys, exporting them, and importing simulated survey
+results of every user for every survey. Each step runs as a stage of `utils.profiling`, so wall and CPU time, peak
+memory and SQL statements are recorded per step and saved to a json file.
+
+A scale is the number of images, split evenly between the datasets, with an original and a segmentation map per
+network in every image group. Compare a run with an earlier one to spot regressions, the benchmark exits with a non
+zero status if a step is slower than in the baseline by more than the tolerance:
+
+    python benchmarks/bench_pipeline.py --scale 1k --output pipeline-1k.json
+    python benchmarks/bench_pipeline.py --scale 1k --output pipeline-1k-new.json --baseline pipeline-1k.json
+
+Images are small squares by default, use --full_size for the real image sizes of the datasets.
+"""
+import json
+import sys
+import tempfile
+
+import click
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils import profiling                                          # noqa: E402
+from utils.database import session, configure, create_schema         # noqa: E402
+from utils.logger import set_levels, set_log_directory               # noqa: E402
+from utils.profiling import stage                                    # noqa: E402
+from model.user import User                                          # noqa: E402, F401
+from model.survey import Survey                                      # noqa: E402, F401
+from model.image import Images                                       # noqa: E402
+from model.question import Questions                                 # noqa: E402
+from model.results import SurveyResults                              # noqa: E402
+from benchmarks.synthetic import make_dataset, make_results, NETWORKS  # noqa: E402
+
+
+# number of images of a scale
+SCALES = {"1k": 1000, "10k": 10000, "100k": 100000}
+
+DATASETS = ["DRIVE", "STARE", "CHASE"]
+
+
+def run_pipeline(directory, n_images, n_users, image_size, questions_per_survey, workers):
+    from generators.surveygeneratortype1 import SurveyGenerator as SurveyGeneratorType1
+    from generators.surveygeneratortype2 import SurveyGenerator as SurveyGeneratorType2
+
+    n_groups = n_images // (len(NETWORKS) + 1) // len(DATASETS)
+    dataset_dirs = list()
+    with stage("make dataset"):
+        for i, dataset in enumerate(DATASETS):
+            size = (image_size, image_size) if image_size is not None else Images.get_dataset_image_dims(dataset)
+            dataset_dirs.append(make_dataset(directory, n_groups, dataset=dataset, size=size, seed=i,
+                                             start=i * n_groups + 1))
+
+    with stage("load images"):
+        for dataset_dir in dataset_dirs:
+            Images.load_images(dataset_dir, extensions=[".png"])
+    session.expunge_all()
+    with stage("generate questions"):
+        Questions.generate(question_types=["1", "2"], n_repeat=5)
+    for survey_type in ["regular", "control"]:
+        session.expunge_all()
+        with stage(f"generate {survey_type} surveys"):
+            SurveyGeneratorType1(question_types=["1"], survey_type=survey_type,
+                                 questions_per_survey=questions_per_survey).generate_all()
+    session.expunge_all()
+    with stage("generate type 2 surveys"):
+        SurveyGeneratorType2().generate_all()
+
+    export_dir = Path(directory) / "export"
+    for name in ["regular", "control", "type2"]:
+        (export_dir / name).mkdir(parents=True)
+    for survey_type in ["regular", "control"]:
+        session.expunge_all()
+        with stage(f"export {survey_type} surveys"):
+            SurveyGeneratorType1.export_surveys(export_dir / survey_type, survey_type=survey_type, workers=workers)
+    session.expunge_all()
+    with stage("export type 2 surveys"):
+        SurveyGeneratorType2.export_surveys(export_dir / "type2", workers=workers)
+
+    session.expunge_all()
+    results_dir = Path(directory) / "results"
+    with stage("make results"):
+        make_results(results_dir, n_users)
+    with stage("load results"):
+        SurveyResults.load_directory(results_dir, workers=workers)
+    session.remove()
+
+
+def compare(stages, baseline_path, tolerance):
+    """
+    Prints steps slower than in the baseline by more than the tolerance and returns False if there are any.
+    """
+    with open(baseline_path) as fin:
+        baseline = {row["name"]: row for row in json.load(fin)["stages"]}
+    passed = True
+    for row in stages:
+        if row["name"] not in baseline or "/" in row["name"]:
+            continue
+        before = baseline[row["name"]]["wall_seconds"]
+        change = (row["wall_seconds"] - before) / before if before > 0 else 0
+        if change > tolerance:
+            print(f"SLOWER {row['name']}: {row['wall_seconds']:.2f} s, baseline {before:.2f} s ({change:+.0%})")
+            passed = False
+    return passed
+
+
+@click.command()
+@click.option("--scale", type=click.Choice(list(SCALES)), default="1k", help="Number of images.")
+@click.option("--n_users", type=int, default=10, help="Number of users, each fills in every survey.")
+@click.option("--image_size", type=int, default=64, help="Width and height of the synthetic images.")
+@click.option("--full_size", is_flag=True, help="Use real image sizes of the datasets instead of --image_size.")
+@click.option("--questions_per_survey", type=int, default=20)
+@click.option("--workers", type=int, help="Number of worker processes used for export and result import.")
+@click.option("--database", type=str, help="SQLAlchemy url of an empty database, a new sqlite database in a temporary "
+                                           "directory by default.")
+@click.option("--output", type=str, default="pipeline.json", help="Json file to which metrics are saved.")
+@click.option("--profile_stage", type=str, help="Name of a stage to profile with cProfile, e.g. `load results`.")
+@click.option("--baseline", type=str, help="Metrics of an earlier run to compare with.")
+@click.option("--tolerance", type=float, default=0.2, help="Allowed relative slowdown of a step compared to the "
+                                                           "baseline.")
+def main(scale, n_users, image_size, full_size, questions_per_survey, workers, database, output, profile_stage,
+         baseline, tolerance):
+    set_levels("WARNING")
+    profiling.enable(output, profile_stage=profile_stage)
+    with tempfile.TemporaryDirectory() as directory:
+        set_log_directory(directory)
+        configure(url=database or f"sqlite:///{directory}/pipeline.db")
+        create_schema()
+        run_pipeline(directory, SCALES[scale], n_users, None if full_size else image_size, questions_per_survey,
+                     workers)
+        set_log_directory(None)
+    profiling.save()
+
+    stages = [row for row in profiling.get_stages() if "/" not in row["name"]]
+    print(f"{'stage':<26} {'wall s':>8} {'cpu s':>8} {'peak MB':>8} {'queries':>8} {'sql s':>7}")
+    for row in stages:
+        cpu = row["cpu_seconds"] + row["children_cpu_seconds"]
+        print(f"{row['name']:<26} {row['wall_seconds']:>8.2f} {cpu:>8.2f} {row['peak_rss'] / 1024 / 1024:>8.0f} "
+              f"{row['sql_statements']:>8} {row['sql_seconds']:>7.2f}")
+    if baseline is not None and not compare(profiling.get_stages(), baseline, tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""
+Compares insert and query throughput of the sqlite profiles from utils.database.
+
+Each profile gets a fresh database in a temporary directory. Answers are inserted in batches, one transaction per
+batch like the survey result import does, and then read back per user and aggregated per question.
+
+    python benchmarks/bench_sqlite_profiles.py --n_answers 200000 --batch_size 500
+"""
+import random
+import sys
+import tempfile
+import time
+
+import click
+
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import insert, select, func
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.database import session, configure, create_schema, SQLITE_PROFILES  # noqa: E402
+from model.user import User                                                      # noqa: E402
+from model.survey import Survey, SurveyResult                                    # noqa: E402
+from model.answer import Answer, AnswerType1, Answers                            # noqa: E402
+from model.question import Question                                              # noqa: E402
+from model.results import ResultImport                                           # noqa: E402, F401
+from model.stats import SurveyStats                                              # noqa: E402, F401
+
+
+def populate(n_users, n_questions):
+    now = datetime.now()
+    session.execute(insert(User.__table__), [
+        {"id": i, "name": f"user {i}", "access_token": f"token-{i}", "created_at": now} for i in range(1, n_users + 1)
+    ])
+    session.execute(insert(Question.__table__), [
+        {"id": i, "type": 1, "json": "{}", "created_at": now} for i in range(1, n_questions + 1)
+    ])
+    session.execute(insert(Survey.__table__), [{"id": 1, "type": "base", "json": "{}", "created_at": now}])
+    session.commit()
+
+
+def bench_inserts(n_users, n_questions, n_answers, batch_size):
+    keys = random.sample([(q, u) for q in range(1, n_questions + 1) for u in range(1, n_users + 1)], n_answers)
+    start = time.perf_counter()
+    for i in range(0, n_answers, batch_size):
+        batch = keys[i:i + batch_size]
+        survey_result_id = session.execute(
+            insert(SurveyResult.__table__).returning(SurveyResult.id), [{"survey_id": 1, "user_id": batch[0][1]}]
+        ).scalar_one()
+        session.execute(insert(Answer.__table__), [
+            {"question_id": q, "user_id": u, "surveyresult_id": survey_result_id, "type": 1} for q, u in batch
+        ])
+        session.execute(insert(AnswerType1.__table__), [
+            {"question_id": q, "user_id": u, "disease_id": None, "certainty": random.randint(1, 5), "invalid": False}
+            for q, u in batch
+        ])
+        session.commit()
+    return n_answers / (time.perf_counter() - start)
+
+
+def bench_queries(n_users, n_repeats):
+    atype1 = AnswerType1.__table__
+    start = time.perf_counter()
+    n_rows = 0
+    for _ in range(n_repeats):
+        for user_id in range(1, n_users + 1, 10):
+            n_rows += len(Answers.get_answers_for_user([user_id, user_id + 1]))
+        n_rows += len(session.execute(
+            select(atype1.c.question_id, func.count(), func.avg(atype1.c.certainty)).group_by(atype1.c.question_id)
+        ).all())
+    return n_rows / (time.perf_counter() - start)
+
+
+@click.command()
+@click.option("--n_users", type=int, default=200)
+@click.option("--n_questions", type=int, default=2000)
+@click.option("--n_answers", type=int, default=100000)
+@click.option("--batch_size", type=int, default=500, help="Answers committed per transaction.")
+@click.option("--n_repeats", type=int, default=3, help="How many times the query workload is repeated.")
+@click.option("--seed", type=int, default=0)
+def main(n_users, n_questions, n_answers, batch_size, n_repeats, seed):
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{'profile':<8} {'inserts/s':>12} {'rows read/s':>14}")
+        for profile in SQLITE_PROFILES:
+            random.seed(seed)
+            configure(url=f"sqlite:///{directory}/bench-{profile}.db", sqlite_profile=profile)
+            create_schema()
+            populate(n_users, n_questions)
+            insert_rate = bench_inserts(n_users, n_questions, n_answers, batch_size)
+            query_rate = bench_queries(n_users, n_repeats)
+            print(f"{profile:<8} {insert_rate:>12.0f} {query_rate:>14.0f}")
+            session.close()
+
+
+if __name__ == '__main__':
+    main()
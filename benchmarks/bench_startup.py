@@ -0,0 +1,88 @@
+"""
+Measures how long `main.py` takes to start: wall time of `--help` and of small commands, each run in a new Python
+process against a database in a temporary directory. The first run of a command creates the schema, later runs only
+verify it. With --importtime, prints the modules that take longest to import for `main.py --help`. Exits with a non
+zero status if `--help` is slower than --max_help.
+
+    python benchmarks/bench_startup.py --n_runs 5 --importtime
+"""
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from pathlib import Path
+
+
+MAIN_PATH = Path(__file__).resolve().parents[1] / "main.py"
+
+# (name, arguments of main.py)
+COMMANDS = [
+    ("--help", ["--help"]),
+    ("generate --help", ["generate", "--help"]),
+    ("db version", ["db", "version"]),
+    ("stats surveys", ["stats", "surveys"])
+]
+
+
+def run(arguments, directory, python_options=()):
+    environment = dict(os.environ, SURVEY_DATABASE_URL=f"sqlite:///{directory}/startup.db")
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, *python_options, str(MAIN_PATH), *arguments], cwd=directory,
+                             env=environment, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if process.returncode != 0:
+        raise click.ClickException(f"main.py {' '.join(arguments)} failed:\n{process.stderr}")
+    return elapsed, process.stderr
+
+
+def run_python(directory):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", "pass"], cwd=directory, check=True)
+    return time.perf_counter() - start
+
+
+def print_import_times(directory, n_modules):
+    # -X importtime writes `import time: self [us] | cumulative | imported package` lines to stderr
+    _, stderr = run(["--help"], directory, python_options=["-X", "importtime"])
+    modules = list()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_time, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), int(self_time), name.rstrip()))
+    print(f"\n{'cumulative ms':>14} {'self ms':>8}  module")
+    for cumulative, self_time, name in sorted(modules, reverse=True)[:n_modules]:
+        print(f"{cumulative / 1000:>14.1f} {self_time / 1000:>8.1f}  {name}")
+
+
+@click.command()
+@click.option("--n_runs", type=int, default=5, help="Runs of every command, the median time is reported.")
+@click.option("--importtime", is_flag=True, help="Print modules taking longest to import for `main.py --help`.")
+@click.option("--n_modules", type=int, default=15, help="Number of modules printed with --importtime.")
+@click.option("--max_help", type=float, help="Maximum median time of `main.py --help` in seconds.")
+def main(n_runs, importtime, n_modules, max_help):
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = statistics.median(run_python(directory) for _ in range(n_runs))
+        print(f"{'command':<20} {'first s':>8} {'median s':>9}")
+        print(f"{'python -c pass':<20} {'':>8} {baseline:>9.3f}")
+        medians = dict()
+        for name, arguments in COMMANDS:
+            times = [run(arguments, directory)[0] for _ in range(n_runs)]
+            medians[name] = statistics.median(times)
+            print(f"{name:<20} {times[0]:>8.3f} {medians[name]:>9.3f}")
+        if importtime:
+            print_import_times(directory, n_modules)
+        if list(Path(directory).glob("logs/*")):
+            print("\nwarning: a log file was created although no command logged anything")
+    if max_help is not None and medians["--help"] > max_help:
+        print(f"FAIL main.py --help took {medians['--help']:.3f} s, maximum is {max_help:.3f} s")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Checks the parquet export of answers on a synthetic dataset in a fresh sqlite database: every exported table must
+have as many rows as its table in the database. Regular, control and type 2 surveys are generated and filled in by
+simulated users, so answers of all kinds are exported. Skipped if pyarrow is not installed, exits with a non zero
+status if the row counts differ.
+
+    python benchmarks/check_parquet_export.py --n_groups 6 --n_users 5
+"""
+import sys
+import tempfile
+
+import click
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import select, func                                  # noqa: E402
+
+from utils.database import session, configure, create_schema         # noqa: E402
+from utils.logger import set_levels, set_log_directory               # noqa: E402
+from model.user import User                                          # noqa: E402, F401
+from model.survey import SurveyResult                                # noqa: E402
+from model.answer import Answer, ControlAnswer                       # noqa: E402
+from model.disease import Disease                                    # noqa: E402
+from model.image import Image, Images                                # noqa: E402
+from model.question import Question, Questions                       # noqa: E402
+from model.results import SurveyResults                              # noqa: E402
+from benchmarks.synthetic import make_dataset, make_results          # noqa: E402
+
+
+# exported file and the database table whose rows it must contain
+TABLES = {
+    "answers": Answer,
+    "control_answers": ControlAnswer,
+    "questions": Question,
+    "images": Image,
+    "diseases": Disease,
+    "survey_results": SurveyResult
+}
+
+
+@click.command()
+@click.option("--n_groups", type=int, default=6, help="Number of image groups in the synthetic dataset.")
+@click.option("--n_users", type=int, default=5, help="Number of users, each fills in every survey.")
+@click.option("--questions_per_survey", type=int, default=10)
+def main(n_groups, n_users, questions_per_survey):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("SKIP parquet export: pyarrow is not installed.")
+        return
+    from generators.surveygeneratortype1 import SurveyGenerator as SurveyGeneratorType1
+    from generators.surveygeneratortype2 import SurveyGenerator as SurveyGeneratorType2
+    from utils.columnar import ParquetExport
+
+    set_levels("WARNING")
+    passed = True
+    with tempfile.TemporaryDirectory() as directory:
+        set_log_directory(directory)
+        configure(url=f"sqlite:///{directory}/parquet.db")
+        create_schema()
+        Images.load_images(make_dataset(directory, n_groups, size=(64, 64)), extensions=[".png"])
+        Questions.generate(question_types=["1", "2"], n_repeat=5)
+        for survey_type in ["regular", "control"]:
+            SurveyGeneratorType1(question_types=["1"], survey_type=survey_type,
+                                 questions_per_survey=questions_per_survey).generate_all()
+        SurveyGeneratorType2().generate_all()
+        results_dir = Path(directory) / "results"
+        make_results(results_dir, n_users)
+        SurveyResults.load_directory(results_dir, workers=1)
+
+        export_dir = Path(directory) / "parquet"
+        ParquetExport.export(export_dir, batch_size=100)
+        for name, model in TABLES.items():
+            expected = session.execute(select(func.count()).select_from(model.__table__)).scalar_one()
+            exported = pq.read_metadata(export_dir / f"{name}.parquet").num_rows
+            if exported != expected or expected == 0:
+                print(f"FAIL {name}: {exported} rows exported, {expected} rows in the database")
+                passed = False
+            else:
+                print(f"ok   {name}: {exported} rows")
+        session.remove()
+        set_log_directory(None)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Checks upserts through the COPY staging table on postgresql: several upserts into the same table within a transaction,
+an upsert after a failed one, accumulated counters, and that no staging table is left after the commit. Works on a
+scratch table that is dropped afterwards. Skipped unless SURVEY_DATABASE_URL is set to a postgresql database, exits
+with a non zero status if a check fails.
+
+    SURVEY_DATABASE_URL=postgresql+psycopg2://user@host/survey python benchmarks/check_postgres_upsert.py
+"""
+import os
+import sys
+
+import click
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from sqlalchemy import MetaData, Table, Column, Integer, select, text, make_url   # noqa: E402
+from sqlalchemy.exc import DBAPIError                                            # noqa: E402
+
+from utils.database import (DATABASE_URL_ENV, COPY_THRESHOLD, session, configure, upsert,   # noqa: E402
+                            unit_of_work)
+from utils.logger import set_levels, set_log_directory                                     # noqa: E402
+
+
+TABLE_NAME = "upsert_check"
+
+
+def check(name, passed, details=""):
+    print(f"{'ok  ' if passed else 'FAIL'} {name}{': ' + details if details else ''}")
+    return passed
+
+
+def staging_tables(uow):
+    return uow.execute(text("SELECT tablename FROM pg_tables WHERE schemaname LIKE 'pg_temp%' "
+                            f"AND tablename LIKE '{TABLE_NAME}_staging%'")).scalars().all()
+
+
+@click.command()
+@click.option("--n_rows", type=int, default=2 * COPY_THRESHOLD, help="Number of rows of an upsert, copied to a "
+                                                                    "staging table from COPY_THRESHOLD rows.")
+def main(n_rows):
+    url = os.environ.get(DATABASE_URL_ENV)
+    if url is None or make_url(url).get_backend_name() != "postgresql":
+        print(f"SKIP postgresql upsert: {DATABASE_URL_ENV} is not set to a postgresql database.")
+        return
+
+    set_levels("WARNING")
+    set_log_directory(None)
+    configure(url=url)
+    table = Table(TABLE_NAME, MetaData(), Column("id", Integer, primary_key=True), Column("value", Integer))
+    table.drop(session.get_bind(), checkfirst=True)
+    table.create(session.get_bind())
+    passed = True
+    try:
+        with unit_of_work() as uow:
+            upsert(table, [{"id": i, "value": 1} for i in range(n_rows)], index_elements=["id"],
+                   update_columns=["value"], session=uow)
+            upsert(table, [{"id": i, "value": 2} for i in range(n_rows // 2, n_rows + n_rows // 2)],
+                   index_elements=["id"], update_columns=["value"], accumulate=True, session=uow)
+            try:
+                with uow.begin_nested():
+                    # rows colliding with each other make the INSERT ... SELECT from the staging table fail
+                    upsert(table, [{"id": i % 10, "value": 5} for i in range(n_rows)], index_elements=["id"],
+                           update_columns=["value"], session=uow)
+            except DBAPIError:
+                passed &= check("colliding rows fail", True)
+            else:
+                passed &= check("colliding rows fail", False, "the upsert succeeded")
+            upsert(table, [{"id": i, "value": 10} for i in range(n_rows, 2 * n_rows)], index_elements=["id"],
+                   update_columns=["value"], session=uow)
+
+        with unit_of_work() as uow:
+            values = dict(uow.execute(select(table.c.id, table.c.value)).all())
+            expected = {i: 1 for i in range(n_rows // 2)}
+            expected.update({i: 3 for i in range(n_rows // 2, n_rows)})
+            expected.update({i: 10 for i in range(n_rows, 2 * n_rows)})
+            mismatched = sum(values.get(key) != value for key, value in expected.items())
+            passed &= check("upserted values", mismatched == 0 and len(values) == len(expected),
+                            f"{len(values)} rows, {mismatched} differ from the expected values")
+            left = staging_tables(uow)
+            passed &= check("staging tables dropped", len(left) == 0, ", ".join(left))
+    finally:
+        session.remove()
+        table.drop(session.get_bind(), checkfirst=True)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
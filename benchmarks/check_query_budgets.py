@@ -0,0 +1,96 @@
+"""
+Checks that survey generation and export stages stay within their query budgets, i.e. do not issue a query per
+question or image, on a synthetic dataset in a fresh sqlite database. Budgets grow only with the number of batches, i.e.
+image groups and surveys, so a lazy load per question makes a stage exceed its budget. Exits with a non zero status if
+any stage exceeds its budget.
+
+    python benchmarks/check_query_budgets.py --n_groups 10 --questions_per_survey 10
+"""
+import sys
+import tempfile
+
+import click
+
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from utils.database import session, configure, create_schema, query_budget   # noqa: E402
+from utils.logger import set_log_directory                                    # noqa: E402
+from model.user import User                                                   # noqa: E402, F401
+from model.survey import Survey                                               # noqa: E402, F401
+from model.image import Images                                                # noqa: E402
+from model.question import Questions                                          # noqa: E402
+from model.results import ResultImport                                        # noqa: E402, F401
+from model.stats import SurveyStats                                           # noqa: E402, F401
+from model.consistency import RaterConsistency                                # noqa: E402, F401
+from benchmarks.synthetic import make_dataset, NETWORKS, DISEASES             # noqa: E402
+
+
+def run_stage(name, budget, function, count_inserts=True):
+    try:
+        with query_budget(budget, name, count_inserts=count_inserts) as counter:
+            function()
+    except RuntimeError as error:
+        print(f"FAIL {name}: {error}")
+        return False
+    inserts = "" if count_inserts else f", {counter['inserts']} inserts not counted"
+    print(f"ok   {name}: {counter['queries']} queries, budget {budget}{inserts}")
+    return True
+
+
+@click.command()
+@click.option("--n_groups", type=int, default=6, help="Number of image groups in the synthetic dataset.")
+@click.option("--questions_per_survey", type=int, default=10)
+def main(n_groups, questions_per_survey):
+    from generators.surveygeneratortype1 import SurveyGenerator as SurveyGeneratorType1
+    from generators.surveygeneratortype2 import SurveyGenerator as SurveyGeneratorType2
+
+    n_images = n_groups * (len(NETWORKS) + 1)
+    # a type 1 question per image, and a type 2 question per pair of segmentation maps in a group with half of the
+    # pairs repeated, see `Questions.generate_questions_t2`
+    n_pairs = len(NETWORKS) * (len(NETWORKS) - 1) // 2
+    n_questions = n_images + n_groups * (n_pairs + n_pairs // 2)
+    with tempfile.TemporaryDirectory() as directory:
+        set_log_directory(directory)
+        configure(url=f"sqlite:///{directory}/budget.db")
+        create_schema()
+        dataset_dir = make_dataset(directory, n_groups, size=(64, 64))
+        export_dir = Path(directory) / "export"
+        export_dir.mkdir()
+
+        def n_surveys():
+            return session.query(Survey).count()
+
+        # images and questions are added as ORM objects, which sqlite inserts one row per statement because it has no
+        # insert sentinel for autoincrement keys, so inserts of these stages are not counted; diseases are looked up
+        # once per token and images are read once per image group
+        passed = run_stage("load images", len(DISEASES) + 10,
+                           lambda: Images.load_images(dataset_dir, extensions=[".png"]), count_inserts=False)
+        passed &= run_stage("generate questions", 5 * n_groups + 10,
+                            lambda: Questions.generate(question_types=["1", "2"], n_repeat=5), count_inserts=False)
+        session.expunge_all()
+        passed &= run_stage("generate regular surveys", 15 * (n_questions // questions_per_survey + 1) + 10,
+                            lambda: SurveyGeneratorType1(question_types=["1"], survey_type="regular",
+                                                         questions_per_survey=questions_per_survey)
+                            .generate_all())
+        session.expunge_all()
+        passed &= run_stage("generate control surveys", 15 * (n_questions // questions_per_survey + 1) + 10,
+                            lambda: SurveyGeneratorType1(question_types=["1"], survey_type="control",
+                                                         questions_per_survey=questions_per_survey)
+                            .generate_all())
+        for survey_type in ["regular", "control"]:
+            session.expunge_all()
+            passed &= run_stage(f"export {survey_type} surveys", n_surveys() + 10,
+                                lambda: SurveyGeneratorType1.export_surveys(export_dir, survey_type=survey_type,
+                                                                            image_format="png"))
+        session.expunge_all()
+        passed &= run_stage("export surveys with inline images", n_surveys() + 10,
+                            lambda: SurveyGeneratorType2.export_surveys(export_dir, image_format="png"))
+        session.remove()
+        set_log_directory(None)
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""
+Synthetic datasets for benchmarks, laid out like the real ones: a dataset directory with original fundus images,
+segmentation maps named <number>-<network>-<dataset>.png and a <dataset>.json metadata file assigning segmentation
+maps of the same original to an image group, and survey result files like the ones exported by the survey application.
+"""
+import json
+import numpy as np
+
+from datetime import datetime
+from pathlib import Path
+from PIL import Image
+from secrets import token_urlsafe
+
+
+NETWORKS = ["unet", "segnet", "dunet", "laddernet"]
+
+# diseases assigned to originals, an original has none, one or two of them
+DISEASES = [
+    {"name": "Dijabetes", "token": "diabetic_retinopathy"},
+    {"name": "Okluzija vene", "token": "vein_occlusion"},
+    {"name": "Glaukom", "token": "glaucoma"},
+    {"name": "Hipertenzija", "token": "hypertensive_retinopathy"}
+]
+
+
+def make_dataset(directory, n_groups, networks=None, dataset="DRIVE", size=(565, 584), seed=0, start=1):
+    """
+    Writes a synthetic dataset with `n_groups` originals and a segmentation map per network for each of them.
+
+    :param directory: Directory in which the dataset directory is created.
+    :param n_groups: Number of original images, each with its own group of segmentation maps.
+    :param networks: Names of networks producing the segmentation maps, NETWORKS by default.
+    :param dataset: Name of the dataset directory, must be a dataset known to `Images.get_dataset_image_dims`.
+    :param size: Image size as (width, height).
+    :param seed: Random seed of image content and diseases.
+    :param start: Number of the first original. Image filenames are unique in the database, so datasets loaded into
+        the same database must not share numbers.
+    :return: Path of the dataset directory.
+    """
+    networks = NETWORKS if networks is None else networks
+    random = np.random.default_rng(seed)
+    dataset_dir = Path(directory) / dataset
+    dataset_dir.mkdir(parents=True, exist_ok=True)
+    width, height = size
+
+    metadata = list()
+    for i in range(1, n_groups + 1):
+        name = f"{start + i - 1:06d}"
+        original = random.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        Image.fromarray(original).save(dataset_dir / f"{name}.png")
+        diseases = random.choice(len(DISEASES), size=random.integers(0, 3), replace=False)
+        metadata.append({"image_name": name, "type": "original", "diseases": [DISEASES[d] for d in sorted(diseases)]})
+        for network in networks:
+            segmap = (random.random((height, width)) > 0.5).astype(np.uint8) * 255
+            segmap_name = f"{name}-{network}-{dataset.lower()}"
+            Image.fromarray(segmap).save(dataset_dir / f"{segmap_name}.png")
+            metadata.append({"image_name": segmap_name, "type": "segmap", "group": i, "diseases": []})
+
+    with open(dataset_dir / f"{dataset.lower()}.json", "w") as fout:
+        json.dump(metadata, fout)
+    return dataset_dir
+
+
+def make_results(directory, n_users, seed=0):
+    """
+    Writes a result file per user with a result of every survey in the database, as if each user filled in all
+    surveys. Users are added to the database if it has fewer than `n_users`. Answers are random but not uniform: a
+    type 1 question gets the same disease from most users and type 2 questions favour the segmentation map with the
+    larger image id, so agreement and ranking have something to find.
+
+    :param directory: Directory in which the result files are written.
+    :param n_users: Number of users filling in the surveys.
+    :param seed: Random seed of answers.
+    :return: A list of paths of the result files.
+    """
+    # the dataset part of this module does not need the database
+    from sqlalchemy import insert, select, func
+    from utils.database import session
+    from model.user import User
+    from model.disease import Disease
+    from model.image import Image as ImageModel, image_qtype2
+    from model.question import Question
+
+    random = np.random.default_rng(seed)
+    n_existing = session.execute(select(func.count()).select_from(User)).scalar_one()
+    if n_existing < n_users:
+        session.execute(insert(User.__table__), [
+            {"name": f"rater {i}", "access_token": token_urlsafe(16), "created_at": datetime.now()}
+            for i in range(n_existing + 1, n_users + 1)
+        ])
+        session.commit()
+    user_ids = session.execute(select(User.id).order_by(User.id).limit(n_users)).scalars().all()
+    tokens = session.execute(select(Disease.token).order_by(Disease.id)).scalars().all() + ["none", "not_applicable"]
+
+    # segmentation maps compared by a type 2 question, its original is shown as well
+    pairs = dict()
+    for question_id, image_id in session.execute(
+            select(image_qtype2.c.question_id, image_qtype2.c.image_id)
+            .join(ImageModel, ImageModel.id == image_qtype2.c.image_id)
+            .where(ImageModel.type != "original")
+            .order_by(image_qtype2.c.question_id, image_qtype2.c.image_id)):
+        pairs.setdefault(question_id, list()).append(image_id)
+
+    surveys = dict()
+    for question_id, question_type, regular_survey_id, control_survey_id in session.execute(
+            select(Question.id, Question.type, Question.regular_survey_id, Question.control_survey_id)
+            .order_by(Question.id)):
+        for survey_id in (regular_survey_id, control_survey_id):
+            if survey_id is not None:
+                surveys.setdefault(survey_id, list()).append((question_id, question_type))
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    paths = list()
+    for user_id in user_ids:
+        data = list()
+        for survey_id, questions in surveys.items():
+            result = {"doctorID": str(user_id)}
+            for question_id, question_type in questions:
+                if question_type == 1:
+                    agrees = random.random() < 0.6
+                    token = tokens[question_id % len(tokens)] if agrees else tokens[random.integers(len(tokens))]
+                    result[f"s{survey_id}-q{question_id}-choice"] = token
+                    result[f"s{survey_id}-q{question_id}-certainty"] = int(random.integers(1, 6))
+                elif question_id in pairs:
+                    first, second = pairs[question_id][:2]
+                    picked = second if random.random() < 0.7 else first
+                    result[f"s{survey_id}-q{question_id}-im{first}-im{second}-impicker"] = f"im{picked}"
+            data.append(result)
+        path = Path(directory) / f"user-{user_id}.json"
+        with open(path, "w") as fout:
+            json.dump({"ResultCount": len(data), "Data": data}, fout)
+        paths.append(path)
+    return paths
@@ -0,0 +1,177 @@
+import json
+
+from pathlib import Path
+from string import Template
+
+from utils.logger import get_logger
+from utils.tools import js_object_to_json
+
+
+logger = get_logger(__name__)
+
+
+class PagedSurveyExport:
+    """
+    Exports a survey as a small html shell, a manifest and one json fragment per survey page. The shell renders the
+    survey with placeholder pages and fetches page fragments listed in the manifest when their page becomes current,
+    prefetching the next page. A failed fetch is shown on the placeholder page and repeated after a growing delay.
+    Fragments are fetched over http, so the exported files must be served by a web server.
+
+    For a survey exported under the name `regular-survey-5.t1` the following files are created in the export directory:
+        regular-survey-5.t1.html            - the survey shell
+        regular-survey-5.t1.manifest.json   - survey id and a list of page fragments with their sizes
+        regular-survey-5.t1/page-<i>.json   - page fragments
+    """
+
+    @staticmethod
+    def export(survey_json, where, name, head, body_template):
+        """
+
+        :param survey_json: Survey json string, as stored in the database.
+        :param where: Export directory.
+        :param name: Base name of exported files, without an extension.
+        :param head: Html head section of the shell.
+        :param body_template: Html body template of the shell with $survey_json and $jqueryselector placeholders.
+        :return: None
+        """
+        survey = json.loads(js_object_to_json(survey_json), strict=False)
+        pages = survey.pop("pages")
+
+        pages_dir = Path(where) / name
+        pages_dir.mkdir(exist_ok=True)
+
+        manifest = {"surveyID": survey.get("surveyID"), "pages": []}
+        skeleton_pages = list()
+        for i, page in enumerate(pages):
+            fragment = json.dumps(page, ensure_ascii=False, separators=(",", ":"))
+            with open(pages_dir / f"page-{i}.json", "w") as fout:
+                fout.write(fragment)
+            manifest["pages"].append({
+                "name": page["name"],
+                "url": f"{name}/page-{i}.json",
+                "bytes": len(fragment.encode("utf-8"))
+            })
+            # placeholder page, survey js skips pages without elements
+            skeleton_pages.append({
+                "name": page["name"],
+                "title": page.get("title", ""),
+                "elements": [{"type": "html", "name": page["name"] + "-loading", "html": "Učitavanje..."}]
+            })
+
+        manifest_filename = f"{name}.manifest.json"
+        with open(Path(where) / manifest_filename, "w") as fout:
+            json.dump(manifest, fout, ensure_ascii=False)
+
+        survey["pages"] = skeleton_pages
+        body = body_template.substitute({
+            "survey_json": json.dumps(survey, ensure_ascii=False),
+            "jqueryselector": "$"
+        })
+        loader = PagedSurveyExport._get_loader_template().substitute({"manifest": manifest_filename})
+        html = Template("""
+<html>
+                    $head
+                    $body
+</html>
+                """).substitute({
+            "head": head,
+            "body": body.replace("</body>", loader + "</body>")
+        })
+        with open(Path(where) / f"{name}.html", "w") as fout:
+            fout.write(html)
+        logger.info(f"Survey {name} saved as a shell with {len(pages)} page fragments!")
+
+    @staticmethod
+    def _get_loader_template():
+        # $manifest - manifest filename relative to the shell
+        return Template("""
+    <!-- Load survey pages on demand -->
+    <script>
+      var surveyManifest = null;
+      var pageRequests = {};
+      var loadedPages = {};
+      var failedAttempts = {};
+
+      function fetchJSON(url) {
+        return fetch(url).then(function (response) {
+          if (!response.ok) throw new Error(url + ": " + response.status + " " + response.statusText);
+          return response.json();
+        });
+      }
+
+      function getManifest() {
+        // a failed manifest request is repeated with the next page request
+        if (surveyManifest === null) {
+          surveyManifest = fetchJSON("$manifest").catch(function (error) {
+            surveyManifest = null;
+            throw error;
+          });
+        }
+        return surveyManifest;
+      }
+
+      function fillPage(index, fragment) {
+        var page = survey.pages[index];
+        var placeholder = page.getQuestionByName(page.name + "-loading");
+        fragment.elements.forEach(function (elementJSON) {
+          var element = Survey.Serializer.createClass(elementJSON.type);
+          new Survey.JsonObject().toObject(elementJSON, element);
+          page.addElement(element);
+        });
+        if (fragment.description) page.description = fragment.description;
+        if (placeholder) page.removeElement(placeholder);
+        loadedPages[index] = true;
+      }
+
+      function showLoadError(index, error, delay) {
+        var page = survey.pages[index];
+        var placeholder = page.getQuestionByName(page.name + "-loading");
+        if (placeholder) {
+          placeholder.html = "Greška pri učitavanju stranice, novi pokušaj za " + Math.round(delay / 1000) + " s...";
+        }
+        console.error("Cannot load survey page " + index, error);
+      }
+
+      function loadPage(index) {
+        if (index < 0 || index >= survey.pages.length || loadedPages[index] || pageRequests[index]) return;
+        pageRequests[index] = getManifest()
+          .then(function (manifest) { return fetchJSON(manifest.pages[index].url); })
+          .then(function (fragment) {
+            fillPage(index, fragment);
+            delete failedAttempts[index];
+          })
+          .catch(function (error) {
+            // the page is requested again after a delay growing with failed attempts, up to half a minute
+            failedAttempts[index] = (failedAttempts[index] || 0) + 1;
+            var delay = Math.min(1000 * Math.pow(2, failedAttempts[index] - 1), 30000);
+            showLoadError(index, error, delay);
+            setTimeout(function () {
+              delete pageRequests[index];
+              loadPage(index);
+            }, delay);
+          });
+      }
+
+      function loadAround(page) {
+        var index = survey.pages.indexOf(page);
+        loadPage(index);
+        loadPage(index + 1);
+      }
+
+      survey.onCurrentPageChanging.add(function (sender, options) {
+        // the user cannot move forward from a page that is not loaded yet, so its questions are not skipped before
+        // they are shown, going back to pages visited before is always allowed
+        var oldIndex = sender.pages.indexOf(options.oldCurrentPage);
+        var newIndex = sender.pages.indexOf(options.newCurrentPage);
+        if (!loadedPages[oldIndex] && newIndex > oldIndex) {
+          options.allowChanging = false;
+          options.allow = false;
+          loadPage(oldIndex);
+        }
+      });
+      survey.onCurrentPageChanged.add(function (sender, options) {
+        loadAround(options.newCurrentPage);
+      });
+      loadAround(survey.currentPage);
+    </script>
+  """)
@@ -1,22 +1,33 @@
 import regex as re
 
+from contextlib import nullcontext
 from random import randint
 from pathlib import Path
 from string import Template
 
 from model.survey import *
 from model.question import *
-from utils.database import session
-from utils.logger import logger
-from utils.tools import fisher_yates_shuffle
+from utils.database import unit_of_work
+from utils.logger import get_logger, PER_ITEM
+from utils.tools import fisher_yates_shuffle, log_payload_reduction
+from utils.imaging import ImageOptimizer
+from generators.paged import PagedSurveyExport
+
+
+logger = get_logger(__name__)
 
 
 class SurveyGenerator:
 
-    supported_export_types = ["html", "json"]
+    supported_export_types = ["html", "json", "paged"]
 
-    def __init__(self, question_types, questions_per_survey, survey_type):
+    # how many times zoom images are larger than the displayed preview, sources are never upscaled
+    zoom_scale = 4
+
+    def __init__(self, question_types, questions_per_survey, survey_type, max_payload=None, max_duration=None):
         self.questions_per_survey = questions_per_survey
+        self.max_payload = max_payload
+        self.max_duration = max_duration
 
         if survey_type not in Survey.valid_types:
             logger.error(f"Survey type can be in {Survey.valid_types} but you require {survey_type}.")
@@ -38,44 +49,59 @@ class SurveyGenerator:
         generated survey. Otherwise, if `survey_type` is set to `control`, candidate questions are picked from those
         questions already assigned to existing regular surveys.
 
+        If `max_payload` (in bytes) or `max_duration` (in seconds) are set, a survey is also closed before reaching
+        `questions_per_survey` questions once the next questions would not fit into the estimated payload size or
+        expected completion time.
+
         :param n_surveys: Maximum number of survey that should be generated. If the requested number is larger then
             a possible number of surveys that can be generated, the method generate as many surveys as it can.
         :return:
         """
+        # payload sizes are computed once per question and reused for all generated surveys, only if they are limited
+        payload_sizes = None if self.max_payload is None else dict()
+
         while True:     # iterate while there are more questions to include in some of the surveys
-            if self.survey_type == "regular":
-                questions = Questions.get_unassigned()
-                survey = RegularSurvey(auth_page=False)
-            else:
-                questions = Questions.get_in_regular_survey()
-                survey = ControlSurvey(auth_page=False)
+            # each survey is generated in its own unit of work, so loaded questions are released once it is saved
+            with unit_of_work() as uow:
+                if self.survey_type == "regular":
+                    questions = Questions.get_unassigned(session=uow)
+                    survey = RegularSurvey(auth_page=False)
+                else:
+                    questions = Questions.get_in_regular_survey(session=uow)
+                    survey = ControlSurvey(auth_page=False)
 
-            if len(questions) == 0:     # all questions are already added to the survey
-                logger.info(f"There are no more unassigned questions satisfying the criteria for '{self.survey_type}' "
-                            f"in the database. Finishing.")
-                break
+                if len(questions) == 0:     # all questions are already added to the survey
+                    logger.info(f"There are no more unassigned questions satisfying the criteria for "
+                                f"'{self.survey_type}' in the database. Finishing.")
+                    break
 
-            # save a survey to database so that it is assigned valid id
-            session.add(survey)
-            session.commit()
-            shuffled_questions = fisher_yates_shuffle(questions)
+                # flush a survey to database so that it is assigned valid id
+                uow.add(survey)
+                uow.flush()
+                shuffled_questions = fisher_yates_shuffle(questions)
+                if payload_sizes is not None:
+                    payload_sizes.update(Questions.get_payload_sizes(
+                        [q for q in questions if q.id not in payload_sizes], session=uow))
+                selected_questions = Questions.select_within_budget(shuffled_questions, payload_sizes,
+                                                                    max_questions=self.questions_per_survey,
+                                                                    max_payload=self.max_payload,
+                                                                    max_duration=self.max_duration)
 
-            for i in range(0, min(self.questions_per_survey, len(shuffled_questions))):
-                question = shuffled_questions[i]
-                survey.questions.append(question)
-                logger.info(f"Added question {question.id} to survey {survey.id}.")
+                for question in selected_questions:
+                    survey.questions.append(question)
+                    logger.debug("Added question %s to survey %s.", question.id, survey.id, extra=PER_ITEM)
 
-            # warn if the survey is assigned less questions then requested
-            if len(survey.questions) != self.questions_per_survey:
-                logger.warning(f"Survey {survey.id} have {len(survey.questions)} questions instead of "
-                               f"{self.questions_per_survey}.")
+                # warn if the survey is assigned less questions then requested
+                if len(survey.questions) != self.questions_per_survey and \
+                        len(survey.questions) == len(shuffled_questions):
+                    logger.warning(f"Survey {survey.id} have {len(survey.questions)} questions instead of "
+                                   f"{self.questions_per_survey}.")
 
-            # generate survey json and update the survey in the database
-            survey.generate()
+                # generate survey json and update the survey in the database
+                survey.generate()
 
-            # replace survey id placeholders in questions associated to survey with the survey id
-            survey.json = re.sub("^_^", str(survey.id), survey.json)
-            session.commit()
+                # replace survey id placeholders in questions associated to survey with the survey id
+                survey.json = re.sub("^_^", str(survey.id), survey.json)
 
             # stop survey generation if required number of surveys is reached
             if n_surveys is not None:
@@ -84,12 +110,15 @@ class SurveyGenerator:
                     break
 
     @staticmethod
-    def export_surveys(where, export_type="json", survey_type="regular"):
+    def export_surveys(where, export_type="json", survey_type="regular", image_format=None, workers=None):
         """
 
         :param where:
         :param export_type:
         :param survey_type:
+        :param image_format: If set, survey images are downscaled to the dataset display size, encoded to this format
+            (`png` or `webp`) and saved to the `images` subdirectory of the export directory.
+        :param workers: Number of worker processes used for image optimization.
         :return:
         """
         # check if directory to export to is ok
@@ -109,38 +138,94 @@ class SurveyGenerator:
                              f"{SurveyGenerator.supported_export_types}")
 
         # export content
-        surveys = session.query(Survey).where(Survey.type == survey_type).all()
-        for survey in surveys:
-            if type(survey) == RegularSurvey:
-                prefix = "regular"
-            else:
-                prefix = "control"
-            if export_type == "json":
-                survey_filename = f"{prefix}-survey-{survey.id}.t1.json"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w") as fout:
-                    fout.write(survey.json)
-                    logger.info(f"Survey {survey_filename} saved!")
-            else:  # html
-                # $head - html head section
-                # $body - html body section
-                html = Template("""
+        surveys = Surveys.get_by_type(survey_type, with_images=image_format is not None)
+        optimizer = nullcontext() if image_format is None else \
+            ImageOptimizer(image_format=image_format, workers=workers)
+        with optimizer:
+            for survey in surveys:
+                if type(survey) == RegularSurvey:
+                    prefix = "regular"
+                else:
+                    prefix = "control"
+                survey_json = survey.json
+                if image_format is not None:
+                    survey_json = SurveyGenerator._optimize_survey_images(survey, where, optimizer)
+                if export_type == "json":
+                    survey_filename = f"{prefix}-survey-{survey.id}.t1.json"
+                    target_path = Path(where) / survey_filename
+                    with open(target_path, "w") as fout:
+                        fout.write(survey_json)
+                        logger.info("Survey %s saved!", survey_filename, extra=PER_ITEM)
+                elif export_type == "paged":
+                    PagedSurveyExport.export(survey_json, where, f"{prefix}-survey-{survey.id}.t1",
+                                             head=SurveyGenerator._generate_html_head_template(),
+                                             body_template=SurveyGenerator._genenerate_html_body_template())
+                else:  # html
+                    # $head - html head section
+                    # $body - html body section
+                    html = Template("""
 <html>
-                    $head
-                    $body
+                        $head
+                        $body
 </html>
-                """).substitute({
-                    "head": SurveyGenerator._generate_html_head_template(),
-                    "body": SurveyGenerator._genenerate_html_body_template().substitute({
-                        "survey_json": survey.json,
-                        "jqueryselector": "$"
+                    """).substitute({
+                        "head": SurveyGenerator._generate_html_head_template(),
+                        "body": SurveyGenerator._genenerate_html_body_template().substitute({
+                            "survey_json": survey_json,
+                            "jqueryselector": "$"
+                        })
                     })
-                })
-                survey_filename = f"{prefix}-survey-{survey.id}.t1.html"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w") as fout:
-                    fout.write(html)
-                    logger.info(f"Survey {survey_filename} saved!")
+                    survey_filename = f"{prefix}-survey-{survey.id}.t1.html"
+                    target_path = Path(where) / survey_filename
+                    with open(target_path, "w") as fout:
+                        fout.write(html)
+                        logger.info("Survey %s saved!", survey_filename, extra=PER_ITEM)
+
+    @staticmethod
+    def _optimize_survey_images(survey, where, optimizer):
+        """
+        Saves optimized versions of all images shown in the survey to the `images` subdirectory of the export directory
+        and points the survey json to them. Each image is saved as a preview downscaled to the display size and as a
+        higher resolution zoom image in `images/zoom` that is fetched only when the zoom lens is used.
+
+        :param survey: Survey whose images should be optimized.
+        :param where: Export directory.
+        :param optimizer: An ImageOptimizer instance.
+        :return: Survey json referencing optimized images.
+        """
+        images_dir = Path(where) / "images"
+        zoom_dir = images_dir / "zoom"
+        zoom_dir.mkdir(parents=True, exist_ok=True)
+
+        # images from the same dataset share display dimensions so they are optimized together
+        datasets = dict()
+        for question in survey.questions:
+            if isinstance(question, QuestionType1) and question.image is not None:
+                datasets.setdefault(question.image.dataset, []).append(question.image)
+
+        survey_json = survey.json
+        before, after = len(survey_json.encode("utf-8")), 0
+        for dataset, images in datasets.items():
+            width, height = Images.get_dataset_image_dims(dataset)
+            zoom_size = (width * SurveyGenerator.zoom_scale, height * SurveyGenerator.zoom_scale)
+            sources = [image.filepath for image in images]
+            previews = optimizer.optimize_all(sources, (width, height))
+            zooms = optimizer.optimize_all(sources, zoom_size)
+            for image, preview, zoom in zip(images, previews, zooms):
+                filename = image.name + optimizer.extension
+                (images_dir / filename).write_bytes(preview)
+                (zoom_dir / filename).write_bytes(zoom)
+                # the zoom image is referenced only when it is written, questions generated by older versions
+                # reference it in any case
+                survey_json = survey_json.replace(f" data-zoom='images/zoom/{image.filename}'", "")
+                survey_json = survey_json.replace(f"src='images/{image.filename}'",
+                                                  f"src='images/{filename}' data-zoom='images/zoom/{filename}'")
+                # zoom images are fetched only if the lens is used, so they are not counted towards the payload
+                before += image.filepath.stat().st_size
+                after += len(preview)
+        after += len(survey_json.encode("utf-8"))
+        log_payload_reduction(f"Survey {survey.id}", before, after)
+        return survey_json
 
     @staticmethod
     def _generate_html_head_template():
@@ -201,7 +286,7 @@ class SurveyGenerator:
          //PHP-SURVEY-DATA-REPLACE
       };
       function imageZoom(imgID, resultID) {
-        var img, lens, result, cx, cy;
+        var img, lens, result, cx, cy, zoomRequested;
         img = document.getElementById(imgID);
         result = document.getElementById(resultID);
         /*create lens:*/
@@ -213,8 +298,23 @@ class SurveyGenerator:
         cx = result.offsetWidth / lens.offsetWidth;
         cy = result.offsetHeight / lens.offsetHeight;
         /*set background properties for the result DIV:*/
-        result.style.backgroundImage = "url('" + img.src + "')";
         result.style.backgroundSize = (img.width * cx) + "px " + (img.height * cy) + "px";
+        /*the preview is shown until the high resolution zoom image is fetched, which happens only when the lens is
+        used for the first time:*/
+        zoomRequested = false;
+        function loadZoom() {
+          var zoomSrc, zoom;
+          if (zoomRequested) return;
+          zoomRequested = true;
+          result.style.backgroundImage = "url('" + img.src + "')";
+          zoomSrc = img.getAttribute("data-zoom");
+          if (!zoomSrc) return;
+          zoom = new Image();
+          zoom.onload = function () {
+            result.style.backgroundImage = "url('" + zoomSrc + "')";
+          };
+          zoom.src = zoomSrc;
+        }
         /*execute a function when someone moves the cursor over the image, or the lens:*/
         lens.addEventListener("mousemove", moveLens);
         img.addEventListener("mousemove", moveLens);
@@ -225,6 +325,7 @@ class SurveyGenerator:
           var pos, x, y;
           /*prevent any other actions that may occur when moving over the image:*/
           e.preventDefault();
+          loadZoom();
           /*get the cursor's x and y positions:*/
           pos = getCursorPos(e);
           /*calculate the position of the lens:*/
@@ -1,80 +1,105 @@
 import regex as re
 
+from contextlib import nullcontext
 from random import randint
 from pathlib import Path
 from string import Template
 
 from model.survey import *
 from model.question import *
-from utils.database import session
-from utils.logger import logger
-from utils.tools import fisher_yates_shuffle
+from utils.database import unit_of_work
+from utils.logger import get_logger, PER_ITEM
+from utils.tools import fisher_yates_shuffle, log_payload_reduction
+from utils.imaging import ImageOptimizer
+from generators.paged import PagedSurveyExport
+
+
+logger = get_logger(__name__)
 
 
 class SurveyGenerator:
 
-    supported_export_types = ["html", "json"]
+    supported_export_types = ["html", "json", "paged"]
+
+    def __init__(self, max_payload=None, max_duration=None):
+        self.max_payload = max_payload
+        self.max_duration = max_duration
 
     def generate_all(self, n_surveys=None):
         """
         Generates surveys and saves them to the database.
 
-        Surveys are generated by image group - each survey contain all questions generated for one image group.
+        Surveys are generated by image group - each survey contain all questions generated for one image group. If
+        `max_payload` (in bytes) or `max_duration` (in seconds) are set, questions of an image group that do not fit
+        into the estimated payload size or expected completion time are split into several surveys.
 
         :param n_surveys: Maximum number of survey that should be generated. If the requested number is larger then
             a possible number of surveys that can be generated, the method generate as many surveys as it can.
         :return:
         """
-        print("generator 2")
-
         current_image_group = Images.get_min_image_group()
         max_image_group = Images.get_max_image_group()
 
         # iterate while there are more question groups to include in the survey
         while current_image_group <= max_image_group:
 
-            questions = Questions.get_by_image_group(gid=current_image_group, unassigned=True)
-            # print(f">>> Dobavio pitanja za grupu {current_image_group}.")
-            if questions is None or len(questions) == 0:
-                logger.info(f"All questions assigned with group id {current_image_group} are already assigned to an "
-                            f"existing survey. Skipping.")
-                current_image_group += 1
-                continue
+            # surveys of an image group are generated in a unit of work, so its questions are released once they are
+            # saved
+            with unit_of_work() as uow:
+                questions = Questions.get_by_image_group(gid=current_image_group, unassigned=True, session=uow)
+                # print(f">>> Dobavio pitanja za grupu {current_image_group}.")
+                if questions is None or len(questions) == 0:
+                    logger.info(f"All questions assigned with group id {current_image_group} are already assigned to "
+                                f"an existing survey. Skipping.")
+                    current_image_group += 1
+                    continue
 
-            # save a survey to database so that it is assigned valid id
-            current_image_group += 1
-            survey = RegularSurvey(auth_page=False)
-            session.add(survey)
-            session.commit()
+                current_image_group += 1
+                questions = fisher_yates_shuffle(questions)
+                # payload sizes are computed only if they are limited
+                payload_sizes = None if self.max_payload is None else \
+                    Questions.get_payload_sizes(questions, session=uow)
 
-            questions = fisher_yates_shuffle(questions)
+                while len(questions) != 0:
+                    selected_questions = Questions.select_within_budget(questions, payload_sizes,
+                                                                        max_payload=self.max_payload,
+                                                                        max_duration=self.max_duration)
+                    selected_ids = set(question.id for question in selected_questions)
+                    questions = [question for question in questions if question.id not in selected_ids]
 
-            for i in range(0, len(questions)):
-                question = questions[i]
-                survey.questions.append(question)
-                logger.info(f"Added question {question.id} to survey {survey.id}.")
+                    # flush a survey to database so that it is assigned valid id
+                    survey = RegularSurvey(auth_page=False)
+                    uow.add(survey)
+                    uow.flush()
 
-            # generate survey json and update the survey in the database
-            survey.generate()
+                    for question in selected_questions:
+                        survey.questions.append(question)
+                        logger.debug("Added question %s to survey %s.", question.id, survey.id, extra=PER_ITEM)
 
-            # replace survey id placeholders in questions associated to survey with the survey id
-            survey.json.replace("^_^", str(survey.id))
+                    # generate survey json and update the survey in the database
+                    survey.generate()
 
-            session.commit()
+                    # replace survey id placeholders in questions associated to survey with the survey id
+                    survey.json.replace("^_^", str(survey.id))
+                    uow.flush()
 
-            # stop survey generation if required number of surveys is reached
-            if n_surveys is not None:
-                n_surveys -= 1
-                if n_surveys == 0:
-                    break
+                    # stop survey generation if required number of surveys is reached, the unit of work is committed
+                    # when the block is left
+                    if n_surveys is not None:
+                        n_surveys -= 1
+                        if n_surveys == 0:
+                            return
 
     @staticmethod
-    def export_surveys(where, export_type="json", survey_type="regular"):
+    def export_surveys(where, export_type="json", survey_type="regular", image_format=None, workers=None):
         """
 
         :param where:
         :param export_type:
         :param survey_type:
+        :param image_format: If set, images inlined into the survey are downscaled to the dataset display size and
+            encoded to this format (`png` or `webp`).
+        :param workers: Number of worker processes used for image optimization.
         :return:
         """
         # check if directory to export to is ok
@@ -94,42 +119,72 @@ class SurveyGenerator:
                              f"{SurveyGenerator.supported_export_types}")
 
         # export content
-        surveys = session.query(Survey).where(Survey.type == survey_type).all()
+        surveys = Surveys.get_by_type(survey_type, with_images=image_format is not None)
         if len(surveys) == 0:
             logger.warning(f"There are no surveys in a database to be exported. Skipping.")
             exit(1)
 
-        for survey in surveys:
-            if type(survey) == RegularSurvey:
-                prefix = "regular"
-            else:
-                prefix = "control"
-            if export_type == "json":
-                survey_filename = f"{prefix}-survey-{survey.id}.t2.json"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w") as fout:
-                    fout.write(survey.json)
-                    logger.info(f"Survey {survey_filename} saved!")
-            else:  # html
-                # $head - html head section
-                # $body - html body section
-                html = Template("""
+        optimizer = nullcontext() if image_format is None else \
+            ImageOptimizer(image_format=image_format, workers=workers)
+        with optimizer:
+            for survey in surveys:
+                if type(survey) == RegularSurvey:
+                    prefix = "regular"
+                else:
+                    prefix = "control"
+                survey_json = survey.json
+                if image_format is not None:
+                    survey_json = SurveyGenerator._optimize_survey_images(survey, optimizer)
+                if export_type == "json":
+                    survey_filename = f"{prefix}-survey-{survey.id}.t2.json"
+                    target_path = Path(where) / survey_filename
+                    with open(target_path, "w") as fout:
+                        fout.write(survey_json)
+                        logger.info("Survey %s saved!", survey_filename, extra=PER_ITEM)
+                elif export_type == "paged":
+                    PagedSurveyExport.export(survey_json, where, f"{prefix}-survey-{survey.id}.t2",
+                                             head=SurveyGenerator._generate_html_head_template(),
+                                             body_template=SurveyGenerator._genenerate_html_body_template())
+                else:  # html
+                    # $head - html head section
+                    # $body - html body section
+                    html = Template("""
 <html>
-                    $head
-                    $body
+                        $head
+                        $body
 </html>
-                """).substitute({
-                    "head": SurveyGenerator._generate_html_head_template(),
-                    "body": SurveyGenerator._genenerate_html_body_template().substitute({
-                        "survey_json": survey.json,
-                        "jqueryselector": "$"
+                    """).substitute({
+                        "head": SurveyGenerator._generate_html_head_template(),
+                        "body": SurveyGenerator._genenerate_html_body_template().substitute({
+                            "survey_json": survey_json,
+                            "jqueryselector": "$"
+                        })
                     })
-                })
-                survey_filename = f"{prefix}-survey-{survey.id}.t2.html"
-                target_path = Path(where) / survey_filename
-                with open(target_path, "w") as fout:
-                    fout.write(html)
-                    logger.info(f"Survey {survey_filename} saved!")
+                    survey_filename = f"{prefix}-survey-{survey.id}.t2.html"
+                    target_path = Path(where) / survey_filename
+                    with open(target_path, "w") as fout:
+                        fout.write(html)
+                        logger.info("Survey %s saved!", survey_filename, extra=PER_ITEM)
+
+    @staticmethod
+    def _optimize_survey_images(survey, optimizer):
+        """
+        Replaces images inlined into the survey json with their optimized versions.
+
+        :param survey: Survey whose images should be optimized.
+        :param optimizer: An ImageOptimizer instance.
+        :return: Survey json with optimized inline images.
+        """
+        images = [image for question in survey.questions if isinstance(question, QuestionType2)
+                  for image in question.images]
+        if len(images) == 0:
+            return survey.json
+
+        # all questions in a survey are generated from a single image group so they share the dataset
+        size = Images.get_dataset_image_dims(images[0].dataset)
+        survey_json = optimizer.optimize_data_uris(survey.json, size)
+        log_payload_reduction(f"Survey {survey.id}", len(survey.json.encode("utf-8")), len(survey_json.encode("utf-8")))
+        return survey_json
 
     @staticmethod
     def _generate_html_head_template():
@@ -1,17 +1,22 @@
-from sqlalchemy import Column, Integer, ForeignKey, PrimaryKeyConstraint, ForeignKeyConstraint, Boolean
+from sqlalchemy import Column, Integer, ForeignKey, PrimaryKeyConstraint, ForeignKeyConstraint, Boolean, select, \
+    union, and_, func
 from sqlalchemy.orm import relationship
 
 from utils.database import Base, session
-from utils.logger import logger
+from utils.logger import get_logger
+from model.image import Image, image_qtype2
 from model.question import *
 
 
+logger = get_logger(__name__)
+
+
 class Answer(Base):
     __tablename__ = "answer"
 
     question_id     = Column(Integer, ForeignKey('question.id'))
-    user_id         = Column(Integer, ForeignKey('user.id'))
-    surveyresult_id = Column(Integer, ForeignKey('survey_result.id'))
+    user_id         = Column(Integer, ForeignKey('user.id'), index=True)
+    surveyresult_id = Column(Integer, ForeignKey('survey_result.id'), index=True)
     type            = Column(Integer)
     valid_types     = Question.valid_types
 
@@ -105,6 +110,83 @@ class AnswerType1(Answer):
         )
 
 
+class AnswerType2(Answer):
+    """
+    An answer to a type 2 question, i.e. which of the two segmentation maps shown in the question the user picked as
+    better. Only ids of the picked (winner) and the other (loser) image are stored, so pairwise comparisons can be
+    imported and analysed in bulk.
+    """
+    __tablename__ = "atype2"
+    __mapper_args__ = {
+        'polymorphic_identity': 2
+    }
+
+    question_id = Column(Integer)
+    user_id     = Column(Integer)
+    winner_id   = Column(Integer, ForeignKey('image.id'), nullable=False)
+    loser_id    = Column(Integer, ForeignKey('image.id'), nullable=False)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('question_id', 'user_id'),
+        ForeignKeyConstraint(
+            columns=("question_id", "user_id"),
+            refcolumns=("answer.question_id", "answer.user_id")
+        ), {}
+    )
+
+    winner = relationship("Image", foreign_keys=[winner_id])
+    loser  = relationship("Image", foreign_keys=[loser_id])
+
+    def __init__(self, user, question_id, winner_id, loser_id):
+        self.question_id = question_id
+        self.winner_id = winner_id
+        self.loser_id = loser_id
+        self.user = user
+        self.user_id = user.id
+
+    def __repr__(self):
+        return "<Answer (question_id: '{}', answered by user: '{}', type: '{}', winner image: '{}', loser image: " \
+               "'{}')>".format(
+                self.question_id,
+                self.user_id,
+                self.type,
+                self.winner_id,
+                self.loser_id
+        )
+
+
+class ControlAnswer(Base):
+    """
+    An answer to a type 1 question given in a control survey. Control surveys repeat questions from regular surveys,
+    so storing these answers in `answer` would replace the answer the same user gave in the regular survey. They are
+    kept separately to measure how consistent a user is with their own earlier answers.
+    """
+    __tablename__ = "control_answer"
+
+    question_id     = Column(Integer, ForeignKey('question.id'))
+    user_id         = Column(Integer, ForeignKey('user.id'), index=True)
+    surveyresult_id = Column(Integer, ForeignKey('survey_result.id'), index=True)
+    disease_id      = Column(Integer, ForeignKey('disease.id'))
+    certainty       = Column(Integer, nullable=False)
+    invalid         = Column(Boolean)
+
+    __table_args__ = (
+        PrimaryKeyConstraint('question_id', 'user_id'), {}
+    )
+
+    question = relationship("Question")
+    disease  = relationship("Disease")
+    user     = relationship("User")
+
+    def __repr__(self):
+        return "<ControlAnswer (question_id: '{}', answered by user: '{}', disease: '{}', certainty: '{}')>".format(
+            self.question_id,
+            self.user_id,
+            self.disease_id,
+            self.certainty
+        )
+
+
 class Answers:
 
     @staticmethod
@@ -117,18 +199,110 @@ class Answers:
         finally:
             session.commit()
 
+    # maximal number of ids passed to a single IN clause, sqlite limits the number of query parameters
+    chunk_size = 500
+
+    @staticmethod
+    def _select_answers():
+        """
+        Select statement returning answers as plain rows, with columns of both type 1 and type 2 answers. Columns of
+        the other answer type are None.
+        """
+        answer, atype1, atype2 = Answer.__table__, AnswerType1.__table__, AnswerType2.__table__
+        return select(
+            answer.c.question_id, answer.c.user_id, answer.c.surveyresult_id, answer.c.type,
+            atype1.c.disease_id, atype1.c.certainty, atype1.c.invalid,
+            atype2.c.winner_id, atype2.c.loser_id
+        ).select_from(
+            answer
+            .outerjoin(atype1, and_(atype1.c.question_id == answer.c.question_id, atype1.c.user_id == answer.c.user_id))
+            .outerjoin(atype2, and_(atype2.c.question_id == answer.c.question_id, atype2.c.user_id == answer.c.user_id))
+        )
+
+    @staticmethod
+    def _get_ids(objects):
+        """
+        Normalizes a single object or id, or a list of objects or ids, to a list of ids.
+        """
+        if isinstance(objects, (list, tuple, set)):
+            return [getattr(obj, "id", obj) for obj in objects]
+        return [getattr(objects, "id", objects)]
+
+    @staticmethod
+    def _query_in_chunks(column, ids, statement=None):
+        if statement is None:
+            statement = Answers._select_answers()
+        rows = list()
+        for i in range(0, len(ids), Answers.chunk_size):
+            rows.extend(session.execute(statement.where(column.in_(ids[i:i + Answers.chunk_size]))).all())
+        return rows
+
     @staticmethod
     def get_answers_for_question(question):
-        raise NotImplementedError
+        """
+        Returns answers to the given questions as lightweight rows with columns question_id, user_id, surveyresult_id,
+        type, disease_id, certainty, invalid, winner_id and loser_id.
+
+        :param question: A question or question id, or a list of questions or question ids.
+        :return: A list of rows.
+        """
+        return Answers._query_in_chunks(Answer.__table__.c.question_id, Answers._get_ids(question))
 
     @staticmethod
     def get_answers_for_user(user):
-        raise NotImplementedError
+        """
+        Returns answers given by the users, see `get_answers_for_question` for returned columns.
+
+        :param user: A user or user id, or a list of users or user ids.
+        :return: A list of rows.
+        """
+        return Answers._query_in_chunks(Answer.__table__.c.user_id, Answers._get_ids(user))
+
+    @staticmethod
+    def get_answers_for_survey_result(survey_result):
+        """
+        Returns answers from the survey results, see `get_answers_for_question` for returned columns.
+
+        :param survey_result: A survey result or survey result id, or a list of survey results or their ids.
+        :return: A list of rows.
+        """
+        return Answers._query_in_chunks(Answer.__table__.c.surveyresult_id, Answers._get_ids(survey_result))
 
     @staticmethod
     def get_answers_for_image(image):
-        raise NotImplementedError
+        """
+        Returns answers to all questions showing the images, i.e. type 1 questions for the image and type 2 questions
+        where the image is one of the compared ones, see `get_answers_for_question` for returned columns. Every answer
+        is returned once, even if the question shows several of the images.
+
+        :param image: An image or image id, or a list of images or image ids.
+        :return: A list of rows.
+        """
+        image_ids = Answers._get_ids(image)
+        image_table = Image.__table__
+        question_ids = set()
+        for i in range(0, len(image_ids), Answers.chunk_size):
+            chunk = image_ids[i:i + Answers.chunk_size]
+            question_ids.update(session.execute(union(
+                select(QuestionType1.__table__.c.id).where(QuestionType1.__table__.c.image_id.in_(chunk)),
+                # type 2 questions show the original of the compared segmentation maps as well, it is not compared
+                select(image_qtype2.c.question_id)
+                .join(image_table, image_table.c.id == image_qtype2.c.image_id)
+                .where(image_qtype2.c.image_id.in_(chunk), func.coalesce(image_table.c.type, "") != "original")
+            )).scalars())
+        return Answers._query_in_chunks(Answer.__table__.c.question_id, sorted(question_ids))
 
     @staticmethod
     def get_answer(user, question):
-        raise NotImplementedError
+        """
+        Returns an answer of the user to the question, see `get_answers_for_question` for returned columns.
+
+        :param user: A user or user id.
+        :param question: A question or question id.
+        :return: A row or None if the user did not answer the question.
+        """
+        answer = Answer.__table__
+        return session.execute(
+            Answers._select_answers().where(and_(answer.c.user_id == getattr(user, "id", user),
+                                                 answer.c.question_id == getattr(question, "id", question)))
+        ).first()
@@ -0,0 +1,246 @@
+from datetime import datetime
+from sqlalchemy import Column, Integer, Float, DateTime, ForeignKey, select, update, case, tuple_
+from sqlalchemy.orm import relationship
+
+from utils.database import Base, get_session, upsert
+from utils.logger import get_logger
+from model.answer import AnswerType1, AnswerType2, ControlAnswer
+from model.question import QuestionType2
+
+
+logger = get_logger(__name__)
+
+
+# counters of the `rater_consistency` table that are maintained by adding the changes of every imported batch
+COUNTER_COLUMNS = ["t1_repeated", "t1_consistent", "t1_certainty_diff_sum", "t2_repeated", "t2_consistent",
+                   "t2_triads", "t2_intransitive"]
+
+
+class RaterConsistency(Base):
+    """
+    Per rater consistency counters. Type 1 counters compare answers from regular surveys with answers to the same
+    questions repeated in control surveys. Type 2 counters compare picks on image pairs shown more than once, and count
+    intransitive triads (a > b, b > c, c > a) in the rater's majority preferences within an image group.
+    `t1_certainty_diff` is the mean absolute certainty difference of the repeated type 1 answers, kept next to the sum
+    it is derived from.
+    """
+    __tablename__ = "rater_consistency"
+
+    user_id               = Column(Integer, ForeignKey("user.id"), primary_key=True)
+    t1_repeated           = Column(Integer, nullable=False, default=0)
+    t1_consistent         = Column(Integer, nullable=False, default=0)
+    t1_certainty_diff     = Column(Float)
+    t1_certainty_diff_sum = Column(Float, nullable=False, default=0)
+    t2_repeated           = Column(Integer, nullable=False, default=0)
+    t2_consistent         = Column(Integer, nullable=False, default=0)
+    t2_triads             = Column(Integer, nullable=False, default=0)
+    t2_intransitive       = Column(Integer, nullable=False, default=0)
+    updated_at            = Column(DateTime, nullable=False)
+
+    user = relationship("User")
+
+
+class ConsistencyCounters:
+    """
+    Maintains the `rater_consistency` table during result import. Like `Stats.apply`, a batch only adds the change of
+    the counters it causes: type 1 counters are compared per answer, and type 2 counters are recounted only in the
+    image groups the batch answers to, so the cost does not grow with the history of a rater. See
+    `analysis.consistency.Consistency` for recomputing the counters from all answers and for reports.
+    """
+
+    # maximal number of answer keys or rater image groups in a single query
+    chunk_size = 500
+
+    @staticmethod
+    def apply(user_ids, answers_t1, control_answers, answers_t2, session=None):
+        """
+        Adds changes of the consistency counters caused by a batch of answers. Must be called within the batch
+        transaction before the answers are written, while the answers they replace are still stored.
+
+        :param user_ids: Ids of the raters of the batch, a row is kept for each of them even if nothing changed.
+        :param answers_t1: Type 1 answers from regular surveys, dictionaries with keys question_id, user_id,
+            disease_id, invalid and certainty.
+        :param control_answers: Type 1 answers from control surveys in the same form.
+        :param answers_t2: Type 2 answers, dictionaries with keys question_id, user_id, winner_id and loser_id.
+        :param session: Session to use, the application session by default.
+        :return: None
+        """
+        session = get_session(session)
+        deltas = {user_id: dict.fromkeys(COUNTER_COLUMNS, 0) for user_id in user_ids}
+        ConsistencyCounters._add_type1(deltas, answers_t1, control_answers, session)
+        ConsistencyCounters._add_type2(deltas, answers_t2, session)
+
+        now = datetime.now()
+        rows = [dict(user_id=user_id, updated_at=now, **counters) for user_id, counters in deltas.items()]
+        upsert(RaterConsistency.__table__, rows, index_elements=["user_id"], update_columns=COUNTER_COLUMNS,
+               accumulate=True, session=session)
+        ConsistencyCounters.update_means(list(deltas), now, session)
+
+    @staticmethod
+    def update_means(user_ids, updated_at, session=None):
+        """
+        Derives `t1_certainty_diff` of the raters from the accumulated sum and marks their counters as updated.
+
+        :param user_ids: A list of rater ids.
+        :param updated_at: Time of the update.
+        :param session: Session to use, the application session by default.
+        :return: None
+        """
+        session = get_session(session)
+        table = RaterConsistency.__table__
+        for i in range(0, len(user_ids), ConsistencyCounters.chunk_size):
+            session.execute(
+                update(table).where(table.c.user_id.in_(user_ids[i:i + ConsistencyCounters.chunk_size])).values(
+                    t1_certainty_diff=case((table.c.t1_repeated > 0,
+                                            table.c.t1_certainty_diff_sum / table.c.t1_repeated), else_=None),
+                    updated_at=updated_at
+                )
+            )
+
+    @staticmethod
+    def compare_type1(answer, control_answer):
+        """
+        Compares a regular and a control survey answer of a rater to the same question.
+
+        :return: A dictionary with the type 1 counters of the pair.
+        """
+        consistent = (answer["disease_id"] if answer["disease_id"] is not None else -1,
+                      bool(answer["invalid"])) == \
+                     (control_answer["disease_id"] if control_answer["disease_id"] is not None else -1,
+                      bool(control_answer["invalid"]))
+        certainty_diff = 0 if answer["certainty"] is None or control_answer["certainty"] is None \
+            else abs(answer["certainty"] - control_answer["certainty"])
+        return {"t1_repeated": 1, "t1_consistent": int(consistent), "t1_certainty_diff_sum": certainty_diff}
+
+    @staticmethod
+    def _load_type1(model, keys, session):
+        columns = select(model.question_id, model.user_id, model.disease_id, model.invalid, model.certainty)
+        stored = dict()
+        for i in range(0, len(keys), ConsistencyCounters.chunk_size):
+            rows = session.execute(columns.where(
+                tuple_(model.question_id, model.user_id).in_(keys[i:i + ConsistencyCounters.chunk_size])
+            )).all()
+            stored.update({(row.question_id, row.user_id): row._asdict() for row in rows})
+        return stored
+
+    @staticmethod
+    def _add_type1(deltas, answers_t1, control_answers, session):
+        """
+        Adds changes of type 1 counters for every question a rater answered in the batch: the comparison with the
+        stored answers is subtracted and the comparison with the answers after the batch is added.
+        """
+        new_answers = {(row["question_id"], row["user_id"]): row for row in answers_t1}
+        new_control = {(row["question_id"], row["user_id"]): row for row in control_answers}
+        keys = sorted(set(new_answers) | set(new_control))
+        if len(keys) == 0:
+            return
+        old_answers = ConsistencyCounters._load_type1(AnswerType1, keys, session)
+        old_control = ConsistencyCounters._load_type1(ControlAnswer, keys, session)
+        for key in keys:
+            for sign, answer, control_answer in (
+                    (-1, old_answers.get(key), old_control.get(key)),
+                    (1, new_answers.get(key, old_answers.get(key)), new_control.get(key, old_control.get(key)))):
+                if answer is None or control_answer is None:
+                    continue
+                counters = deltas.setdefault(key[1], dict.fromkeys(COUNTER_COLUMNS, 0))
+                for column, value in ConsistencyCounters.compare_type1(answer, control_answer).items():
+                    counters[column] += sign * value
+
+    @staticmethod
+    def _add_type2(deltas, answers_t2, session):
+        """
+        Adds changes of type 2 counters: the counters of every rater image group the batch answers to are counted from
+        the stored answers and from the answers after the batch, and their difference is added.
+        """
+        new_answers = {(row["question_id"], row["user_id"]): row for row in answers_t2}
+        if len(new_answers) == 0:
+            return
+        question_ids = sorted({question_id for question_id, _ in new_answers})
+        groups = dict()
+        for i in range(0, len(question_ids), ConsistencyCounters.chunk_size):
+            groups.update(session.execute(
+                select(QuestionType2.id, QuestionType2.group)
+                .where(QuestionType2.id.in_(question_ids[i:i + ConsistencyCounters.chunk_size]))
+            ).all())
+
+        blocks = sorted({(user_id, groups.get(question_id)) for question_id, user_id in new_answers})
+        old_answers = dict()
+        for i in range(0, len(blocks), ConsistencyCounters.chunk_size):
+            rows = session.execute(
+                select(AnswerType2.question_id, AnswerType2.user_id, QuestionType2.group, AnswerType2.winner_id,
+                       AnswerType2.loser_id)
+                .join(QuestionType2, QuestionType2.id == AnswerType2.question_id)
+                .where(tuple_(AnswerType2.user_id, QuestionType2.group).in_(
+                    blocks[i:i + ConsistencyCounters.chunk_size]))
+            ).all()
+            old_answers.update({(row.question_id, row.user_id): (row.user_id, row.group, row.winner_id, row.loser_id)
+                                for row in rows})
+        answers = dict(old_answers)
+        answers.update({key: (row["user_id"], groups.get(key[0]), row["winner_id"], row["loser_id"])
+                        for key, row in new_answers.items()})
+
+        for sign, rows in ((-1, old_answers.values()), (1, answers.values())):
+            for row in ConsistencyCounters.count_type2(list(rows)):
+                counters = deltas.setdefault(row["user_id"], dict.fromkeys(COUNTER_COLUMNS, 0))
+                for column in ["t2_repeated", "t2_consistent", "t2_triads", "t2_intransitive"]:
+                    counters[column] += sign * row[column]
+
+    @staticmethod
+    def count_type2(rows):
+        """
+        Computes repeated pair agreement and intransitive triads of raters with array operations over their type 2
+        answers.
+
+        :param rows: A list of (user id, image group, winner id, loser id) tuples.
+        :return: A list of dictionaries with user_id and the type 2 counters, one per rater.
+        """
+        if len(rows) == 0:
+            return []
+        # imported here because every database command registers this module's table, but few compute counters
+        import numpy as np
+
+        users, groups, winners, losers = zip(*rows)
+        users, winners, losers = (np.array(column, dtype=np.int64) for column in (users, winners, losers))
+        groups = np.array([-1 if group is None else group for group in groups], dtype=np.int64)
+        first, second = np.minimum(winners, losers), np.maximum(winners, losers)
+        rater_users, user_index = np.unique(users, return_inverse=True)
+
+        # answers of a rater on the same image pair, regardless of the order the images were shown in
+        pairs, pair_index = np.unique(np.stack([user_index, groups, first, second], axis=1), axis=0,
+                                      return_inverse=True)
+        pair_index = pair_index.ravel()
+        shown = np.bincount(pair_index)
+        first_wins = np.bincount(pair_index, weights=(winners == first).astype(float))
+        second_wins = shown - first_wins
+        repeated = np.bincount(pairs[:, 0], weights=shown * (shown - 1) / 2, minlength=len(rater_users))
+        consistent = np.bincount(pairs[:, 0], minlength=len(rater_users),
+                                 weights=(first_wins * (first_wins - 1) + second_wins * (second_wins - 1)) / 2)
+
+        # majority preferences of every rater within every image group as a stack of adjacency matrices, a directed
+        # 3-cycle in a matrix A is an intransitive triad and their number is trace(A^3) / 3
+        blocks, block_index = np.unique(pairs[:, :2], axis=0, return_inverse=True)
+        block_index = block_index.ravel()
+        # images are numbered from zero within their group
+        n_images = int(pairs[:, 2:].max()) + 1
+        keys = np.unique(np.concatenate([pairs[:, 1] * n_images + pairs[:, 2], pairs[:, 1] * n_images + pairs[:, 3]]))
+        key_groups = keys // n_images
+        key_local = np.arange(len(keys)) - np.searchsorted(key_groups, key_groups, side="left")
+        first_local = key_local[np.searchsorted(keys, pairs[:, 1] * n_images + pairs[:, 2])]
+        second_local = key_local[np.searchsorted(keys, pairs[:, 1] * n_images + pairs[:, 3])]
+        size = int(key_local.max()) + 1
+
+        preferences = np.zeros((len(blocks), size, size))
+        compared = np.zeros((len(blocks), size, size))
+        compared[block_index, first_local, second_local] = 1
+        compared[block_index, second_local, first_local] = 1
+        preferences[block_index, first_local, second_local] = first_wins > second_wins
+        preferences[block_index, second_local, first_local] = second_wins > first_wins
+        cycles = np.einsum("bii->b", preferences @ preferences @ preferences) / 3
+        triads = np.einsum("bii->b", compared @ compared @ compared) / 6
+        intransitive = np.bincount(blocks[:, 0], weights=cycles, minlength=len(rater_users))
+        all_triads = np.bincount(blocks[:, 0], weights=triads, minlength=len(rater_users))
+
+        return [{"user_id": int(user_id), "t2_repeated": int(round(repeated[i])),
+                 "t2_consistent": int(round(consistent[i])), "t2_triads": int(round(all_triads[i])),
+                 "t2_intransitive": int(round(intransitive[i]))}
+                for i, user_id in enumerate(rater_users)]
@@ -1,13 +1,16 @@
-from utils.database import Base, session
-from utils.logger import logger
+from utils.database import Base, get_session, commit
+from utils.logger import get_logger
 
 from sqlalchemy import Column, Integer, String, ForeignKey, Table
 from sqlalchemy.orm import relationship
 
 
+logger = get_logger(__name__)
+
+
 association_table = Table('image_disease', Base.metadata,
-                          Column("image_id", Integer, ForeignKey("image.id")),
-                          Column("disease_id", Integer, ForeignKey("disease.id")))
+                          Column("image_id", Integer, ForeignKey("image.id"), index=True),
+                          Column("disease_id", Integer, ForeignKey("disease.id"), index=True))
 
 
 class Disease(Base):
@@ -37,7 +40,8 @@ class Disease(Base):
 class Diseases:
 
     @staticmethod
-    def insert(name, token):
+    def insert(name, token, session=None):
+        session = get_session(session)
         results = session.query(Disease).where(Disease.token == token).all()
         if results is None or len(results) == 0:
             d = Disease(token=token, name=name)
@@ -46,7 +50,7 @@ class Diseases:
             except:
                 session.rollback()
             finally:
-                session.commit()
+                commit(session)
                 return d
         else:
             logger.warning(f"Disease with a name {token} already exists in a database. A duplicate will not be "
@@ -54,10 +58,12 @@ class Diseases:
             return results[0]
 
     @staticmethod
-    def get_by_token(token):
+    def get_by_token(token, session=None):
+        session = get_session(session)
         return session.query(Disease).where(Disease.token == token).one()
 
     @staticmethod
-    def get_all():
+    def get_all(session=None):
+        session = get_session(session)
         return session.query(Disease).all()
 
@@ -6,14 +6,18 @@ from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.hybrid import hybrid_property
 from pathlib import Path
 
-from utils.database import Base, session
+from utils.database import Base, get_session, commit
 from model.disease import Disease, Diseases, association_table, ForeignKey
-from utils.logger import logger
+from utils.logger import get_logger
+from utils.profiling import stage
+
+
+logger = get_logger(__name__)
 
 
 image_qtype2 = Table('image_qtype2', Base.metadata,
-                          Column("image_id", Integer, ForeignKey("image.id")),
-                          Column("question_id", Integer, ForeignKey("qtype2.id")))
+                          Column("image_id", Integer, ForeignKey("image.id"), index=True),
+                          Column("question_id", Integer, ForeignKey("qtype2.id"), index=True))
 
 
 class Image(Base):
@@ -22,8 +26,8 @@ class Image(Base):
     root      = Column(String, nullable=False)
     filename  = Column(String(50), nullable=False, unique=True)
     dataset   = Column(String, nullable=False)
-    group_id  = Column(Integer, nullable=True)
-    type      = Column(String, nullable=True)
+    group_id  = Column(Integer, nullable=True, index=True)
+    type      = Column(String, nullable=True, index=True)
 
     questions    = relationship("QuestionType1", back_populates="image")
     questions_t2 = relationship("QuestionType2", secondary=image_qtype2, back_populates="images")
@@ -36,6 +40,13 @@ class Image(Base):
         """
         return self.filename[:self.filename.rfind('.')]
 
+    @property
+    def filepath(self):
+        """
+        Full path to the image file on disk.
+        """
+        return Path(self.root) / self.dataset / self.filename
+
     def __init__(self, filepath, gid=None):
         # filepath treba da izgleda:
         #     /neka/putanja/do/npr/DRIVE/000123.png ili
@@ -80,68 +91,78 @@ class Images:
             raise ValueError(f"Cannot find dimension for the images in dataset. Unknown dataset {dataset}.")
 
     @staticmethod
-    def insert(image):
+    def insert(image, session=None):
+        session = get_session(session)
         try:
             session.add(image)
         except:
             session.rollback()
             raise
         else:
-            session.commit()
+            commit(session)
 
     @staticmethod
-    def bulk_insert(images):
+    def bulk_insert(images, session=None):
+        session = get_session(session)
         try:
             [session.add(image) for image in images]
         except:
             session.rollback()
             raise
         else:
-            session.commit()
+            commit(session)
 
     @staticmethod
-    def update(image):
+    def update(image, session=None):
+        session = get_session(session)
         try:
             session.merge(image)
         except:
             session.rollback()
             raise
         else:
-            session.commit()
+            commit(session)
 
     @staticmethod
     def delete(image):
         raise NotImplementedError
 
     @staticmethod
-    def get_all():
+    def get_all(session=None):
+        session = get_session(session)
         return session.query(Image).all()
 
     @staticmethod
-    def get_max_image_group():
+    def get_max_image_group(session=None):
         """
         Get maximum group ID based on images already in a database. If none of the images
         have an associated ID, zero is returned.
 
+        :param session: Session to use, the application session by default.
+
         :return: Maximal image group ID associated with images inserted into the database.
         """
+        session = get_session(session)
         max_group_id = session.query(func.max(Image.group_id)).scalar()
         if max_group_id is None:
             max_group_id = 0
         return max_group_id
 
     @staticmethod
-    def get_min_image_group():
+    def get_min_image_group(session=None):
         """
         Get minimum group ID based on images already in a database. If none of the images have an
         associated ID, None is returned.
 
+        :param session: Session to use, the application session by default.
+
         :return: Minimal image group ID associated with images inserted into the database.
         """
+        session = get_session(session)
         return session.query(func.min(Image.group_id)).scalar()
 
     @staticmethod
-    def load_images(directory, extensions):
+    def load_images(directory, extensions, session=None):
         """
         Loads images with specific file extensions from a given directory. For each image
         an object of Image class is created and added to the `images` collection. If the
@@ -150,8 +171,10 @@ class Images:
         :param directory: Path of str object pointing to the directory containing images.
         :param extensions: A list of valid image extensions with dot, e.g. [".png", ".jpg"].
             Extension list is case insensitive.
+        :param session: Session to use, the application session by default.
         :return:
         """
+        session = get_session(session)
         if type(directory) is not Path:
             directory = Path(directory)
 
@@ -165,11 +188,12 @@ class Images:
         logger.info(f"Image extensions to be loaded {extensions}.")
         logger.info(f"Loading images from {directory}...")
 
-        img_paths = Path(directory).glob("*")
-        if extensions is not None or len(extensions) != 0:
-            images = [Image(img_path) for img_path in img_paths if img_path.suffix.lower() in extensions]
-        else:
-            images = [Image(img_path) for img_path in img_paths]
+        with stage("read images"):
+            img_paths = Path(directory).glob("*")
+            if extensions is not None or len(extensions) != 0:
+                images = [Image(img_path) for img_path in img_paths if img_path.suffix.lower() in extensions]
+            else:
+                images = [Image(img_path) for img_path in img_paths]
         logger.info(f"Loaded {len(images)} images.")
 
         if len(images) != 0:
@@ -179,14 +203,16 @@ class Images:
                 logger.warning(f"Metadata file {metadata_file} not found or is not a file! Skipping image metadata "
                                f"loading.")
             else:
-                Images._load_image_metadata(images=images, metadata_filepath=metadata_file)
+                with stage("load image metadata"):
+                    Images._load_image_metadata(images=images, metadata_filepath=metadata_file, session=session)
                 logger.info(f"Successfully loaded image metadata.")
 
-        Images.bulk_insert(images)      # add new images to database
+        with stage("insert images"):
+            Images.bulk_insert(images, session=session)      # add new images to database
         logger.info(f"Inserted {len(images)} images into the database.")
 
     @staticmethod
-    def _load_image_metadata(images, metadata_filepath):
+    def _load_image_metadata(images, metadata_filepath, session=None):
         """
         Load image metadata from a metadata file.
 
@@ -200,62 +226,108 @@ class Images:
 
         :param images: Images for which to load metadata.
         :param metadata_filepath: Relative or absolute path to the metadata file.
+        :param session: Session to use, the application session by default.
         :return: None
         """
+        session = get_session(session)
 
         with open(metadata_filepath, "r") as metf:
             metadata = json.load(metf)
 
+        # group ids in the metadata are offset by the largest group id of images already in the database
+        max_image_group = Images.get_max_image_group(session=session)
+        diseases_by_token = dict()
+
+        # an image matches every metadata name its name contains, candidates are looked up in an index of name
+        # trigrams instead of comparing every metadata name with every image
+        name_index = Images._index_image_names(images)
+
         for image_metadata in metadata:
-            for image in images:
+            for image in Images._match_image_name(image_metadata["image_name"], images, name_index):
                 image_diseases = list()
-                if image_metadata["image_name"] in image.name:
-                    # process disease data
-                    try:
-                        diseases = image_metadata["diseases"]
-                        if diseases is not None and len(diseases) != 0:
-                            for disease in diseases:
-                                d = Diseases.insert(name=disease["name"], token=disease["token"])
-                                image_diseases.append(d)
-                            image.diseases = image_diseases
-                    except KeyError:
-                        image.diseases = None
-
-                    # process image group data if it exist
-                    try:
-                        group_id = int(image_metadata["group"])
-                        if group_id is not None:   # image doesn't necessarily belong to any group
-                            image.group_id = group_id + Images.get_max_image_group()
-                    except KeyError:
-                        image.group_id = None
-
-                    # get image type if exists for the image
-                    try:
-                        type = image_metadata["type"]
-                        if type is not None:        # image type can be unknown
-                            image.type = type
-                    except KeyError:
-                        image.type = None
+                # process disease data
+                try:
+                    diseases = image_metadata["diseases"]
+                    if diseases is not None and len(diseases) != 0:
+                        for disease in diseases:
+                            if disease["token"] not in diseases_by_token:
+                                diseases_by_token[disease["token"]] = Diseases.insert(
+                                    name=disease["name"], token=disease["token"], session=session)
+                            image_diseases.append(diseases_by_token[disease["token"]])
+                        image.diseases = image_diseases
+                except KeyError:
+                    image.diseases = None
+
+                # process image group data if it exist
+                try:
+                    group_id = int(image_metadata["group"])
+                    if group_id is not None:   # image doesn't necessarily belong to any group
+                        image.group_id = group_id + max_image_group
+                except KeyError:
+                    image.group_id = None
+
+                # get image type if exists for the image
+                try:
+                    type = image_metadata["type"]
+                    if type is not None:        # image type can be unknown
+                        image.type = type
+                except KeyError:
+                    image.type = None
+
+    @staticmethod
+    def _index_image_names(images):
+        """
+        Indexes images by the trigrams of their names, see `_match_image_name`.
+
+        :param images: A list of images.
+        :return: A dictionary mapping a trigram to a list of positions of images whose name contains it.
+        """
+        name_index = dict()
+        for position, image in enumerate(images):
+            for trigram in {image.name[i:i + 3] for i in range(len(image.name) - 2)}:
+                name_index.setdefault(trigram, list()).append(position)
+        return name_index
+
+    @staticmethod
+    def _match_image_name(name, images, name_index):
+        """
+        Returns images whose name contains a full or partial image name from a metadata file, in the order of
+        `images`. Only images containing the least common trigram of the name are compared with it, names shorter than
+        three characters are compared with every image.
+
+        :param name: Full or partial image name.
+        :param images: A list of images.
+        :param name_index: Index of the image names, see `_index_image_names`.
+        :return: A list of images.
+        """
+        if len(name) < 3:
+            return [image for image in images if name in image.name]
+        candidates = min((name_index.get(name[i:i + 3], []) for i in range(len(name) - 2)), key=len)
+        return [images[position] for position in candidates if name in images[position].name]
 
     @staticmethod
-    def get_whole_group(gid):
+    def get_whole_group(gid, session=None):
         """
 
         :param gid:
+        :param session: Session to use, the application session by default.
         :return:
         """
+        session = get_session(session)
         images = session.query(Image).where(Image.group_id == gid).all()
         if len(images) == 0:
             return None
         return images
 
     @staticmethod
-    def get_by_name(image_filenames):
+    def get_by_name(image_filenames, session=None):
         """
 
         :param image_filenames:
+        :param session: Session to use, the application session by default.
         :return:
         """
+        session = get_session(session)
         logger.info(f"Load from database images with names {image_filenames}.")
         filters = []
         for filename in image_filenames:
@@ -263,7 +335,7 @@ class Images:
         return session.query(Image).filter(*filters).all()
 
     @staticmethod
-    def get_original_for_segmap(segmap):
+    def get_original_for_segmap(segmap, session=None):
         """
         Searches for the original color image in a database for a corresponding segmentation mask. It is assumed that
         the segmentaion mask is named similar to the pattern: <number>-<network>-<dataset>.<extension> and that the
@@ -271,8 +343,10 @@ class Images:
 
         :param segmap: An instance of Image class representing a segmentation map with filename similar to
             <number>-<network>-<dataset>.
+        :param session: Session to use, the application session by default.
         :return:
         """
+        session = get_session(session)
         assert segmap is not None
         filename = segmap.filename.split('-')[0]    # for segmentation mask filename like <number>-<network>-<dataset>
                                                     # extracts <number> and uses it to query for the original image of
@@ -4,35 +4,44 @@ import itertools
 
 from datetime import datetime
 from pathlib import Path
-from sqlalchemy import Column, Integer, DateTime, Text, ForeignKey
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, DateTime, ForeignKey, select
+from sqlalchemy.orm import relationship, deferred, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy import and_
 from string import Template
 
-from utils.database import Base, session
-from utils.logger import logger
+from utils.database import Base, get_session, commit
+from utils.compression import CompressedText
+from utils.logger import get_logger, PER_ITEM
+from utils.profiling import stage
 from utils.tools import minify_json, fisher_yates_shuffle
 from model.image import Images
 from model.disease import Diseases
 
 
+logger = get_logger(__name__)
+
+
 class Question(Base):
     __tablename__ = "question"
 
     id          = Column(Integer, primary_key=True, autoincrement=True)
-    type        = Column(Integer)
-    json        = Column(Text)
+    type        = Column(Integer, index=True)
+    json        = deferred(Column(CompressedText))
     created_at  = Column(DateTime, nullable=False)
 
     valid_types = [1, 2, 3]
 
+    # rough estimate of how many seconds it takes to answer a question
+    expected_duration = 20
+
     __mapper_args__ = {
         'polymorphic_identity': 0,
         'polymorphic_on': type,
     }
 
-    regular_survey_id = Column(Integer, ForeignKey("regular_survey.id"))
-    control_survey_id = Column(Integer, ForeignKey("control_survey.id"))
+    regular_survey_id = Column(Integer, ForeignKey("regular_survey.id"), index=True)
+    control_survey_id = Column(Integer, ForeignKey("control_survey.id"), index=True)
 
     regular_survey = relationship("RegularSurvey", back_populates="questions")
     control_survey = relationship("ControlSurvey", back_populates="questions")
@@ -52,13 +61,15 @@ class Question(Base):
 
 class QuestionType1(Question):
     __tablename__   = "qtype1"
-    __mapper_args__ = {'polymorphic_identity': 1}
+    __mapper_args__ = {'polymorphic_identity': 1, 'polymorphic_load': 'selectin'}
 
     id       = Column(Integer, ForeignKey("question.id"), primary_key=True)
-    image_id = Column(Integer, ForeignKey("image.id"))
+    image_id = Column(Integer, ForeignKey("image.id"), index=True)
 
     image = relationship("Image", back_populates="questions")
 
+    expected_duration = 30
+
     def __repr__(self):
         return super().__repr__() + \
             "\n<QuestionType1 (image id: '{}', image name: '{}')>".format(
@@ -66,14 +77,22 @@ class QuestionType1(Question):
             "None" if self.image is None else self.image.filename
         )
 
-    def generate(self):
+    def generate(self, diseases=None, session=None):
+        """
+        Generates the question json.
+
+        :param diseases: Diseases offered as answers, all diseases from the database if None. Should be passed when
+            generating many questions, so the diseases are not queried for every question.
+        :param session: Session to query the diseases with, the application session by default.
+        :return: None
+        """
         if self.image is not None:
             question_json = QuestionType1._get_question_template().substitute({
                 "quid": self.id,
                 "imid": self.image.id,
                 "imname": self.image.name,
                 "imfname": self.image.filename,
-                "questions": QuestionType1._get_questions()
+                "questions": QuestionType1._get_questions(diseases, session=session)
             })
             self.json = minify_json(question_json)
         else:
@@ -81,8 +100,9 @@ class QuestionType1(Question):
             raise ValueError(f"Cannot generate question {self.id} because it does not have associated image.")
 
     @staticmethod
-    def _get_questions():
-        diseases = Diseases.get_all()
+    def _get_questions(diseases=None, session=None):
+        if diseases is None:
+            diseases = Diseases.get_all(session=session)
         questions_json = ""
         for i, disease in enumerate(diseases):
             template = Template("""
@@ -111,12 +131,15 @@ class QuestionType1(Question):
         # $imname - ime slike koja se prikazuje, mora da se nalazi u images direktorijumu
         # $imfname - puno ime slike sa ekstenzijom
         # $questions - izgenerisani json za bolesti na slici
+        # slika za zumiranje (data-zoom) se dodaje tek pri izvozu optimizovanih slika, inace se zumira prikazana slika
         template = Template("""
         elements: [
             {
                 type: "html",
                 name: "s^_^-q$quid-img",
-                html: "<div class='img-zoom-container'><div style='width: 500px; float: left'><img onload=\\"imageZoom('$imname', '$imname-zoom')\\" id='$imname' src='images/$imfname' style='width: 100%'/></div>
+                html: "<div class='img-zoom-container'><div style='width: 500px; float: left'>
+                       <img onload=\\"imageZoom('$imname',
+                       '$imname-zoom')\\" id='$imname' src='images/$imfname' style='width: 100%'/></div>
                        <div id='$imname-zoom' class='img-zoom-result'></div></div>"
             },
             {
@@ -149,12 +172,14 @@ class QuestionType1(Question):
 
 class QuestionType2(Question):
     __tablename__ = "qtype2"
-    __mapper_args__ = {'polymorphic_identity': 2}
+    __mapper_args__ = {'polymorphic_identity': 2, 'polymorphic_load': 'selectin'}
 
     id      = Column(Integer, ForeignKey("question.id"), primary_key=True)
-    group   = Column(Integer)
+    group   = Column(Integer, index=True)
     images  = relationship("Image", secondary="image_qtype2", back_populates="questions_t2")
 
+    expected_duration = 10
+
     def __init__(self, gid):
         super(QuestionType2, self).__init__()
         self.group = gid
@@ -258,7 +283,7 @@ class QuestionType2(Question):
 
 class QuestionType3(Question):
     __tablename__ = "qtype3"
-    __mapper_args__ = {'polymorphic_identity': 3}
+    __mapper_args__ = {'polymorphic_identity': 3, 'polymorphic_load': 'selectin'}
 
     id = Column(Integer, ForeignKey("question.id"), primary_key=True)
 
@@ -282,14 +307,15 @@ class Questions:
         raise NotImplementedError
 
     @staticmethod
-    def bulk_insert(questions):
+    def bulk_insert(questions, session=None):
+        session = get_session(session)
         try:
             [session.add(q) for q in questions]
         except:
             session.rollback()
             raise
         else:
-            session.commit()
+            commit(session)
 
     @staticmethod
     def update(question):
@@ -300,23 +326,27 @@ class Questions:
         raise NotImplementedError
 
     @staticmethod
-    def get_all():
+    def get_all(session=None):
+        session = get_session(session)
         return session.query(Question).all()
 
     @staticmethod
-    def get_by_type(type):
+    def get_by_type(type, session=None):
         """
         Query a database for all questions of specific type.
 
         :param type: An integer in interval [0-3].
+        :param session: Session to use, the application session by default.
         :return: A list of Question objects.
         """
+        session = get_session(session)
         if type not in [0, 1, 2, 3]:
             raise ValueError("Question type must be one of [0, 1, 2, 3]. Given type is {0}".format(type))
         return session.query(Question).where(Question.type == type).all()
 
     @staticmethod
-    def get_by_id(qid):
+    def get_by_id(qid, session=None):
+        session = get_session(session)
         return session.query(Question).get(qid)
 
     @staticmethod
@@ -328,13 +358,15 @@ class Questions:
         raise NotImplementedError
 
     @staticmethod
-    def get_unassigned(types=None):
+    def get_unassigned(types=None, session=None):
         """
         Returns all questions of specific types that are not assigned to any regular or control survey.
 
         :param types: Valid question types.
+        :param session: Session to use, the application session by default.
         :return: List of questions not assigned to any survey
         """
+        session = get_session(session)
         if types is not None:
             filters = [Question.type == type for type in types]
         else:
@@ -342,16 +374,20 @@ class Questions:
         return session.query(Question)\
                       .where(and_(Question.regular_survey == None, Question.control_survey == None))\
                       .filter(*filters)\
+                      .options(selectinload(QuestionType1.image))\
                       .all()
 
     @staticmethod
-    def get_in_regular_survey(types=None):
+    def get_in_regular_survey(types=None, session=None):
         """
-        Returns all questions of specific types that are assigned to any of regular surveys and are not assigned to any of control surveys.
+        Returns all questions of specific types that are assigned to any of regular surveys and are not assigned to any
+        of control surveys.
 
         :param types: Valid question types.
+        :param session: Session to use, the application session by default.
         :return: List of questions assigned only to regular surveys.
         """
+        session = get_session(session)
         if types is not None:
             filters = [Question.type == type for type in types]
         else:
@@ -359,20 +395,108 @@ class Questions:
         return session.query(Question)\
                       .where(and_(Question.regular_survey != None, Question.control_survey == None))\
                       .filter(*filters)\
+                      .options(selectinload(QuestionType1.image))\
                       .all()
 
+    # maximal number of question jsons loaded at once when estimating payload sizes
+    chunk_size = 100
+
+    @staticmethod
+    def load_json(questions, session=None):
+        """
+        Loads deferred jsons of the questions in chunks, instead of a query per question when the jsons are accessed,
+        e.g. before the questions are rendered into a survey.
+
+        :param questions: A list of questions.
+        :param session: Session the questions belong to, the application session by default.
+        :return: None
+        """
+        session = get_session(session)
+        questions = {question.id: question for question in questions if "json" not in question.__dict__}
+        question_ids = list(questions)
+        for i in range(0, len(question_ids), Questions.chunk_size):
+            chunk = question_ids[i:i + Questions.chunk_size]
+            for question_id, question_json in session.execute(
+                    select(Question.id, Question.json).where(Question.id.in_(chunk))):
+                set_committed_value(questions[question_id], "json", question_json)
+
+    @staticmethod
+    def get_payload_sizes(questions, session=None):
+        """
+        Estimates how many bytes a browser downloads to show each of the questions. Type 2 questions inline their images
+        into the question json, while type 1 questions link to an image file that is downloaded separately.
+
+        Question jsons are deferred, they are loaded in chunks only to be measured and are not kept on the questions.
+
+        :param questions: A list of questions.
+        :param session: Session to use, the application session by default.
+        :return: A dictionary mapping question id to the estimated payload size in bytes.
+        """
+        session = get_session(session)
+        question_ids = [question.id for question in questions]
+        json_sizes = dict()
+        for i in range(0, len(question_ids), Questions.chunk_size):
+            chunk = question_ids[i:i + Questions.chunk_size]
+            for question_id, question_json in session.execute(
+                    select(Question.id, Question.json).where(Question.id.in_(chunk))):
+                json_sizes[question_id] = 0 if question_json is None else len(question_json.encode("utf-8"))
+
+        sizes = dict()
+        for question in questions:
+            size = json_sizes.get(question.id, 0)
+            if isinstance(question, QuestionType1) and question.image is not None:
+                try:
+                    size += question.image.filepath.stat().st_size
+                except FileNotFoundError:
+                    logger.warning(f"Cannot find image {question.image.filepath} of question {question.id}. Its size "
+                                   f"will not be counted towards the question payload.")
+            sizes[question.id] = size
+        return sizes
+
     @staticmethod
-    def get_by_image_group(gid, unassigned=True):
+    def select_within_budget(questions, payload_sizes, max_questions=None, max_payload=None, max_duration=None):
+        """
+        Picks questions in the given order as long as they fit into all of the given limits. Questions that would
+        exceed a limit are skipped in favour of the smaller ones that follow. At least one question is always picked,
+        even if it alone exceeds the limits.
+
+        :param questions: Candidate questions, in the order of preference.
+        :param payload_sizes: A dictionary mapping question id to the payload size in bytes, see `get_payload_sizes`.
+            Not used and may be None if `max_payload` is not given.
+        :param max_questions: Maximum number of picked questions.
+        :param max_payload: Maximum total payload size of picked questions in bytes.
+        :param max_duration: Maximum total expected time in seconds to answer the picked questions.
+        :return: A list of picked questions.
+        """
+        selected = list()
+        total_payload, total_duration = 0, 0
+        for question in questions:
+            if max_questions is not None and len(selected) >= max_questions:
+                break
+            payload = 0 if max_payload is None else payload_sizes[question.id]
+            fits = (max_payload is None or total_payload + payload <= max_payload) and \
+                   (max_duration is None or total_duration + question.expected_duration <= max_duration)
+            if fits or len(selected) == 0:
+                selected.append(question)
+                total_payload += payload
+                total_duration += question.expected_duration
+        return selected
+
+    @staticmethod
+    def get_by_image_group(gid, unassigned=True, session=None):
+        session = get_session(session)
         if unassigned:
             # return all questions of the same group that are not already attached to some of the surveys
-            questions = session.query(QuestionType2).where(QuestionType2.group == gid).all()
-            return [q for q in questions if q.regular_survey is None]
+            return session.query(QuestionType2)\
+                          .where(and_(QuestionType2.group == gid, QuestionType2.regular_survey_id == None))\
+                          .all()
         else:
             # return all questions of the same group
             return session.query(QuestionType2).where(QuestionType2.group == gid).all()
 
     @staticmethod
-    def generate_questions_t2(gid, image_group, n_repeat, redundancy=50, n_redundancy=1, flip_images=True):
+    def generate_questions_t2(gid, image_group, n_repeat, redundancy=50, n_redundancy=1, flip_images=True,
+                              session=None):
         """
 
         :param gid:
@@ -380,8 +504,10 @@ class Questions:
         :param n_repeat:
         :param redundancy: Should be in percentages. How many questions will be repeated to create redundancy. It should
             be between 0 and 100.
+        :param session: Session to use, the application session by default.
         :return:
         """
+        session = get_session(session)
 
         # generate all combinations of images in a group
         # it will be total of 28 image pairs for a group of 8 images
@@ -396,7 +522,8 @@ class Questions:
         iindices = random.sample(range(0, len(image_group)), (redundancy * len(image_group)) // 100)
         for idx in iindices:
             dupes.append(image_group[idx])
-            print(f"Added duplicate image pair ({image_group[idx][0].id}, {image_group[idx][1].id}).")
+            logger.debug("Added duplicate image pair (%s, %s).", image_group[idx][0].id, image_group[idx][1].id,
+                         extra=PER_ITEM)
 
         # replicate duplicates n_redundancy times
         dupes = dupes * n_redundancy
@@ -407,7 +534,7 @@ class Questions:
 
         # get original image for a segmentation mask group
         # the original should be the last image in an array
-        original = Images.get_original_for_segmap(image_group[0][0])
+        original = Images.get_original_for_segmap(image_group[0][0], session=session)
 
         # create questions and assign them to the images
         questions = list()
@@ -415,7 +542,7 @@ class Questions:
             q = QuestionType2(gid=gid)
             q.images.extend([im1, im2, original])
             questions.append(q)
-            print(f"Question {i} is associated with images {im1.id} and {im2.id}.")
+            logger.debug("Question %s is associated with images %s and %s.", i, im1.id, im2.id, extra=PER_ITEM)
 
         return questions
 
@@ -481,7 +608,7 @@ class Questions:
                       f"img2_id: {question.images[1].id}")
 
     @staticmethod
-    def generate(question_types, n_repeat, image_names=None):
+    def generate(question_types, n_repeat, image_names=None, session=None):
         """
         Generate questions of a given type for a given set of images. If set of images
         is specified, it must be provided as a list of image filenames. If not specified
@@ -496,8 +623,10 @@ class Questions:
             repeated when generating questions.
         :param image_names: A list of string representing image filenames with extension. Filenames
             are case sensitive.
+        :param session: Session to use, the application session by default.
         :return: A list of generated questions.
         """
+        session = get_session(session)
         logger.info(f"Generating questions of types {question_types}.")
         for qtype in question_types:
             qtype = int(qtype)
@@ -508,45 +637,53 @@ class Questions:
         questions = list()
         for qtype in question_types:
             qtype = int(qtype)
-            if qtype == 1:
-                if image_names is None:
-                    images = Images.get_all()
-                else:
-                    images = Images.get_by_name(image_names)
-                logger.info(f"Loaded {len(images)} images for question generation.")
-
-                for image in images:
-                    qt = QuestionType1()
-                    qt.image = image
-                    questions.append(qt)
-            elif qtype == 2:
-                min_group_id = Images.get_min_image_group()
-                if min_group_id is None:
-                    logger.error(f"Skipping question generation because there are no groups associated with the "
-                                 f"images.")
-                    raise ValueError(logger.error(f"Skipping question generation because there are no groups associated"
-                                                  f" with the images."))
-
-                max_group_id = Images.get_max_image_group()
-                for gid in range(min_group_id, max_group_id+1):
-                    image_group = Images.get_whole_group(gid)
-                    if image_group is None:
-                        logger.error(f"There are no images associated with a group {gid}. Aborting.")
-                        raise ValueError(f"There are no images associated with a group {gid}. Aborting.")
-                    qt = Questions.generate_questions_t2(gid, image_group, n_repeat)
-                    questions.extend(qt)
-            elif qtype == 3:
-                raise NotImplementedError
+            with stage(f"create type {qtype} questions"):
+                if qtype == 1:
+                    if image_names is None:
+                        images = Images.get_all(session=session)
+                    else:
+                        images = Images.get_by_name(image_names, session=session)
+                    logger.info(f"Loaded {len(images)} images for question generation.")
+
+                    for image in images:
+                        qt = QuestionType1()
+                        qt.image = image
+                        questions.append(qt)
+                elif qtype == 2:
+                    min_group_id = Images.get_min_image_group(session=session)
+                    if min_group_id is None:
+                        logger.error(f"Skipping question generation because there are no groups associated with the "
+                                     f"images.")
+                        raise ValueError(logger.error(f"Skipping question generation because there are no groups "
+                                                      f"associated with the images."))
+
+                    max_group_id = Images.get_max_image_group(session=session)
+                    for gid in range(min_group_id, max_group_id+1):
+                        image_group = Images.get_whole_group(gid, session=session)
+                        if image_group is None:
+                            logger.error(f"There are no images associated with a group {gid}. Aborting.")
+                            raise ValueError(f"There are no images associated with a group {gid}. Aborting.")
+                        qt = Questions.generate_questions_t2(gid, image_group, n_repeat, session=session)
+                        questions.extend(qt)
+                elif qtype == 3:
+                    raise NotImplementedError
 
         logger.info(f"Generated {len(questions)} questions.")
-        Questions.bulk_insert(questions)
+        with stage("insert questions"):
+            Questions.bulk_insert(questions, session=session)
         logger.debug(f"Inserted {len(questions)} questions to the database.")
 
         # this step must come after the questions are inserted into the database because generation required question id
-        [question.generate() for question in questions]
+        with stage("generate question json"):
+            diseases = Diseases.get_all(session=session)
+            for question in questions:
+                if isinstance(question, QuestionType1):
+                    question.generate(diseases=diseases, session=session)
+                else:
+                    question.generate()
 
-        # update the database to reflect changes in json field
-        session.commit()
+            # update the database to reflect changes in json field
+            commit(session)
 
         return questions
 
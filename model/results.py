@@ -0,0 +1,635 @@
+import hashlib
+import itertools
+import json
+import time
+import regex as re
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, insert, select, update
+
+from utils.database import Base, get_session, unit_of_work, upsert, copy_rows, init_worker
+from utils.logger import get_logger, PER_ITEM
+from utils.profiling import stage
+from utils.tools import iter_json_array
+from model.answer import Answer, AnswerType1, AnswerType2, ControlAnswer
+from model.consistency import ConsistencyCounters
+from model.disease import Disease
+from model.image import image_qtype2
+from model.question import Question, QuestionType1
+from model.survey import Survey, ControlSurvey, SurveyResult
+from model.stats import Stats
+from model.user import User
+
+
+logger = get_logger(__name__)
+
+
+# matches question identifiers like s<survey id>-q<question id>-choice and s<survey id>-q<question id>-certainty
+TYPE1_KEY_RE = re.compile(r"s(\d+)-q(\d+)-(choice|certainty)", re.ASCII)
+
+# matches type 2 question identifiers like s<survey id>-q<question id>-im<image id>-im<image id>-impicker
+TYPE2_KEY_RE = re.compile(r"s(\d+)-q(\d+)-im(\d+)-im(\d+)-impicker", re.ASCII)
+
+# matches picked image values like im<image id>
+TYPE2_VALUE_RE = re.compile(r"im(\d+)", re.ASCII)
+
+
+class ResultImport(Base):
+    """
+    Import journal entry for a survey result file. A file is identified by the hash of its content, so renamed or
+    moved files are recognized as well. `finished_at` is set once all results from the file are applied.
+    """
+    __tablename__ = "result_import"
+
+    id          = Column(Integer, primary_key=True, autoincrement=True)
+    file_hash   = Column(String(64), nullable=False, unique=True)
+    filename    = Column(String, nullable=False)
+    n_results   = Column(Integer)
+    started_at  = Column(DateTime, nullable=False)
+    finished_at = Column(DateTime)
+
+
+class ResultImportEntry(Base):
+    """
+    Import journal entry for a single result from the `Data` array of a result file. A result is identified by the
+    hash of its content, so the same result is applied only once, even if it is found in several files.
+    """
+    __tablename__ = "result_import_entry"
+
+    entry_hash      = Column(String(40), primary_key=True)
+    import_id       = Column(Integer, ForeignKey("result_import.id"))
+    surveyresult_id = Column(Integer, ForeignKey("survey_result.id"))
+
+
+class SurveyResultWriter:
+    """
+    Writes parsed survey results to the database using bulk inserts.
+
+    Users, questions, surveys and diseases referenced by the results are looked up in maps that are loaded once when
+    the writer is created, so importing a result does not query the database per answer. Survey results and answers
+    are collected in memory and inserted in bulk every `batch_size` results, each batch in a single transaction. If
+    `batch_size` is None, everything is committed in a single transaction by `flush`.
+
+    Answers are upserted, so an answer of a user to a question that is already in the database is replaced. Type 1
+    answers from control surveys are written to `control_answer`, so they do not replace the regular survey answers
+    they are compared with. Consistency counters of the users in a batch (see ConsistencyCounters) and the summary
+    tables (see Stats) are updated in the batch transaction with the changes the batch causes. Applied results and
+    files are recorded in the import journal (see ResultImport and ResultImportEntry) and results that were already
+    applied are skipped, so an interrupted import can be resumed by importing the same files again.
+
+    Every batch and journal update is written in its own unit of work, so nothing stays in a session between batches.
+    """
+
+    def __init__(self, batch_size=None):
+        self.batch_size = batch_size
+        with unit_of_work() as uow:
+            self.user_ids = set(uow.execute(select(User.id)).scalars())
+            self.survey_ids = set(uow.execute(select(Survey.id)).scalars())
+            self.control_survey_ids = set(uow.execute(select(ControlSurvey.id)).scalars())
+            self.question_types = dict(uow.execute(select(Question.id, Question.type)).all())
+            self.question_image_ids = dict(uow.execute(select(QuestionType1.id, QuestionType1.image_id)).all())
+            self.question_images = dict()
+            for question_id, image_id in uow.execute(select(image_qtype2.c.question_id, image_qtype2.c.image_id)):
+                self.question_images.setdefault(question_id, set()).add(image_id)
+            self.disease_ids = dict(uow.execute(select(Disease.token, Disease.id)).all())
+            self.applied_entries = set(uow.execute(select(ResultImportEntry.entry_hash)).scalars())
+
+        self.n_results = 0
+        self.n_answers = 0
+        self.n_skipped = 0
+        self._import_id = None
+        self._n_file_results = 0
+        self._pending_results = 0
+        # pending state when the current file was started and changes of the pending answers made since then, so
+        # pending results of the file can be dropped, see `discard_file`
+        self._file_start = (0, 0)
+        self._file_changes = list()
+        self._survey_results = list()
+        self._entries = list()
+        self._answers = dict()
+        self._answers_t1 = dict()
+        self._answers_t2 = dict()
+        self._control_answers = dict()
+
+    @staticmethod
+    def get_file_hash(survey_json_filepath):
+        sha256 = hashlib.sha256()
+        with open(survey_json_filepath, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def is_imported(file_hash, session=None):
+        """
+        Checks the import journal whether all results from a file with the given hash were already applied.
+        """
+        session = get_session(session)
+        return session.execute(
+            select(ResultImport.id).where(ResultImport.file_hash == file_hash, ResultImport.finished_at != None)
+        ).first() is not None
+
+    def start_file(self, survey_json_filepath, file_hash=None):
+        """
+        Records in the import journal that results from the file are being imported. Results added until
+        `finish_file` is called are journaled as coming from this file.
+
+        :param survey_json_filepath: A path to the survey result json file.
+        :param file_hash: Hash of the file content, computed if not given.
+        :return: None
+        """
+        if file_hash is None:
+            file_hash = SurveyResultWriter.get_file_hash(survey_json_filepath)
+        with unit_of_work() as uow:
+            upsert(ResultImport.__table__,
+                   [{"file_hash": file_hash, "filename": str(survey_json_filepath), "started_at": datetime.now()}],
+                   index_elements=["file_hash"], update_columns=["filename", "started_at"], session=uow)
+            self._import_id = uow.execute(
+                select(ResultImport.id).where(ResultImport.file_hash == file_hash)
+            ).scalar_one()
+        self._n_file_results = 0
+        self._file_start = (self._pending_results, len(self._survey_results))
+        self._file_changes = list()
+
+    def finish_file(self):
+        """
+        Writes all pending results and marks the current file as imported in the import journal.
+
+        :return: None
+        """
+        self.flush()
+        with unit_of_work() as uow:
+            uow.execute(
+                update(ResultImport.__table__)
+                .where(ResultImport.id == self._import_id)
+                .values(finished_at=datetime.now(), n_results=self._n_file_results)
+            )
+        self._import_id = None
+
+    def discard_file(self):
+        """
+        Drops pending results of the current file, e.g. after one of them is rejected, so they are not written by the
+        next `flush`. Results of the file already written by an earlier flush stay in the database, and the file is
+        not marked as imported, so it is imported again with the next import of the same file.
+
+        :return: None
+        """
+        pending_results, n_survey_results = self._file_start
+        for answers, key, previous in reversed(self._file_changes):
+            if previous is None:
+                del answers[key]
+            else:
+                answers[key] = previous
+        self.applied_entries.difference_update(entry["entry_hash"] for entry in self._entries[n_survey_results:])
+        del self._survey_results[n_survey_results:]
+        del self._entries[n_survey_results:]
+        self._pending_results = pending_results
+        self._file_changes = list()
+        self._import_id = None
+
+    def add(self, result):
+        """
+        Adds a result parsed by `SurveyResults.parse_result` to the current batch and writes the batch to the database
+        if it is full. A result referring to a user, survey, question, image or disease that does not exist is
+        rejected with a ValueError and leaves the batch unchanged.
+
+        :param result: A parsed survey result.
+        :return: None
+        """
+        self._add(result)
+        self._pending_results += 1
+        if self.batch_size is not None and self._pending_results >= self.batch_size:
+            self.flush()
+
+    def _add(self, result):
+        if result["entry_hash"] in self.applied_entries:
+            if self._import_id is not None:
+                self._n_file_results += 1
+            self.n_skipped += 1
+            return
+
+        # the whole result is validated before the batch is changed, so a rejected result leaves nothing behind
+        user_id, survey_id = result["user_id"], result["survey_id"]
+        if user_id not in self.user_ids:
+            logger.error("User with id '{}' does not exist.".format(user_id))
+            raise ValueError("User with id '{}' does not exist.".format(user_id))
+        if survey_id not in self.survey_ids:
+            logger.error("Survey with id '{}' does not exist.".format(survey_id))
+            raise ValueError("Survey with id '{}' does not exist.".format(survey_id))
+        diseases = dict()
+        for question_id, answer in result["answers"].items():
+            if question_id not in self.question_types:
+                logger.error(f"Question with id '{question_id}' does not exist.")
+                raise ValueError(f"Question with id '{question_id}' does not exist.")
+            diseases[question_id] = self._get_disease(answer["choice"])
+        for question_id, (winner_id, loser_id) in result.get("pairs", {}).items():
+            if self.question_types.get(question_id) != 2:
+                logger.error(f"Question with id '{question_id}' does not exist or is not a type 2 question.")
+                raise ValueError(f"Question with id '{question_id}' does not exist or is not a type 2 question.")
+            if not {winner_id, loser_id} <= self.question_images.get(question_id, set()):
+                logger.error(f"Images {winner_id} and {loser_id} are not shown in question {question_id}.")
+                raise ValueError(f"Images {winner_id} and {loser_id} are not shown in question {question_id}.")
+
+        if self._import_id is not None:
+            self._n_file_results += 1
+        # survey results are inserted in bulk by `flush`, until then answers refer to their position in the batch
+        survey_result_id = len(self._survey_results)
+        self._survey_results.append({"survey_id": survey_id, "user_id": user_id})
+        self._entries.append({
+            "entry_hash": result["entry_hash"],
+            "import_id": self._import_id,
+            "surveyresult_id": survey_result_id
+        })
+        self.applied_entries.add(result["entry_hash"])
+
+        for question_id, answer in result["answers"].items():
+            disease_id, invalid = diseases[question_id]
+            if survey_id in self.control_survey_ids:
+                self._set_pending(self._control_answers, (question_id, user_id), {
+                    "question_id": question_id,
+                    "user_id": user_id,
+                    "surveyresult_id": survey_result_id,
+                    "disease_id": disease_id,
+                    "certainty": answer["certainty"],
+                    "invalid": invalid
+                })
+                continue
+            # answers are keyed by the primary key, so only the last answer of a user to a question is written
+            self._set_pending(self._answers, (question_id, user_id), {
+                "question_id": question_id,
+                "user_id": user_id,
+                "surveyresult_id": survey_result_id,
+                "type": 1
+            })
+            self._set_pending(self._answers_t1, (question_id, user_id), {
+                "question_id": question_id,
+                "user_id": user_id,
+                "disease_id": disease_id,
+                "certainty": answer["certainty"],
+                "invalid": invalid
+            })
+
+        for question_id, (winner_id, loser_id) in result.get("pairs", {}).items():
+            self._set_pending(self._answers, (question_id, user_id), {
+                "question_id": question_id,
+                "user_id": user_id,
+                "surveyresult_id": survey_result_id,
+                "type": 2
+            })
+            self._set_pending(self._answers_t2, (question_id, user_id), {
+                "question_id": question_id,
+                "user_id": user_id,
+                "winner_id": winner_id,
+                "loser_id": loser_id
+            })
+
+    def _set_pending(self, answers, key, row):
+        """
+        Sets a pending answer and remembers the answer it replaces, see `discard_file`.
+        """
+        self._file_changes.append((answers, key, answers.get(key)))
+        answers[key] = row
+
+    def _get_disease(self, disease_token):
+        """
+        Maps a disease token from the result to a pair (disease id, invalid), see `AnswerType1.set_disease`.
+        """
+        if disease_token is None or disease_token.lower() == "none":
+            return None, False
+        if disease_token.lower() == "not_applicable":
+            return None, True
+        try:
+            return self.disease_ids[disease_token], False
+        except KeyError:
+            logger.error(f"Disease with a token '{disease_token}' does not exist.")
+            raise ValueError(f"Disease with a token '{disease_token}' does not exist.")
+
+    def _get_stats_answers(self):
+        """
+        Collected answers in the form expected by `Stats.apply`. Must be called before survey result ids are assigned.
+        """
+        answers = list()
+        for key, answer in self._answers.items():
+            row = {
+                "type": answer["type"],
+                "survey_id": self._survey_results[answer["surveyresult_id"]]["survey_id"],
+                "user_id": answer["user_id"]
+            }
+            if answer["type"] == 1:
+                answer_t1 = self._answers_t1[key]
+                row["image_id"] = self.question_image_ids.get(answer["question_id"])
+                row["category"] = Stats.get_category(answer_t1["disease_id"], answer_t1["invalid"])
+                row["certainty"] = answer_t1["certainty"]
+            else:
+                row["winner_id"] = self._answers_t2[key]["winner_id"]
+                row["loser_id"] = self._answers_t2[key]["loser_id"]
+            answers.append(row)
+        return answers
+
+    def flush(self):
+        """
+        Inserts all collected answers and commits the current batch in a unit of work.
+
+        :return: None
+        """
+        try:
+            with unit_of_work() as uow:
+                Stats.apply(self._survey_results, Stats.get_answers(self._answers.keys(), session=uow),
+                            self._get_stats_answers(), session=uow)
+                ConsistencyCounters.apply({row["user_id"] for row in self._survey_results}, self._answers_t1.values(),
+                                          self._control_answers.values(), self._answers_t2.values(), session=uow)
+                if len(self._survey_results) != 0:
+                    survey_result_ids = uow.execute(
+                        insert(SurveyResult.__table__).returning(SurveyResult.id, sort_by_parameter_order=True),
+                        self._survey_results
+                    ).scalars().all()
+                    for row in itertools.chain(self._entries, self._answers.values(), self._control_answers.values()):
+                        row["surveyresult_id"] = survey_result_ids[row["surveyresult_id"]]
+                upsert(Answer.__table__, list(self._answers.values()),
+                       index_elements=["question_id", "user_id"], update_columns=["surveyresult_id", "type"],
+                       session=uow)
+                upsert(AnswerType1.__table__, list(self._answers_t1.values()),
+                       index_elements=["question_id", "user_id"], update_columns=["disease_id", "certainty", "invalid"],
+                       session=uow)
+                upsert(AnswerType2.__table__, list(self._answers_t2.values()),
+                       index_elements=["question_id", "user_id"], update_columns=["winner_id", "loser_id"],
+                       session=uow)
+                upsert(ControlAnswer.__table__, list(self._control_answers.values()),
+                       index_elements=["question_id", "user_id"],
+                       update_columns=["surveyresult_id", "disease_id", "certainty", "invalid"], session=uow)
+                copy_rows(ResultImportEntry.__table__, self._entries, session=uow)
+        except:
+            # entries from the rolled back batch were not applied
+            self.applied_entries.difference_update(entry["entry_hash"] for entry in self._entries)
+            raise
+        self.n_results += len(self._entries)
+        self.n_answers += len(self._answers) + len(self._control_answers)
+        self._pending_results = 0
+        self._file_start = (0, 0)
+        self._file_changes = list()
+        self._survey_results = list()
+        self._entries = list()
+        self._answers = dict()
+        self._answers_t1 = dict()
+        self._answers_t2 = dict()
+        self._control_answers = dict()
+
+
+class SurveyResults:
+
+    # number of results committed at once when streaming results from a file
+    stream_batch_size = 1000
+
+    @staticmethod
+    def _check_file(survey_json_filepath):
+        # does survey result json file exist?
+        if not Path(survey_json_filepath).exists():
+            logger.error(f"File {survey_json_filepath} does not exist.")
+            raise FileNotFoundError(f"File {survey_json_filepath} does not exist.")
+        if Path(survey_json_filepath).is_dir():
+            logger.error(f"Expecting a file, but {survey_json_filepath} is a directory.")
+            raise IsADirectoryError(f"Expecting a file, but {survey_json_filepath} is a directory.")
+
+    @staticmethod
+    def read_results(survey_json_filepath):
+        """
+        Reads raw results from the `Data` array of a surveyjs result file.
+
+        :param survey_json_filepath: A path to the survey result json file.
+        :return: A list of raw result dictionaries.
+        """
+        SurveyResults._check_file(survey_json_filepath)
+        with open(survey_json_filepath, "r") as f:
+            survey_json = json.load(f)
+
+        # results are stored inside "Data" json array
+        return survey_json["Data"]
+
+    @staticmethod
+    def iter_results(survey_json_filepath):
+        """
+        Reads raw results from the `Data` array of a surveyjs result file one at a time, without loading the whole
+        file into memory.
+
+        :param survey_json_filepath: A path to the survey result json file.
+        :return: A generator of raw result dictionaries.
+        """
+        SurveyResults._check_file(survey_json_filepath)
+        with open(survey_json_filepath, "r") as f:
+            # results are stored inside "Data" json array
+            yield from iter_json_array(f, "Data")
+
+    @staticmethod
+    def parse_result(result):
+        """
+        Converts a single raw result to a plain dictionary of answers, without touching the database:
+            {
+                "user_id": <id of the user that filled the survey>,
+                "survey_id": <id of the survey>,
+                "answers": {<question id>: {"choice": <disease token>, "certainty": <certainty>}, ...},
+                "pairs": {<question id>: (<winner image id>, <loser image id>), ...},
+                "entry_hash": <hash of the raw result, used to recognize already imported results>
+            }
+        where `answers` are answers to type 1 questions and `pairs` are answers to type 2 questions, given as
+            "sXY-qZW-imAB-imCD-impicker": "imAB"
+        in the raw result, where AB is the id of the picked image.
+
+        :param result: A raw result, an item of the `Data` array.
+        :return: A parsed result, or None if the result does not contain any answers.
+        """
+        survey_id = None
+        answers = dict()
+        pairs = dict()
+        for question_str, answer_str in result.items():
+            if question_str.endswith("-impicker"):
+                match = TYPE2_KEY_RE.match(question_str)
+                if match is None:
+                    continue
+                if survey_id is None:
+                    survey_id = int(match.group(1))
+                images = (int(match.group(3)), int(match.group(4)))
+                picked = TYPE2_VALUE_RE.fullmatch(str(answer_str))
+                if picked is None or int(picked.group(1)) not in images:
+                    raise ValueError(f"Picked image {answer_str} is not one of the images in {question_str}.")
+                winner_id = int(picked.group(1))
+                pairs[int(match.group(2))] = (winner_id, images[1] if winner_id == images[0] else images[0])
+                continue
+
+            # if question identifier is not like sXY-qZW-choice or sXY-qZW-certainty skip
+            match = TYPE1_KEY_RE.match(question_str)
+            if match is None:
+                continue
+
+            # get survey id from an identifier of the first processed question
+            if survey_id is None:
+                survey_id = int(match.group(1))
+
+            answer = answers.setdefault(int(match.group(2)), {"choice": None, "certainty": None})
+            if match.group(3) == "choice":
+                answer["choice"] = answer_str
+            else:
+                answer["certainty"] = int(answer_str)
+
+        if survey_id is None:
+            return None
+        return {
+            "user_id": int(result["doctorID"]),
+            "survey_id": survey_id,
+            "answers": answers,
+            "pairs": pairs,
+            "entry_hash": hashlib.sha1(json.dumps(result, sort_keys=True).encode("utf-8")).hexdigest()
+        }
+
+    @staticmethod
+    def parse_file(survey_json_filepath):
+        """
+        Reads and parses all results from a survey result file.
+
+        :param survey_json_filepath: A path to the survey result json file.
+        :return: A list of parsed results, see `parse_result`.
+        """
+        parsed = [SurveyResults.parse_result(result) for result in SurveyResults.read_results(survey_json_filepath)]
+        skipped = parsed.count(None)
+        if skipped != 0:
+            logger.warning(f"Skipped {skipped} results without answers in {survey_json_filepath}.")
+        return [result for result in parsed if result is not None]
+
+    @staticmethod
+    def load(survey_json_filepath, batch_size=None, stream=False, writer=None):
+        """
+        Imports survey results from a surveyjs json file, see `Survey.load_results` and `parse_result` for the
+        expected format.
+
+        :param survey_json_filepath: A path to the survey result json file.
+        :param batch_size: Number of results committed in a single transaction. If None, the whole file is imported
+            in one transaction, unless `stream` is set.
+        :param stream: If True, results are parsed and written one at a time and committed every `batch_size` results
+            (`stream_batch_size` by default), so memory consumption does not depend on the file size.
+        :param writer: A SurveyResultWriter to write the results with. If None, a new one is created.
+        :return: A SurveyResultWriter used for import, holding the number of imported results and answers.
+        """
+        logger.info(f"Importing survey results from file {survey_json_filepath}.")
+        if stream and batch_size is None:
+            batch_size = SurveyResults.stream_batch_size
+        if writer is None:
+            writer = SurveyResultWriter(batch_size=batch_size)
+
+        file_hash = SurveyResultWriter.get_file_hash(survey_json_filepath)
+        if SurveyResultWriter.is_imported(file_hash):
+            logger.info(f"All results from {survey_json_filepath} were already imported. Skipping.")
+            return writer
+
+        if stream:
+            results = SurveyResults._stream_file(survey_json_filepath)
+        else:
+            results = SurveyResults.parse_file(survey_json_filepath)
+        n_results, n_answers, n_skipped = writer.n_results, writer.n_answers, writer.n_skipped
+        writer.start_file(survey_json_filepath, file_hash=file_hash)
+        for result in results:
+            writer.add(result)
+        writer.finish_file()
+        logger.info(f"Imported {writer.n_results - n_results} results with {writer.n_answers - n_answers} answers from "
+                    f"{survey_json_filepath}, skipped {writer.n_skipped - n_skipped} already imported results.")
+        return writer
+
+    @staticmethod
+    def _stream_file(survey_json_filepath):
+        results = (SurveyResults.parse_result(result) for result in SurveyResults.iter_results(survey_json_filepath))
+        return (result for result in results if result is not None)
+
+    @staticmethod
+    def _parse_files(filepaths, workers, stream):
+        """
+        Yields pairs (filepath, parsed results) for all files, parsing them in a pool of worker processes, or lazily
+        one after another if `stream` is set. Parse errors are raised while iterating over the results.
+        """
+        def future_results(future):
+            yield from future.result()
+
+        if stream:
+            for filepath in filepaths:
+                yield filepath, SurveyResults._stream_file(filepath)
+        else:
+            # workers only parse files, the initializer keeps them off the connections inherited from this process
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+                futures = {executor.submit(SurveyResults.parse_file, filepath): filepath for filepath in filepaths}
+                for future in as_completed(futures):
+                    yield futures[future], future_results(future)
+
+    @staticmethod
+    def load_directory(directory, workers=None, batch_size=100, stream=False):
+        """
+        Imports all survey result files (*.json) found in the directory and its subdirectories. Files are read and
+        parsed in a pool of worker processes, while the parsed results are written to the database by a single writer
+        in the main process, committing every `batch_size` results. Files that cannot be parsed are skipped. Files with
+        a result that is rejected by the writer, e.g. of an unknown user, are skipped and their pending results are
+        dropped, see `SurveyResultWriter.discard_file`.
+
+        :param directory: A path to the directory containing survey result files.
+        :param workers: Number of worker processes used for parsing. Defaults to the number of processors.
+        :param batch_size: Number of results committed in a single transaction.
+        :param stream: If True, files are streamed one after another in the main process instead of being parsed in
+            the worker pool, see `load`. Should be used for files too large to be parsed into memory at once.
+        :return: A SurveyResultWriter used for import, holding the number of imported results and answers.
+        """
+        if not Path(directory).is_dir():
+            logger.error(f"Cannot load survey results because {directory} is not a directory.")
+            raise NotADirectoryError(f"Cannot load survey results because {directory} is not a directory.")
+
+        filepaths = sorted(path for path in Path(directory).rglob("*.json") if path.is_file())
+        logger.info(f"Importing survey results from {len(filepaths)} files in {directory}.")
+
+        # files whose results were all applied by a previous import are skipped without parsing
+        with stage("find imported files"), unit_of_work() as uow:
+            file_hashes = {filepath: SurveyResultWriter.get_file_hash(filepath) for filepath in filepaths}
+            filepaths = [filepath for filepath in filepaths
+                         if not SurveyResultWriter.is_imported(file_hashes[filepath], session=uow)]
+        if len(filepaths) != len(file_hashes):
+            logger.info(f"Skipping {len(file_hashes) - len(filepaths)} files that were already imported.")
+
+        writer = SurveyResultWriter(batch_size=batch_size)
+        n_parsed = 0
+        start = time.perf_counter()
+        with stage("import results"):
+            for i, (filepath, results) in enumerate(SurveyResults._parse_files(filepaths, workers, stream), start=1):
+                n_file_results = 0
+                writer.start_file(filepath, file_hash=file_hashes[filepath])
+                results = iter(results)
+                parsed = True
+                while True:
+                    try:
+                        result = next(results)
+                    except StopIteration:
+                        break
+                    except (ValueError, KeyError, TypeError, AttributeError) as e:
+                        logger.error(f"[{i}/{len(filepaths)}] Skipping the rest of {filepath} because it cannot be "
+                                     f"parsed: {e!r}")
+                        parsed = False
+                        break
+                    try:
+                        writer.add(result)
+                    except ValueError as e:
+                        # the error is logged by the writer
+                        logger.error(f"[{i}/{len(filepaths)}] Skipping {filepath} because one of its results is "
+                                     f"rejected: {e}")
+                        writer.discard_file()
+                        parsed = False
+                        break
+                    n_file_results += 1
+                if parsed:
+                    writer.finish_file()
+
+                n_parsed += n_file_results
+                elapsed = time.perf_counter() - start
+                logger.info("[%s/%s] Parsed %s results from %s (%.1f results/s).", i, len(filepaths),
+                            n_file_results, filepath, n_parsed / elapsed, extra=PER_ITEM)
+            writer.flush()
+
+        elapsed = time.perf_counter() - start
+        logger.info(f"Imported {writer.n_results} results with {writer.n_answers} answers from {len(filepaths)} files "
+                    f"in {elapsed:.2f} s ({writer.n_results / elapsed:.1f} results/s, "
+                    f"{writer.n_answers / elapsed:.1f} answers/s), skipped {writer.n_skipped} already imported "
+                    f"results.")
+        return writer
@@ -0,0 +1,296 @@
+from sqlalchemy import Column, Integer, ForeignKey, PrimaryKeyConstraint, select, delete, insert, func, case, \
+    and_, tuple_, literal, union_all
+from sqlalchemy.orm import relationship
+
+from utils.database import Base, session, get_session, upsert
+from utils.logger import get_logger
+from model.answer import Answer, AnswerType1, AnswerType2
+from model.disease import Disease
+from model.question import QuestionType1
+from model.survey import SurveyResult
+
+
+logger = get_logger(__name__)
+
+
+# vote categories of type 1 answers without a disease
+NO_DISEASE = -1
+NOT_APPLICABLE = -2
+
+
+class SurveyStats(Base):
+    __tablename__ = "survey_stats"
+
+    survey_id = Column(Integer, ForeignKey("survey.id"), primary_key=True)
+    n_results = Column(Integer, nullable=False, default=0)
+    n_answers = Column(Integer, nullable=False, default=0)
+
+    survey = relationship("Survey")
+
+
+class UserStats(Base):
+    __tablename__ = "user_stats"
+
+    user_id       = Column(Integer, ForeignKey("user.id"), primary_key=True)
+    n_results     = Column(Integer, nullable=False, default=0)
+    n_answers     = Column(Integer, nullable=False, default=0)
+    n_answers_t1  = Column(Integer, nullable=False, default=0)
+    certainty_sum = Column(Integer, nullable=False, default=0)
+
+    user = relationship("User")
+
+
+class ImageStats(Base):
+    """
+    Answers to questions showing the image: type 1 answers about the image and type 2 picks where the image was
+    compared, split into wins and losses.
+    """
+    __tablename__ = "image_stats"
+
+    image_id  = Column(Integer, ForeignKey("image.id"), primary_key=True)
+    n_answers = Column(Integer, nullable=False, default=0)
+    n_wins    = Column(Integer, nullable=False, default=0)
+    n_losses  = Column(Integer, nullable=False, default=0)
+
+    image = relationship("Image")
+
+
+class DiseaseVotes(Base):
+    """
+    Histogram of type 1 answers per image. `category` is a disease id or one of NO_DISEASE and NOT_APPLICABLE, so it
+    can be a part of the primary key.
+    """
+    __tablename__ = "disease_votes"
+
+    image_id      = Column(Integer, ForeignKey("image.id"))
+    category      = Column(Integer)
+    n_votes       = Column(Integer, nullable=False, default=0)
+    certainty_sum = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        PrimaryKeyConstraint("image_id", "category"), {}
+    )
+
+    image = relationship("Image")
+
+
+class Stats:
+    """
+    Maintains summary tables of imported answers. The tables are updated with the difference each imported batch makes,
+    i.e. contributions of answers replaced by the batch are subtracted and contributions of the new answers added, in
+    the import transaction. Answers from control surveys are not counted.
+
+    Answers passed to `apply` are dictionaries with keys type, survey_id, user_id and, for type 1 answers, image_id,
+    category and certainty, or, for type 2 answers, winner_id and loser_id.
+    """
+
+    # maximal number of answer keys in a single query
+    chunk_size = 500
+
+    @staticmethod
+    def get_category(disease_id, invalid):
+        if invalid:
+            return NOT_APPLICABLE
+        return NO_DISEASE if disease_id is None else disease_id
+
+    @staticmethod
+    def get_answers(keys, session=None):
+        """
+        Loads stored answers in the form expected by `apply`.
+
+        :param keys: A list of (question id, user id) pairs.
+        :param session: Session to use, the application session by default.
+        :return: A list of answer dictionaries, for the keys that have a stored answer.
+        """
+        session = get_session(session)
+        answer, atype1, atype2 = Answer.__table__, AnswerType1.__table__, AnswerType2.__table__
+        statement = select(
+            answer.c.type, answer.c.user_id, SurveyResult.survey_id, QuestionType1.image_id,
+            atype1.c.disease_id, atype1.c.invalid, atype1.c.certainty, atype2.c.winner_id, atype2.c.loser_id
+        ).select_from(
+            answer
+            .outerjoin(SurveyResult.__table__, SurveyResult.id == answer.c.surveyresult_id)
+            .outerjoin(QuestionType1.__table__, QuestionType1.id == answer.c.question_id)
+            .outerjoin(atype1, and_(atype1.c.question_id == answer.c.question_id, atype1.c.user_id == answer.c.user_id))
+            .outerjoin(atype2, and_(atype2.c.question_id == answer.c.question_id, atype2.c.user_id == answer.c.user_id))
+        )
+
+        answers = list()
+        keys = list(keys)
+        for i in range(0, len(keys), Stats.chunk_size):
+            rows = session.execute(statement.where(
+                tuple_(answer.c.question_id, answer.c.user_id).in_(keys[i:i + Stats.chunk_size])
+            )).all()
+            for row in rows:
+                answers.append({
+                    "type": row.type,
+                    "survey_id": row.survey_id,
+                    "user_id": row.user_id,
+                    "image_id": row.image_id,
+                    "category": Stats.get_category(row.disease_id, row.invalid),
+                    "certainty": row.certainty,
+                    "winner_id": row.winner_id,
+                    "loser_id": row.loser_id
+                })
+        return answers
+
+    @staticmethod
+    def apply(results, old_answers, new_answers, session=None):
+        """
+        Updates summary tables with a batch of imported results. Executed within the current session transaction.
+
+        :param results: A list of new survey results as dictionaries with keys survey_id and user_id.
+        :param old_answers: Stored answers replaced by the batch, see `get_answers`.
+        :param new_answers: Answers written by the batch.
+        :param session: Session to use, the application session by default.
+        :return: None
+        """
+        surveys, users, images, votes = dict(), dict(), dict(), dict()
+
+        def add(table, key, **deltas):
+            counters = table.setdefault(key, dict.fromkeys(deltas, 0))
+            for column, delta in deltas.items():
+                counters[column] = counters.get(column, 0) + delta
+
+        for result in results:
+            add(surveys, result["survey_id"], n_results=1)
+            add(users, result["user_id"], n_results=1)
+
+        for sign, answers in ((-1, old_answers), (1, new_answers)):
+            for answer in answers:
+                if answer["survey_id"] is not None:
+                    add(surveys, answer["survey_id"], n_answers=sign)
+                if answer["type"] == 1:
+                    certainty = answer["certainty"] or 0
+                    add(users, answer["user_id"], n_answers=sign, n_answers_t1=sign, certainty_sum=sign * certainty)
+                    if answer["image_id"] is not None:
+                        add(images, answer["image_id"], n_answers=sign)
+                        add(votes, (answer["image_id"], answer["category"]), n_votes=sign,
+                            certainty_sum=sign * certainty)
+                else:
+                    add(users, answer["user_id"], n_answers=sign)
+                    if answer["type"] == 2:
+                        add(images, answer["winner_id"], n_answers=sign, n_wins=sign)
+                        add(images, answer["loser_id"], n_answers=sign, n_losses=sign)
+
+        Stats._accumulate(SurveyStats, ["survey_id"], surveys, ["n_results", "n_answers"], session)
+        Stats._accumulate(UserStats, ["user_id"], users, ["n_results", "n_answers", "n_answers_t1", "certainty_sum"],
+                          session)
+        Stats._accumulate(ImageStats, ["image_id"], images, ["n_answers", "n_wins", "n_losses"], session)
+        Stats._accumulate(DiseaseVotes, ["image_id", "category"], votes, ["n_votes", "certainty_sum"], session)
+
+    @staticmethod
+    def _accumulate(model, key_columns, counters, columns, session=None):
+        rows = list()
+        for key, deltas in counters.items():
+            if not any(deltas.values()):
+                continue
+            row = dict(zip(key_columns, key if isinstance(key, tuple) else (key,)))
+            row.update({column: deltas.get(column, 0) for column in columns})
+            rows.append(row)
+        upsert(model.__table__, rows, index_elements=key_columns, update_columns=columns, accumulate=True,
+               session=session)
+
+    @staticmethod
+    def rebuild():
+        """
+        Recomputes all summary tables from stored survey results and answers, e.g. for a database with results
+        imported before the tables existed.
+
+        :return: None
+        """
+        answer, atype1, atype2 = Answer.__table__, AnswerType1.__table__, AnswerType2.__table__
+        survey_result, qtype1 = SurveyResult.__table__, QuestionType1.__table__
+        category = case((atype1.c.invalid == True, NOT_APPLICABLE),
+                        (atype1.c.disease_id == None, NO_DISEASE),
+                        else_=atype1.c.disease_id)
+        is_t1 = case((answer.c.type == 1, 1), else_=0)
+        try:
+            for model in (SurveyStats, UserStats, ImageStats, DiseaseVotes):
+                session.execute(delete(model.__table__))
+
+            results = select(survey_result.c.survey_id, survey_result.c.user_id,
+                             literal(1).label("n_results"), literal(0).label("n_answers")) \
+                .where(survey_result.c.survey_id != None)
+            answers = select(survey_result.c.survey_id, answer.c.user_id,
+                             literal(0).label("n_results"), literal(1).label("n_answers")) \
+                .select_from(answer.outerjoin(survey_result, survey_result.c.id == answer.c.surveyresult_id))
+            counts = union_all(results, answers).subquery()
+            session.execute(insert(SurveyStats.__table__).from_select(
+                ["survey_id", "n_results", "n_answers"],
+                select(counts.c.survey_id, func.sum(counts.c.n_results), func.sum(counts.c.n_answers))
+                .where(counts.c.survey_id != None).group_by(counts.c.survey_id)
+            ))
+
+            results = select(survey_result.c.user_id, literal(1).label("n_results"), literal(0).label("n_answers"),
+                             literal(0).label("n_answers_t1"), literal(0).label("certainty")) \
+                .where(survey_result.c.user_id != None)
+            answers = select(answer.c.user_id, literal(0), literal(1), is_t1, func.coalesce(atype1.c.certainty, 0)) \
+                .select_from(answer.outerjoin(atype1, and_(atype1.c.question_id == answer.c.question_id,
+                                                           atype1.c.user_id == answer.c.user_id)))
+            counts = union_all(results, answers).subquery()
+            session.execute(insert(UserStats.__table__).from_select(
+                ["user_id", "n_results", "n_answers", "n_answers_t1", "certainty_sum"],
+                select(counts.c.user_id, func.sum(counts.c.n_results), func.sum(counts.c.n_answers),
+                       func.sum(counts.c.n_answers_t1), func.sum(counts.c.certainty))
+                .group_by(counts.c.user_id)
+            ))
+
+            t1 = select(qtype1.c.image_id, literal(1).label("n_answers"), literal(0).label("n_wins"),
+                        literal(0).label("n_losses")) \
+                .select_from(atype1.join(qtype1, qtype1.c.id == atype1.c.question_id))
+            wins = select(atype2.c.winner_id, literal(1), literal(1), literal(0))
+            losses = select(atype2.c.loser_id, literal(1), literal(0), literal(1))
+            counts = union_all(t1, wins, losses).subquery()
+            session.execute(insert(ImageStats.__table__).from_select(
+                ["image_id", "n_answers", "n_wins", "n_losses"],
+                select(counts.c.image_id, func.sum(counts.c.n_answers), func.sum(counts.c.n_wins),
+                       func.sum(counts.c.n_losses))
+                .group_by(counts.c.image_id)
+            ))
+
+            session.execute(insert(DiseaseVotes.__table__).from_select(
+                ["image_id", "category", "n_votes", "certainty_sum"],
+                select(qtype1.c.image_id, category, func.count(), func.sum(atype1.c.certainty))
+                .select_from(atype1.join(qtype1, qtype1.c.id == atype1.c.question_id))
+                .group_by(qtype1.c.image_id, category)
+            ))
+        except:
+            session.rollback()
+            raise
+        else:
+            session.commit()
+        logger.info("Rebuilt survey statistics.")
+
+    @staticmethod
+    def get_survey_stats():
+        return session.execute(select(SurveyStats).order_by(SurveyStats.survey_id)).scalars().all()
+
+    @staticmethod
+    def get_user_stats():
+        return session.execute(select(UserStats).order_by(UserStats.user_id)).scalars().all()
+
+    @staticmethod
+    def get_image_stats():
+        return session.execute(select(ImageStats).order_by(ImageStats.image_id)).scalars().all()
+
+    @staticmethod
+    def get_disease_stats():
+        """
+        Sums the per image vote histograms by disease.
+
+        :return: A list of rows (category, token, n_votes, certainty_sum, n_images), where token is the disease token,
+            `none` or `not_applicable`.
+        """
+        token = case((DiseaseVotes.category == NO_DISEASE, "none"),
+                     (DiseaseVotes.category == NOT_APPLICABLE, "not_applicable"),
+                     else_=Disease.token)
+        return session.execute(
+            select(DiseaseVotes.category, token.label("token"), func.sum(DiseaseVotes.n_votes).label("n_votes"),
+                   func.sum(DiseaseVotes.certainty_sum).label("certainty_sum"),
+                   func.count(DiseaseVotes.image_id).label("n_images"))
+            .outerjoin(Disease, Disease.id == DiseaseVotes.category)
+            .where(DiseaseVotes.n_votes > 0)
+            .group_by(DiseaseVotes.category, Disease.token)
+            .order_by(func.sum(DiseaseVotes.n_votes).desc())
+        ).all()
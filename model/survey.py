@@ -1,17 +1,16 @@
-import json
-import regex as re
-
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Text, Date
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Date
+from sqlalchemy.orm import relationship, deferred, selectinload, object_session
 from string import Template
 from datetime import datetime
-from pathlib import Path
 
-from utils.database import Base, session
+from utils.database import Base, get_session, commit
+from utils.compression import CompressedText
 from utils.tools import minify_json
-from utils.logger import logger
-from model.user import Users
-from model.answer import AnswerType1
+from utils.logger import get_logger
+from model.question import Questions, QuestionType1, QuestionType2
+
+
+logger = get_logger(__name__)
 
 
 class Survey(Base):
@@ -19,7 +18,7 @@ class Survey(Base):
 
     id          = Column(Integer, primary_key=True, autoincrement=True)
     type        = Column(String)
-    json        = Column(Text)
+    json        = deferred(Column(CompressedText))
     created_at  = Column(DateTime, nullable=False)
 
     survey_results = relationship("SurveyResult", back_populates="survey")
@@ -58,72 +57,14 @@ class Survey(Base):
         A file can contain multiple results for the same survey. Each result is parsed separately and for each parsed
         result an instance of SurveyResult is created. The instance consist of array of AnswerType1 objects, where each
         object is associated with a corresponding QuestionType1, a User that has filled the survey, a Disease that the
-        user has selected and certainty
+        user has selected and certainty. All results from the file are imported in a single transaction.
 
         :param survey_json_filepath: A path to the survey result json file.
         :return: None
         """
-        # does survey result json file exist?
-        if not Path(survey_json_filepath).exists():
-            logger.error(f"File {survey_json_filepath} does not exist.")
-            raise FileNotFoundError(f"File {survey_json_filepath} does not exist.")
-        if Path(survey_json_filepath).is_dir():
-            logger.error(f"Expecting a file, but {survey_json_filepath} is a directory.")
-            raise IsADirectoryError(f"Expecting a file, but {survey_json_filepath} is a directory.")
-        logger.info(f"Importing survey results from file {survey_json_filepath}.")
-
-        with open(survey_json_filepath, "r") as f:
-            survey_json = json.load(f)
-
-        # matches for strings like s<digits>-q<digits>-choice and s<digits>-q<digits>-certainty
-        question_re = re.compile("s\d+-q\d+-(choice|certainty)", re.ASCII)
-
-        # results are stored inside "Data" json array
-        survey_results = survey_json["Data"]
-        for result in survey_results:
-            uid = result["doctorID"]
-            user = Users.get_user_by_id(uid=uid)
-            if user is None:
-                logger.error("User with id '{}' does not exist.".format(uid))
-                raise ValueError("User with id '{}' does not exist.".format(uid))
-
-            # generate AnswerType1 objects for each pair of question-choice and question-certainty pairs in response
-            # json
-            first_question = False
-
-            # answers dictionary contains pairs: <question_id>: <answer_object>
-            # where type 1 answer object stores selected disease and certainty
-            answers = dict()
-            for question_str, answer_str in result.items():
-                # if question identifier is not like sXY-qZW-choice or sXY-qZW-certainty skip
-                if not question_re.match(question_str):
-                    continue
-                question_id = int(question_str.split('-')[1][1:])
-
-                # get survey id from an identifier of the first processed question
-                if first_question is False:
-                    survey_id = int(question_str.split('-')[0][1:])
-                    survey = Surveys.get_by_id(survey_id)
-                    assert survey is not None
-                    first_question = True
-                if "-choice" in question_str:
-                    if question_id not in answers.keys():
-                        answers[question_id] = AnswerType1(user, question_id=question_id, disease_token=answer_str)
-                    else:
-                        answers[question_id].set_disease(disease_token=answer_str)
-                if "-certainty" in question_str:
-                    certainty = int(answer_str)
-                    if question_id not in answers.keys():
-                        answers[question_id] = AnswerType1(user, question_id=question_id, certainty=certainty)
-                    else:
-                        answers[question_id].set_certainty(certainty=certainty)
-
-            # create list of Answer objects from the dictionary
-            answers = [answer for _, answer in answers.items()]
-
-            # create a survey result object and insert it to the database
-            survey_result = SurveyResult(user=user, survey=survey, answers=answers)
-            survey_result.insert()
+        # results are imported in bulk, see SurveyResults
+        from model.results import SurveyResults
+        SurveyResults.load(survey_json_filepath)
 
     @staticmethod
     def _generate_auth_page():
@@ -161,7 +102,8 @@ class Survey(Base):
         if self.auth_page:
             survey_json += Survey._generate_auth_page()
 
-        # generate pages for survey questions
+        # generate pages for survey questions, their jsons are loaded at once instead of one query per page
+        Questions.load_json(self.questions, session=object_session(self))
         for i, question in enumerate(self.questions):
             question_json = self._generate_page(question)
             if i != len(self.questions) - 1:  # put comma after all but the last generated page
@@ -200,7 +142,7 @@ class Survey(Base):
 
 class RegularSurvey(Survey):
     __tablename__ = "regular_survey"
-    __mapper_args__ = {"polymorphic_identity": "regular"}
+    __mapper_args__ = {"polymorphic_identity": "regular", "polymorphic_load": "selectin"}
 
     id = Column(Integer, ForeignKey("survey.id"), primary_key=True)
 
@@ -230,7 +172,7 @@ class RegularSurvey(Survey):
 
 class ControlSurvey(Survey):
     __tablename__ = "control_survey"
-    __mapper_args__ = {"polymorphic_identity": "control"}
+    __mapper_args__ = {"polymorphic_identity": "control", "polymorphic_load": "selectin"}
 
     id = Column(Integer, ForeignKey("survey.id"), primary_key=True)
 
@@ -258,9 +200,34 @@ class ControlSurvey(Survey):
 class Surveys:
 
     @staticmethod
-    def get_by_id(id):
+    def get_by_id(id, session=None):
+        session = get_session(session)
         return session.query(Survey).where(Survey.id == id).one()
 
+    @staticmethod
+    def get_by_type(survey_type, with_images=False, session=None):
+        """
+        Returns all surveys of a type. Survey jsons are deferred and loaded one survey at a time when accessed.
+
+        :param survey_type: `regular` or `control`.
+        :param with_images: If True, questions of the surveys and images shown in the questions are loaded as well,
+            with a query per relationship instead of a query per survey and question.
+        :param session: Session to use, the application session by default.
+        :return: A list of surveys.
+        """
+        session = get_session(session)
+        if survey_type not in Survey.valid_types:
+            logger.error(f"Survey type can be in {Survey.valid_types} but you require {survey_type}.")
+            raise ValueError(f"Survey type can be in {Survey.valid_types} but you require {survey_type}.")
+        survey_class = RegularSurvey if survey_type == "regular" else ControlSurvey
+        query = session.query(survey_class)
+        if with_images:
+            query = query.options(
+                selectinload(survey_class.questions.of_type(QuestionType1)).selectinload(QuestionType1.image),
+                selectinload(survey_class.questions.of_type(QuestionType2)).selectinload(QuestionType2.images)
+            )
+        return query.all()
+
 
 class SurveyResult(Base):
     __tablename__ = 'survey_result'
@@ -279,11 +246,12 @@ class SurveyResult(Base):
         self.user = user
         self.answers = answers
 
-    def insert(self):
+    def insert(self, session=None):
+        session = get_session(session)
         try:
             session.add(self)
         except:
             session.rollback()
         finally:
-            session.commit()
+            commit(session)
 
@@ -3,8 +3,11 @@ from sqlalchemy import Column, Integer, String, DateTime
 from sqlalchemy.orm import relationship
 from secrets import token_urlsafe
 
-from utils.database import Base, session
-from utils.logger import logger
+from utils.database import Base, get_session, commit
+from utils.logger import get_logger
+
+
+logger = get_logger(__name__)
 
 
 class User(Base):
@@ -12,7 +15,7 @@ class User(Base):
 
     id           = Column(Integer, primary_key=True, autoincrement=True)
     name         = Column(String, nullable=False)
-    access_token = Column(String, nullable=False)
+    access_token = Column(String, nullable=False, index=True)
     created_at   = Column(DateTime, nullable=False)
 
     survey_results = relationship("SurveyResult", back_populates="user")
@@ -29,19 +32,21 @@ class Users:
     users = list()
 
     @staticmethod
-    def insert(name, access_token=None):
+    def insert(name, access_token=None, session=None):
         """
         Inserts new user to the database if the user with a same access token does not already exist. If the user
         already exists in a database, the entry from the database is returned and new user is not created.
 
         :param name: User name.
         :param access_token: User access token. Must be different from
+        :param session: Session to use, the application session by default.
         :return:
         """
+        session = get_session(session)
         if access_token is None:
             result = None
         else:
-            result = Users.get_user_by_access_token(access_token=access_token)
+            result = Users.get_user_by_access_token(access_token=access_token, session=session)
 
         if result is None:
             new_user = User(name=name, access_token=access_token)
@@ -50,7 +55,7 @@ class Users:
             except:
                 session.rollback()
             finally:
-                session.commit()
+                commit(session)
                 return new_user
         else:
             logger.warning(f"A user with with access_token '{access_token}' already exists in a database. "
@@ -66,18 +71,23 @@ class Users:
         raise NotImplementedError
 
     @staticmethod
-    def get_users():
+    def get_users(session=None):
         """
         Returns all users.
 
+        :param session: Session to use, the application session by default.
+
         :return:
         """
+        session = get_session(session)
         return session.query(User).all()
 
     @staticmethod
-    def get_user_by_access_token(access_token):
+    def get_user_by_access_token(access_token, session=None):
+        session = get_session(session)
         return session.query(User).where(User.access_token == access_token).first()
 
     @staticmethod
-    def get_user_by_id(uid):
+    def get_user_by_id(uid, session=None):
+        session = get_session(session)
         return session.query(User).where(User.id == uid).first()
@@ -0,0 +1,179 @@
+from pathlib import Path
+from sqlalchemy import select, and_
+
+from utils.database import session
+from utils.logger import get_logger
+from model.answer import Answer, AnswerType1, AnswerType2, ControlAnswer
+from model.disease import Disease
+from model.image import Image
+from model.question import Question, QuestionType1, QuestionType2
+from model.survey import SurveyResult
+
+
+logger = get_logger(__name__)
+
+
+class ParquetExport:
+    """
+    Exports answers, including the control survey answers, together with the questions, images, diseases and survey
+    results they refer to as Parquet files, one file per table. Rows are streamed from the database and written as
+    Arrow record batches, so memory used by the export does not grow with the number of answers. Repeated strings
+    like disease tokens and dataset names are dictionary encoded and load as categoricals in pandas.
+
+    Requires pyarrow.
+    """
+
+    # number of rows fetched from the database and written to a record batch at once
+    batch_size = 65536
+
+    @staticmethod
+    def _get_tables(pa):
+        """
+        Returns a list of (name, select statement, schema) for every exported table. Columns of the statement must be in
+        the order of schema fields.
+        """
+        answer, atype1, atype2 = Answer.__table__, AnswerType1.__table__, AnswerType2.__table__
+        token = pa.dictionary(pa.int32(), pa.string())
+
+        answers = select(
+            answer.c.question_id, answer.c.user_id, answer.c.surveyresult_id, answer.c.type,
+            atype1.c.disease_id, Disease.token, atype1.c.certainty, atype1.c.invalid,
+            atype2.c.winner_id, atype2.c.loser_id
+        ).select_from(
+            answer
+            .outerjoin(atype1, and_(atype1.c.question_id == answer.c.question_id, atype1.c.user_id == answer.c.user_id))
+            .outerjoin(atype2, and_(atype2.c.question_id == answer.c.question_id, atype2.c.user_id == answer.c.user_id))
+            .outerjoin(Disease.__table__, Disease.id == atype1.c.disease_id)
+        ).order_by(answer.c.question_id, answer.c.user_id)
+        answers_schema = pa.schema([
+            ("question_id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("surveyresult_id", pa.int64()),
+            ("type", pa.int8()),
+            ("disease_id", pa.int64()),
+            ("disease_token", token),
+            ("certainty", pa.int8()),
+            ("invalid", pa.bool_()),
+            ("winner_id", pa.int64()),
+            ("loser_id", pa.int64())
+        ])
+
+        # answers to type 1 questions repeated in control surveys, kept apart from the regular survey answers
+        control = ControlAnswer.__table__
+        control_answers = select(
+            control.c.question_id, control.c.user_id, control.c.surveyresult_id, control.c.disease_id, Disease.token,
+            control.c.certainty, control.c.invalid
+        ).select_from(
+            control.outerjoin(Disease.__table__, Disease.id == control.c.disease_id)
+        ).order_by(control.c.question_id, control.c.user_id)
+        control_answers_schema = pa.schema([
+            ("question_id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("surveyresult_id", pa.int64()),
+            ("disease_id", pa.int64()),
+            ("disease_token", token),
+            ("certainty", pa.int8()),
+            ("invalid", pa.bool_())
+        ])
+
+        # question json is left out, it is large and not needed for analysis
+        questions = select(
+            Question.__table__.c.id, Question.__table__.c.type, Question.__table__.c.created_at,
+            Question.__table__.c.regular_survey_id, Question.__table__.c.control_survey_id,
+            QuestionType1.__table__.c.image_id, QuestionType2.__table__.c.group
+        ).select_from(
+            Question.__table__
+            .outerjoin(QuestionType1.__table__, QuestionType1.__table__.c.id == Question.__table__.c.id)
+            .outerjoin(QuestionType2.__table__, QuestionType2.__table__.c.id == Question.__table__.c.id)
+        ).order_by(Question.__table__.c.id)
+        questions_schema = pa.schema([
+            ("id", pa.int64()),
+            ("type", pa.int8()),
+            ("created_at", pa.timestamp("us")),
+            ("regular_survey_id", pa.int64()),
+            ("control_survey_id", pa.int64()),
+            ("image_id", pa.int64()),
+            ("group", pa.int64())
+        ])
+
+        images = select(
+            Image.__table__.c.id, Image.__table__.c.filename, Image.__table__.c.dataset, Image.__table__.c.group_id,
+            Image.__table__.c.type, Image.__table__.c.root
+        ).order_by(Image.__table__.c.id)
+        images_schema = pa.schema([
+            ("id", pa.int64()),
+            ("filename", pa.string()),
+            ("dataset", token),
+            ("group_id", pa.int64()),
+            ("type", token),
+            ("root", token)
+        ])
+
+        diseases = select(Disease.__table__.c.id, Disease.__table__.c.name, Disease.__table__.c.token) \
+            .order_by(Disease.__table__.c.id)
+        diseases_schema = pa.schema([
+            ("id", pa.int64()),
+            ("name", pa.string()),
+            ("token", pa.string())
+        ])
+
+        survey_results = select(
+            SurveyResult.__table__.c.id, SurveyResult.__table__.c.survey_id, SurveyResult.__table__.c.user_id,
+            SurveyResult.__table__.c.date
+        ).order_by(SurveyResult.__table__.c.id)
+        survey_results_schema = pa.schema([
+            ("id", pa.int64()),
+            ("survey_id", pa.int64()),
+            ("user_id", pa.int64()),
+            ("date", pa.date32())
+        ])
+
+        return [
+            ("answers", answers, answers_schema),
+            ("control_answers", control_answers, control_answers_schema),
+            ("questions", questions, questions_schema),
+            ("images", images, images_schema),
+            ("diseases", diseases, diseases_schema),
+            ("survey_results", survey_results, survey_results_schema)
+        ]
+
+    @staticmethod
+    def export(where, batch_size=None, compression="zstd"):
+        """
+        Writes answers.parquet, control_answers.parquet, questions.parquet, images.parquet, diseases.parquet and
+        survey_results.parquet to the export directory.
+
+        :param where: Export directory.
+        :param batch_size: Number of rows per record batch, `ParquetExport.batch_size` if not given.
+        :param compression: Parquet compression codec.
+        :return: None
+        """
+        # imported here so that pyarrow is required only when exporting to parquet
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            logger.error("Exporting to parquet requires pyarrow, install it with `pip install pyarrow`.")
+            raise
+
+        if batch_size is None:
+            batch_size = ParquetExport.batch_size
+        Path(where).mkdir(parents=True, exist_ok=True)
+
+        for name, statement, schema in ParquetExport._get_tables(pa):
+            filepath = Path(where) / f"{name}.parquet"
+            n_rows = 0
+            with pq.ParquetWriter(filepath, schema, compression=compression) as writer:
+                result = session.execute(statement.execution_options(yield_per=batch_size))
+                for rows in result.partitions():
+                    columns = list(zip(*rows))
+                    arrays = [ParquetExport._to_array(pa, column, field.type) for column, field in zip(columns, schema)]
+                    writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+                    n_rows += len(rows)
+            logger.info(f"Exported {n_rows} rows to {filepath}.")
+
+    @staticmethod
+    def _to_array(pa, values, data_type):
+        if pa.types.is_dictionary(data_type):
+            return pa.array(values, type=data_type.value_type).dictionary_encode()
+        return pa.array(values, type=data_type)
@@ -0,0 +1,85 @@
+import os
+import zlib
+
+from sqlalchemy import LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+from utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# codec used to compress new values, `zlib` or `zstd`, values compressed with either codec can always be read
+TEXT_COMPRESSION_ENV = "SURVEY_TEXT_COMPRESSION"
+
+# compressed values start with a null byte, which never starts a utf-8 encoded json, followed by the codec tag
+ZLIB_HEADER = b"\x00Z"
+ZSTD_HEADER = b"\x00S"
+
+
+def _get_zstd():
+    # imported here so that zstandard is required only when the zstd codec is used
+    try:
+        import zstandard
+    except ImportError:
+        logger.error("Compressing text with zstd requires zstandard, install it with `pip install zstandard`.")
+        raise
+    return zstandard
+
+
+def compress_text(text, codec=None):
+    """
+    Compresses utf-8 bytes of the text.
+
+    :param text: A string.
+    :param codec: `zlib` or `zstd`, the SURVEY_TEXT_COMPRESSION environment variable or `zlib` by default.
+    :return: Compressed bytes prefixed with a header identifying the codec.
+    """
+    if codec is None:
+        codec = os.environ.get(TEXT_COMPRESSION_ENV, "zlib")
+    data = text.encode("utf-8")
+    if codec == "zlib":
+        return ZLIB_HEADER + zlib.compress(data, 6)
+    elif codec == "zstd":
+        return ZSTD_HEADER + _get_zstd().ZstdCompressor(level=9).compress(data)
+    logger.error(f"Unknown text compression codec '{codec}'. Supported codecs are zlib and zstd.")
+    raise ValueError(f"Unknown text compression codec '{codec}'. Supported codecs are zlib and zstd.")
+
+
+def decompress_text(value):
+    """
+    Reverses `compress_text`. Plain strings and utf-8 bytes without a codec header, e.g. values stored before the
+    column was compressed, are returned as they are.
+
+    :param value: Bytes or a string.
+    :return: A string.
+    """
+    if isinstance(value, str):
+        return value
+    value = bytes(value)
+    if value.startswith(ZLIB_HEADER):
+        return zlib.decompress(value[len(ZLIB_HEADER):]).decode("utf-8")
+    elif value.startswith(ZSTD_HEADER):
+        return _get_zstd().ZstdDecompressor().decompress(value[len(ZSTD_HEADER):]).decode("utf-8")
+    return value.decode("utf-8")
+
+
+class CompressedText(TypeDecorator):
+    """
+    Text column stored compressed as binary. Values are compressed when written and decompressed when loaded, so the
+    mapped attribute is an ordinary string. Should be combined with `deferred` for large values, so they are loaded
+    and decompressed only when the attribute is accessed.
+    """
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress_text(value)
@@ -1,18 +1,363 @@
-from sqlalchemy import create_engine
+import importlib
+import io
+import os
+import uuid
+
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, inspect, insert, select, text, make_url
+from sqlalchemy.sql import table as table_clause, column as column_clause
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import sessionmaker, scoped_session
 from pathlib import Path
 
+from utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
 
 DATABASE_PATH = str(Path('../database/survey.db?charset=utf8').resolve())
 
-SQLALCHEMY_CONN_STRING = 'sqlite:///' + DATABASE_PATH
+# the database url and the sqlite profile can be set with these environment variables or with the --database and
+# --sqlite_profile command line options
+DATABASE_URL_ENV = "SURVEY_DATABASE_URL"
+SQLITE_PROFILE_ENV = "SURVEY_SQLITE_PROFILE"
+
+SQLALCHEMY_CONN_STRING = os.environ.get(DATABASE_URL_ENV, 'sqlite:///' + DATABASE_PATH)
+
+# pragmas applied to every new sqlite connection
+#   safe - sqlite defaults, rollback journal and a full sync on every commit
+#   fast - write-ahead log, which is synced only at checkpoints, a 64 MB page cache and memory mapped reads; a commit
+#          may be lost on power failure, but the database is never corrupted
+#   bulk - for large imports, does not wait for the data to reach the disk at all, an OS crash can corrupt the database
+SQLITE_PROFILES = {
+    "safe": {},
+    "fast": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -64 * 1024,
+        "mmap_size": 256 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON"
+    },
+    "bulk": {
+        "journal_mode": "WAL",
+        "synchronous": "OFF",
+        "cache_size": -256 * 1024,
+        "mmap_size": 1024 * 1024 * 1024,
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON"
+    }
+}
+
+SQLITE_PROFILE = os.environ.get(SQLITE_PROFILE_ENV, "fast")
+
+# connection pool of a postgresql engine, shared by all threads of a process; forked worker processes start with
+# their own pool, see `init_worker`
+POSTGRES_POOL_SIZE = 10
+POSTGRES_MAX_OVERFLOW = 10
+
+# upserts and inserts of at least this many rows are loaded into postgresql with COPY
+COPY_THRESHOLD = 1000
+
+# modules declaring mapped tables, imported by `load_models` before the schema is created; model.user and model.survey
+# go first because other models refer to their classes by name
+MODEL_MODULES = ["model.user", "model.survey", "model.disease", "model.image", "model.question", "model.answer",
+                 "model.results", "model.stats", "model.consistency", "utils.migrations"]
 
 # SQLAlchemy root class for ORM mapping, all classess that should be mapped must inherit this class
 Base = declarative_base()
 
+
+def _create_engine(url, sqlite_profile):
+    if sqlite_profile not in SQLITE_PROFILES:
+        logger.error(f"Unknown sqlite profile '{sqlite_profile}'. Supported profiles are {list(SQLITE_PROFILES)}.")
+        raise ValueError(f"Unknown sqlite profile '{sqlite_profile}'. Supported profiles are "
+                         f"{list(SQLITE_PROFILES)}.")
+    url = make_url(url)
+    if url.get_backend_name() == "postgresql":
+        options = {"pool_size": POSTGRES_POOL_SIZE, "max_overflow": POSTGRES_MAX_OVERFLOW, "pool_pre_ping": True}
+        if url.get_driver_name() == "psycopg2":
+            # multi row VALUES for inserts and batched statements for updates issued by ORM flushes
+            options["executemany_mode"] = "values_plus_batch"
+        new_engine = create_engine(url, **options)
+    else:
+        new_engine = create_engine(url)
+    if new_engine.dialect.name == "sqlite":
+        pragmas = SQLITE_PROFILES[sqlite_profile]
+
+        @event.listens_for(new_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+            cursor.close()
+    return new_engine
+
+
 # SQLAlchemy engine for database manipulations
-engine = create_engine(SQLALCHEMY_CONN_STRING)
+engine = _create_engine(SQLALCHEMY_CONN_STRING, SQLITE_PROFILE)
+
+# creates new sessions, objects loaded by a session are not expired on commit, so they can be used after a commit
+# without reloading them from the database
+SessionFactory = sessionmaker(bind=engine, expire_on_commit=False)
+
+# application session used by helpers when no session is given, each thread gets its own session
+session = scoped_session(SessionFactory)
+
+# engine whose database schema was verified by `create_schema`
+_schema_engine = None
+
+
+def get_session(uow=None):
+    """
+    Returns the given unit of work session or the application session if None, helpers use it to resolve their
+    `session` parameter.
+    """
+    return session if uow is None else uow
+
+
+def commit(target):
+    """
+    Commits changes made by a helper to the application session. A unit of work session given to the helper is only
+    flushed, so new objects get their ids, and is committed by the unit of work when its block ends.
+
+    :param target: Session resolved by `get_session`.
+    :return: None
+    """
+    if target is session:
+        target.commit()
+    else:
+        target.flush()
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Opens a new session for a unit of work. The session is committed when the block ends, rolled back if an exception
+    is raised and closed in both cases, so objects loaded within the block are released. Pass it to helpers through
+    their `session` parameter, helpers given a unit of work do not commit it, see `commit`:
+
+        with unit_of_work() as uow:
+            images = Images.get_all(session=uow)
+
+    :return: A context manager yielding a new session.
+    """
+    new_session = SessionFactory()
+    try:
+        yield new_session
+        new_session.commit()
+    except:
+        new_session.rollback()
+        raise
+    finally:
+        new_session.close()
+
+
+@contextmanager
+def query_budget(max_queries=None, name="block", count_inserts=True):
+    """
+    Counts SQL statements executed by the application engine within the block, e.g. to check that a stage does not
+    issue a query per object. Raises a RuntimeError when the block ends if more than `max_queries` statements were
+    executed:
+
+        with query_budget(10, "survey export") as budget:
+            export_surveys(...)
+        print(budget["queries"])
+
+    :param max_queries: Maximum number of statements, not checked if None.
+    :param name: Name of the block used in the error message.
+    :param count_inserts: If False, INSERT statements are counted separately under `inserts` and not checked, e.g.
+        for blocks adding ORM objects, which sqlite inserts one row per statement.
+    :return: A context manager yielding a dictionary with the number of executed statements under `queries`.
+    """
+    budget = {"queries": 0, "inserts": 0}
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        if not count_inserts and statement.lstrip()[:6].upper() == "INSERT":
+            budget["inserts"] += 1
+        else:
+            budget["queries"] += 1
+
+    bind = session.get_bind()
+    event.listen(bind, "before_cursor_execute", count)
+    try:
+        yield budget
+    finally:
+        event.remove(bind, "before_cursor_execute", count)
+    if max_queries is not None and budget["queries"] > max_queries:
+        logger.error(f"{name} executed {budget['queries']} queries, more than its budget of {max_queries}.")
+        raise RuntimeError(f"{name} executed {budget['queries']} queries, more than its budget of {max_queries}.")
+
+
+def init_worker():
+    """
+    Initializer for worker processes forked from a process that already used the database. Connections inherited from
+    the parent must not be used or closed by the child, so the pool is replaced without closing them and the child
+    starts with a fresh application session. Sessions opened by the worker, e.g. with `unit_of_work`, connect anew.
+
+    :return: None
+    """
+    engine.dispose(close=False)
+    session.registry.clear()
+
+
+def configure(url=None, sqlite_profile=None):
+    """
+    Replaces the engine with one connected to another database or using another sqlite profile. The application
+    session is closed and sessions created afterwards are bound to the new engine. Must be called before the database
+    is used, e.g. when parsing command line options.
+
+    :param url: SQLAlchemy database url, the current one if not given.
+    :param sqlite_profile: Name of a profile from SQLITE_PROFILES, the current one if not given. Ignored for databases
+        other than sqlite.
+    :return: None
+    """
+    global engine, SQLALCHEMY_CONN_STRING, SQLITE_PROFILE
+    SQLALCHEMY_CONN_STRING = url or SQLALCHEMY_CONN_STRING
+    SQLITE_PROFILE = sqlite_profile or SQLITE_PROFILE
+    new_engine = _create_engine(SQLALCHEMY_CONN_STRING, SQLITE_PROFILE)
+    session.remove()
+    engine.dispose()
+    engine = new_engine
+    SessionFactory.configure(bind=engine)
+
+
+def load_models():
+    """
+    Imports all modules declaring mapped tables, so that the metadata knows every table of the schema.
+
+    :return: None
+    """
+    for name in MODEL_MODULES:
+        importlib.import_module(name)
+
+
+def create_schema():
+    """
+    Creates missing tables. A new database is created with the latest schema and marked as such, tables of an existing
+    database are changed only by migrations, see `utils.migrations`. The schema is verified once per engine, further
+    calls return immediately, and a database that already has all tables costs a single query.
+
+    :return: None
+    """
+    global _schema_engine
+    if _schema_engine is engine:
+        return
+    load_models()
+    from utils.migrations import Migrations
+
+    existing = set(inspect(engine).get_table_names())
+    if not set(Base.metadata.tables).issubset(existing):
+        Base.metadata.create_all(engine)
+        if len(existing) == 0:
+            Migrations.stamp()
+    _schema_engine = engine
+
+
+def upsert(table, rows, index_elements, update_columns=None, accumulate=False, session=None):
+    """
+    Inserts rows into a table in bulk, using INSERT ... ON CONFLICT semantics for rows that collide with existing ones
+    on `index_elements`. Colliding rows are updated with values of `update_columns` or skipped if no columns to update
+    are given. Executed within the current session transaction.
+
+    On postgresql, at least COPY_THRESHOLD rows are copied to a temporary table first and upserted from there with a
+    single INSERT ... SELECT. Rows must not collide with each other.
+
+    :param table: SQLAlchemy Table object.
+    :param rows: A list of dictionaries mapping column names to values.
+    :param index_elements: Names of columns forming the primary key or unique constraint rows may collide on.
+    :param update_columns: Names of columns updated on collision.
+    :param accumulate: If True, values of `update_columns` are added to the values of the colliding row instead of
+        replacing them, e.g. to maintain counters.
+    :param session: Session to use, the application session by default.
+    :return: None
+    """
+    if len(rows) == 0:
+        return
+    session = get_session(session)
+    if session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+
+    staging = None
+    if len(rows) >= COPY_THRESHOLD and _can_copy(session):
+        columns = list(rows[0])
+        # a unique name, so upserts into the same table by other code in the transaction do not collide, and the table
+        # is dropped with the transaction if the upsert fails
+        staging = table_clause(f"{table.name}_staging_{uuid.uuid4().hex[:12]}",
+                               *[column_clause(name) for name in columns])
+        session.execute(text(f'CREATE TEMPORARY TABLE "{staging.name}" (LIKE "{table.name}" INCLUDING DEFAULTS) '
+                             f'ON COMMIT DROP'))
+        copy_rows(staging, rows, session=session)
+        statement = dialect_insert(table).from_select(columns, select(*staging.c))
+    else:
+        statement = dialect_insert(table)
+    if update_columns:
+        # excluded columns are generated on every access of `statement.excluded`
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: table.c[column] + excluded[column] if accumulate else excluded[column]
+                  for column in update_columns}
+        )
+    else:
+        statement = statement.on_conflict_do_nothing(index_elements=index_elements)
+    if staging is None:
+        session.execute(statement, rows)
+    else:
+        session.execute(statement)
+        session.execute(text(f'DROP TABLE "{staging.name}"'))
+
+
+def _can_copy(target):
+    """
+    Whether the session is bound to postgresql through psycopg2, which can load rows with COPY.
+    """
+    bind = target.get_bind()
+    return bind.dialect.name == "postgresql" and bind.dialect.driver == "psycopg2"
+
+
+def _copy_value(value):
+    # postgresql COPY text format: tab separated values, \N for NULL and backslash escapes
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+def copy_rows(table, rows, session=None):
+    """
+    Inserts rows into a table in bulk within the current session transaction. On postgresql the rows are streamed with
+    COPY, which skips parsing and planning an INSERT statement per row, elsewhere they are inserted with a single
+    executemany INSERT. Unlike `upsert`, rows must not collide with existing ones and generated values like ids are
+    not returned.
+
+    :param table: SQLAlchemy Table object.
+    :param rows: A list of dictionaries mapping column names to values, all with the same keys.
+    :param session: Session to use, the application session by default.
+    :return: None
+    """
+    if len(rows) == 0:
+        return
+    session = get_session(session)
+    if not _can_copy(session):
+        session.execute(insert(table), rows)
+        return
 
-# this session should be used through all application to issue database commands
-session = Session(bind=engine)
\ No newline at end of file
+    columns = list(rows[0])
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_value(row[name]) for name in columns))
+        buffer.write("\n")
+    buffer.seek(0)
+    column_names = ", ".join(f'"{name}"' for name in columns)
+    cursor = session.connection().connection.dbapi_connection.cursor()
+    try:
+        cursor.copy_expert(f'COPY "{table.name}" ({column_names}) FROM STDIN', buffer)
+    finally:
+        cursor.close()
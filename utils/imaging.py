@@ -0,0 +1,133 @@
+import base64
+import hashlib
+import io
+import os
+import regex as re
+
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# directory where optimized images are cached between exports
+IMAGE_CACHE_DIR = "./cache/images"
+
+# matches base64 encoded images inlined into the question json, e.g. data:image/png;base64,iVBORw0K...
+DATA_URI_RE = re.compile(r"data:image/(png|webp|jpeg);base64,([A-Za-z0-9+/=]+)")
+
+
+def optimize_image(source, size, image_format="png", cache_dir=IMAGE_CACHE_DIR):
+    """
+    Downscales an image so that it fits into `size` and encodes it into the `image_format`. Images smaller than `size`
+    are never upscaled. The result is cached on disk under a key built from the source image hash, the target size and
+    the target format, so the same image is processed only once across all exports.
+
+    :param source: Raw image bytes or a path to the image file.
+    :param size: A tuple (width, height) of the bounding box the image should fit into.
+    :param image_format: Target image format, `png` or `webp`.
+    :param cache_dir: A directory where optimized images are cached. If None, caching is disabled.
+    :return: Optimized image bytes.
+    """
+    if not isinstance(source, bytes):
+        with open(source, "rb") as f:
+            source = f.read()
+
+    width, height = size
+    cache_path = None
+    if cache_dir is not None:
+        key = hashlib.sha256(source).hexdigest()
+        cache_path = Path(cache_dir) / key[:2] / f"{key}-{width}x{height}.{image_format}"
+        if cache_path.exists():
+            return cache_path.read_bytes()
+
+    # imported here so that pillow is required only when images are actually optimized
+    from PIL import Image as PILImage
+
+    image = PILImage.open(io.BytesIO(source))
+    image.thumbnail((width, height), PILImage.LANCZOS)
+    buffer = io.BytesIO()
+    if image_format == "webp":
+        # segmentation masks are binary, lossless compression keeps them sharp and is smaller than lossy anyway
+        image.save(buffer, format="WEBP", lossless=image.mode in ("1", "L"), quality=85, method=4)
+    else:
+        image.save(buffer, format="PNG", optimize=True)
+    optimized = buffer.getvalue()
+
+    if cache_path is not None:
+        # write to a temporary file first, several workers can produce the same image at once
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(optimized)
+        os.replace(tmp_path, cache_path)
+    return optimized
+
+
+def _optimize_job(job):
+    source, size, image_format, cache_dir = job
+    return optimize_image(source, size, image_format=image_format, cache_dir=cache_dir)
+
+
+class ImageOptimizer:
+    """
+    Resizes and transcodes survey images in a pool of worker processes. Should be used as a context manager so that
+    the worker pool is shut down when the export finishes.
+    """
+
+    supported_formats = ["png", "webp"]
+
+    def __init__(self, image_format="png", workers=None, cache_dir=IMAGE_CACHE_DIR):
+        image_format = image_format.lower()
+        if image_format not in ImageOptimizer.supported_formats:
+            logger.error(f"Cannot optimize images to '{image_format}'. Supported formats are "
+                         f"{ImageOptimizer.supported_formats}.")
+            raise ValueError(f"Cannot optimize images to '{image_format}'. Supported formats are "
+                             f"{ImageOptimizer.supported_formats}.")
+        self.image_format = image_format
+        self.workers = workers
+        self.cache_dir = cache_dir
+        self._executor = None
+
+    def __enter__(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._executor.shutdown()
+        self._executor = None
+
+    @property
+    def extension(self):
+        return "." + self.image_format
+
+    def optimize_all(self, sources, size):
+        """
+        Optimizes all images from `sources` in parallel.
+
+        :param sources: A list of raw image bytes or image paths.
+        :param size: A tuple (width, height) all images should fit into.
+        :return: A list of optimized image bytes, in the same order as `sources`.
+        """
+        jobs = [(source, size, self.image_format, self.cache_dir) for source in sources]
+        if self._executor is None:
+            return [_optimize_job(job) for job in jobs]
+        return list(self._executor.map(_optimize_job, jobs, chunksize=max(1, len(jobs) // 64)))
+
+    def optimize_data_uris(self, text, size):
+        """
+        Replaces every base64 encoded image inlined into the `text` with its optimized version.
+
+        :param text: A survey or question json string.
+        :param size: A tuple (width, height) all images should fit into.
+        :return: A json string with optimized inline images.
+        """
+        payloads = list(dict.fromkeys(match.group(2) for match in DATA_URI_RE.finditer(text)))
+        optimized = self.optimize_all([base64.b64decode(payload) for payload in payloads], size)
+        replacements = {
+            payload: f"data:image/{self.image_format};base64," + base64.b64encode(image).decode("utf-8")
+            for payload, image in zip(payloads, optimized)
+        }
+        return DATA_URI_RE.sub(lambda match: replacements[match.group(2)], text)
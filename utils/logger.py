@@ -1,23 +1,167 @@
+import atexit
+import json
 import logging
-import datetime
+import os
+import queue
 
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from pathlib import Path
 
-LOG_FILE_PATH = "./logs/app-{}.log".format(str(datetime.datetime.utcnow()))
-if not Path(LOG_FILE_PATH).parent.exists():
-    Path(LOG_FILE_PATH).parent.mkdir(parents=True)
 
-# Create a custom logger
-logger = logging.getLogger(__name__)
+# name of the application logger, loggers of modules are its children named `survey.<module>`, see `get_logger`
+LOGGER_NAME = "survey"
 
-# Create handlers
+# log levels can be set with this environment variable or with the --log_level command line option, see `set_levels`
+LOG_LEVEL_ENV = "SURVEY_LOG_LEVEL"
+DEFAULT_LOG_LEVEL = "INFO"
+
+# log records are written as json lines to a file per process, named by the utc start time and the process id, in a
+# directory set with this environment variable or with the --log_dir command line option, see `set_log_directory`
+LOG_DIR_ENV = "SURVEY_LOG_DIR"
+DEFAULT_LOG_DIR = "logs"
+LOG_FILE_NAME = "app-{}-{}.jsonl".format(datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ"), os.getpid())
+
+# per item messages, e.g. one per question, are logged the first SAMPLE_FIRST times and then every SAMPLE_EVERY-th time
+SAMPLE_FIRST = 10
+SAMPLE_EVERY = 100
+
+# pass as `extra` of a per item message to sample it, e.g. logger.debug("Added question %s.", id, extra=PER_ITEM)
+PER_ITEM = {"per_item": True}
+
+# attributes of every log record, the remaining attributes come from `extra` and are written to json records as well
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class DelayedFileHandler(logging.FileHandler):
+    """
+    File handler that creates the log directory and file when the first record is logged, so that commands which log
+    nothing, e.g. `main.py --help`, do not touch the disk.
+    """
+    def __init__(self, filename):
+        super().__init__(filename, delay=True)
+
+    def _open(self):
+        Path(self.baseFilename).parent.mkdir(parents=True, exist_ok=True)
+        return super()._open()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats a record as a single line json object with its time, level, logger, message and `extra` attributes.
+    """
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "process": record.process
+        }
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes records of a per item message, i.e. logged with `extra=PER_ITEM`, the first SAMPLE_FIRST times and then
+    every SAMPLE_EVERY-th time. Records are counted per logger and message template, a passed record gets the count
+    as its `occurrence` attribute. Other records always pass.
+    """
+    def __init__(self):
+        super().__init__()
+        self.counts = dict()
+
+    def filter(self, record):
+        if not getattr(record, "per_item", False):
+            return True
+        key = (record.name, record.msg)
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        record.occurrence = count
+        return count <= SAMPLE_FIRST or count % SAMPLE_EVERY == 0
+
+
+class _DirectQueue:
+    """
+    Stands in for the queue of the queue handler in forked processes, which do not run the listener thread, and hands
+    records to the handlers at once.
+    """
+    def put_nowait(self, record):
+        listener.handle(record)
+
+
+def get_logger(name):
+    """
+    Returns the logger of a module, e.g. `logger = get_logger(__name__)`. Its level can be set per subsystem, e.g. for
+    all generators with `generators=DEBUG`, see `set_levels`.
+
+    :param name: Module name.
+    :return: A logger named `survey.<name>`.
+    """
+    return logging.getLogger(f"{LOGGER_NAME}.{name}")
+
+
+def set_levels(levels):
+    """
+    Sets log levels of the application and its subsystems.
+
+    :param levels: Comma separated levels, a level without a subsystem applies to the whole application, e.g.
+        `INFO,generators=DEBUG,model.results=WARNING`.
+    :return: None
+    """
+    parsed = list()
+    for item in levels.split(","):
+        name, _, level = item.strip().rpartition("=")
+        level = level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            # not logged, the levels are usually a command line option and logging the error would create a log file
+            raise ValueError(f"Unknown log level '{level}' in '{levels}'.")
+        parsed.append((get_logger(name.strip()) if name.strip() else logger, level))
+    for target, level in parsed:
+        target.setLevel(level)
+
+
+def set_log_directory(directory):
+    """
+    Moves the log file of the process to another directory, or turns logging to a file off. Records already written
+    stay in the previous file.
+
+    :param directory: Directory of the log file, relative to the working directory or absolute. If None, records are
+        logged only to the console.
+    :return: None
+    """
+    file_handler.acquire()
+    try:
+        if file_handler.stream is not None:
+            file_handler.stream.close()
+            file_handler.stream = None
+        if directory is not None:
+            file_handler.baseFilename = os.path.abspath(Path(directory) / LOG_FILE_NAME)
+    finally:
+        file_handler.release()
+    listener.handlers = (console_handler,) if directory is None else (console_handler, file_handler)
+
+
+# application logger, modules log to its children, see `get_logger`
+logger = logging.getLogger(LOGGER_NAME)
+
+# records are formatted and written by a background thread, so logging in loops does not wait for the disk
 console_handler = logging.StreamHandler()
-# console_handler.setLevel(logging.DEBUG)
 
-file_handler = logging.FileHandler(LOG_FILE_PATH)
-# file_handler.setLevel(logging.DEBUG)
+file_handler = DelayedFileHandler(Path(os.environ.get(LOG_DIR_ENV, DEFAULT_LOG_DIR)) / LOG_FILE_NAME)
+file_handler.setFormatter(JsonFormatter())
+
+listener = QueueListener(queue.SimpleQueue(), console_handler, file_handler, respect_handler_level=True)
+queue_handler = QueueHandler(listener.queue)
+queue_handler.addFilter(SamplingFilter())
 
-logger.addHandler(console_handler)
-logger.addHandler(file_handler)
+logger.addHandler(queue_handler)
+set_levels(os.environ.get(LOG_LEVEL_ENV, DEFAULT_LOG_LEVEL))
 
-logger.setLevel(logging.DEBUG)
+listener.start()
+# the listener writes remaining records when the process exits
+atexit.register(listener.stop)
+os.register_at_fork(after_in_child=lambda: setattr(queue_handler, "queue", _DirectQueue()))
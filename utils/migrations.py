@@ -0,0 +1,288 @@
+from datetime import datetime
+from sqlalchemy import Column, Integer, String, DateTime, LargeBinary, select, insert, update, func, and_, cast, \
+    inspect, bindparam
+
+from utils.database import Base, session
+from utils.logger import get_logger, PER_ITEM
+from model.consistency import RaterConsistency
+from model.disease import association_table
+from model.image import Image, image_qtype2
+from model.question import Question, QuestionType2
+from model.survey import Survey
+from model.user import User
+
+
+logger = get_logger(__name__)
+
+
+class SchemaVersion(Base):
+    """
+    Migrations applied to the database, the highest version is the current version of the schema.
+    """
+    __tablename__ = "schema_version"
+
+    version     = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at  = Column(DateTime, nullable=False)
+
+
+def _add_answer_indexes(connection):
+    Migrations.create_indexes(connection, "ix_answer_user_id", "ix_answer_surveyresult_id", "ix_qtype1_image_id",
+                              "ix_image_qtype2_image_id")
+
+
+def _add_generator_indexes(connection):
+    Migrations.create_indexes(connection, "ix_question_type", "ix_question_regular_survey_id",
+                              "ix_question_control_survey_id", "ix_qtype2_group", "ix_image_group_id",
+                              "ix_image_type", "ix_user_access_token", "ix_image_qtype2_question_id",
+                              "ix_image_disease_image_id", "ix_image_disease_disease_id")
+
+
+def _compress_text_columns(connection):
+    before = Migrations.get_text_sizes(connection)
+    for table in (Question.__table__, Survey.__table__):
+        json_type = next(c["type"] for c in inspect(connection).get_columns(table.name) if c["name"] == "json")
+        if connection.dialect.name == "postgresql" and not isinstance(json_type, LargeBinary):
+            # existing utf-8 text is kept as is, values without a codec header are read as plain text
+            connection.exec_driver_sql(f"ALTER TABLE {table.name} ALTER COLUMN json TYPE BYTEA "
+                                       f"USING convert_to(json, 'UTF8')")
+        last_id = 0
+        while True:
+            statement = select(table.c.id, table.c.json).where(table.c.id > last_id).order_by(table.c.id) \
+                .limit(Migrations.batch_size)
+            if connection.dialect.name == "sqlite":
+                # sqlite keeps the storage class of every value, compressed values are blobs
+                statement = statement.where(func.typeof(table.c.json) == "text")
+            rows = connection.execute(statement).all()
+            if len(rows) == 0:
+                break
+            connection.execute(
+                update(table).where(table.c.id == bindparam("row_id")).values(json=bindparam("row_json")),
+                [{"row_id": row_id, "row_json": row_json} for row_id, row_json in rows]
+            )
+            last_id = rows[-1][0]
+            logger.info("Compressed %s json up to id %s.", table.name, last_id, extra=PER_ITEM)
+    after = Migrations.get_text_sizes(connection)
+    for table_name in before:
+        logger.info(f"{table_name} json: {before[table_name]} bytes before compression, {after[table_name]} bytes "
+                    f"after compression. Run `main.py db vacuum` to shrink the database file.")
+
+
+def _add_certainty_diff_sums(connection):
+    table = RaterConsistency.__table__
+    columns = {column["name"] for column in inspect(connection).get_columns(table.name)}
+    if "t1_certainty_diff_sum" not in columns:
+        connection.exec_driver_sql(f"ALTER TABLE {table.name} ADD COLUMN t1_certainty_diff_sum FLOAT NOT NULL "
+                                   f"DEFAULT 0")
+    # the mean certainty difference was computed over all repeated answers
+    connection.execute(update(table).values(
+        t1_certainty_diff_sum=func.coalesce(table.c.t1_certainty_diff, 0) * table.c.t1_repeated))
+
+
+class Migrations:
+    """
+    Versioned schema migrations. Tables missing in the database are created by `create_schema` before a command uses
+    the database, migrations change tables that already exist, e.g. add indexes to databases created by older versions.
+    Every migration runs in its own transaction together with recording its version, so an interrupted upgrade can
+    simply be run again.
+
+    New migrations are appended to `migrations` with the next version number and must not remove data.
+    """
+
+    # list of (version, description, function applying the migration to a connection)
+    migrations = [
+        (1, "Index answers by user and survey result, and questions by image", _add_answer_indexes),
+        (2, "Index columns filtered when generating surveys and looking up users", _add_generator_indexes),
+        (3, "Compress question and survey json", _compress_text_columns),
+        (4, "Sum certainty differences of raters, so consistency counters can be updated per batch",
+         _add_certainty_diff_sums)
+    ]
+
+    # number of rows rewritten at once by data migrations
+    batch_size = 200
+
+    @staticmethod
+    def get_latest_version():
+        return max(version for version, _, _ in Migrations.migrations)
+
+    @staticmethod
+    def get_version(connection=None):
+        """
+        Returns the version of the database schema, 0 for databases created before migrations were introduced.
+
+        :param connection: Connection to use, a new one by default.
+        :return: An integer version.
+        """
+        if connection is None:
+            with session.get_bind().connect() as connection:
+                return Migrations.get_version(connection)
+        if not inspect(connection).has_table(SchemaVersion.__tablename__):
+            return 0
+        return connection.execute(select(func.coalesce(func.max(SchemaVersion.version), 0))).scalar_one()
+
+    @staticmethod
+    def create_indexes(connection, *names):
+        """
+        Creates indexes declared on mapped tables by their names, skipping the ones that already exist.
+
+        :param connection: Connection to use.
+        :param names: Index names.
+        :return: None
+        """
+        indexes = {index.name: index for table in Base.metadata.sorted_tables for index in table.indexes}
+        for name in names:
+            if name not in indexes:
+                logger.error(f"Cannot create index {name} because no mapped table declares it.")
+                raise KeyError(f"Cannot create index {name} because no mapped table declares it.")
+            indexes[name].create(bind=connection, checkfirst=True)
+
+    @staticmethod
+    def get_text_sizes(connection=None):
+        """
+        Returns the number of bytes stored in question and survey json columns.
+
+        :param connection: Connection to use, a new one by default.
+        :return: A dictionary mapping table name to the number of bytes.
+        """
+        if connection is None:
+            with session.get_bind().connect() as connection:
+                return Migrations.get_text_sizes(connection)
+        return {table.name: connection.execute(
+                    select(func.coalesce(func.sum(func.length(cast(table.c.json, LargeBinary))), 0))).scalar_one()
+                for table in (Question.__table__, Survey.__table__)}
+
+    @staticmethod
+    def get_database_size():
+        """
+        Returns the size of the sqlite database file and the size of its free pages, which are reused by new rows and
+        released to the file system only by `vacuum`.
+
+        :return: A tuple (file size, free size) in bytes, or None for other databases.
+        """
+        engine = session.get_bind()
+        if engine.dialect.name != "sqlite":
+            return None
+        with engine.connect() as connection:
+            page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+            page_count = connection.exec_driver_sql("PRAGMA page_count").scalar()
+            free_count = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        return page_size * page_count, page_size * free_count
+
+    @staticmethod
+    def vacuum():
+        """
+        Rebuilds the database file, e.g. to release space freed by compressing text columns.
+
+        :return: None
+        """
+        with session.get_bind().connect() as connection:
+            connection.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM")
+
+    @staticmethod
+    def stamp(version=None, connection=None):
+        """
+        Records migrations up to the version as applied without running them, e.g. for a new database whose tables
+        were created with the latest schema.
+
+        :param version: Version to stamp, the latest one by default.
+        :param connection: Connection to use, a new transaction by default.
+        :return: None
+        """
+        if connection is None:
+            with session.get_bind().begin() as connection:
+                return Migrations.stamp(version, connection)
+        if version is None:
+            version = Migrations.get_latest_version()
+        SchemaVersion.__table__.create(bind=connection, checkfirst=True)
+        current = Migrations.get_version(connection)
+        rows = [{"version": v, "description": description, "applied_at": datetime.now()}
+                for v, description, _ in Migrations.migrations if current < v <= version]
+        if len(rows) > 0:
+            connection.execute(insert(SchemaVersion.__table__), rows)
+
+    @staticmethod
+    def upgrade(target=None):
+        """
+        Applies pending migrations in order of their versions.
+
+        :param target: Version to upgrade to, the latest one by default.
+        :return: A list of applied versions.
+        """
+        if target is None:
+            target = Migrations.get_latest_version()
+        current = Migrations.get_version()
+        if target < current:
+            logger.error(f"Cannot upgrade the database to version {target} because it is already at version {current}.")
+            raise ValueError(f"Cannot upgrade the database to version {target} because it is already at version "
+                             f"{current}.")
+
+        applied = list()
+        for version, description, migrate in sorted(Migrations.migrations, key=lambda migration: migration[0]):
+            if not current < version <= target:
+                continue
+            logger.info(f"Applying migration {version}: {description}.")
+            with session.get_bind().begin() as connection:
+                migrate(connection)
+                Migrations.stamp(version, connection)
+            applied.append(version)
+        logger.info(f"Database schema is at version {Migrations.get_version()}.")
+        return applied
+
+    @staticmethod
+    def warn_pending():
+        """
+        Logs a warning if the database schema is older than the latest migration.
+
+        :return: None
+        """
+        current, latest = Migrations.get_version(), Migrations.get_latest_version()
+        if current < latest:
+            logger.warning(f"Database schema is at version {current}, the latest version is {latest}. Run "
+                           f"`main.py db upgrade` to apply pending migrations.")
+
+    @staticmethod
+    def _get_plan_queries():
+        """
+        Returns a list of (name, statement) for queries issued most often when generating surveys, looking up users and
+        loading images.
+        """
+        return [
+            ("unassigned questions", select(Question.id).where(and_(
+                Question.regular_survey_id == None, Question.control_survey_id == None, Question.type == 1))),
+            ("questions only in regular surveys", select(Question.id).where(and_(
+                Question.regular_survey_id != None, Question.control_survey_id == None, Question.type == 1))),
+            ("questions of a survey", select(Question.id).where(Question.regular_survey_id == 1)),
+            ("type 2 questions of an image group", select(QuestionType2.__table__.c.id)
+                .where(QuestionType2.__table__.c.group == 1)),
+            ("images of a type 2 question", select(image_qtype2.c.image_id).where(image_qtype2.c.question_id == 1)),
+            ("images of a group", select(Image.id).where(Image.group_id == 1)),
+            ("original images", select(Image.id).where(Image.type == "original")),
+            ("diseases of an image", select(association_table.c.disease_id).where(association_table.c.image_id == 1)),
+            ("user by access token", select(User.id).where(User.access_token == "token"))
+        ]
+
+    @staticmethod
+    def get_query_plans():
+        """
+        Explains the main generator queries with the database query planner.
+
+        :return: A list of dictionaries with `name` of the query, its `sql`, `plan` as a list of plan lines and
+            `full_scan`, True if the planner scans a whole table instead of using an index.
+        """
+        engine = session.get_bind()
+        dialect = engine.dialect.name
+        explain = "EXPLAIN QUERY PLAN" if dialect == "sqlite" else "EXPLAIN"
+        report = list()
+        with session.get_bind().connect() as connection:
+            for name, statement in Migrations._get_plan_queries():
+                sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True}))
+                rows = connection.exec_driver_sql(f"{explain} {sql}").all()
+                if dialect == "sqlite":
+                    # rows are (id, parent, unused, detail)
+                    plan = [row[-1] for row in rows]
+                    full_scan = any(line.startswith("SCAN") and "USING" not in line for line in plan)
+                else:
+                    plan = [row[0] for row in rows]
+                    full_scan = any("Seq Scan" in line for line in plan)
+                report.append({"name": name, "sql": sql, "plan": plan, "full_scan": full_scan})
+        return report
@@ -0,0 +1,213 @@
+import json
+import os
+import re
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# profilers that can record a chosen stage, see `enable`
+PROFILERS = ["cprofile", "pyinstrument"]
+
+# metrics file and recorded stages, profiling is off until `enable` is called
+_metrics_path = None
+_profile_stage = None
+_profiler = None
+_stages = list()
+_open_stages = list()
+
+# SQL statements executed by any engine of this process and their total duration in seconds
+_sql = {"statements": 0, "seconds": 0.0}
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("profiling_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    _sql["statements"] += 1
+    _sql["seconds"] += time.perf_counter() - connection.info["profiling_start"].pop()
+
+
+def _read_io():
+    """
+    Returns (bytes read, bytes written) by the process to storage, or (None, None) where /proc/self/io is unavailable.
+    """
+    try:
+        with open("/proc/self/io") as fin:
+            counters = dict(line.split(": ") for line in fin.read().splitlines())
+    except OSError:
+        return None, None
+    return int(counters["read_bytes"]), int(counters["write_bytes"])
+
+
+def _read_peak_rss():
+    """
+    Returns the peak resident set size of the process in bytes since it was last reset by `_reset_peak_rss`.
+    """
+    try:
+        with open("/proc/self/status") as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # peak of the whole process lifetime, kilobytes on linux and bytes on macos
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _reset_peak_rss():
+    # linux resets the peak resident set size reported as VmHWM when 5 is written to clear_refs
+    try:
+        with open("/proc/self/clear_refs", "w") as fout:
+            fout.write("5")
+    except OSError:
+        pass
+
+
+def _start_profiler():
+    if _profiler == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            logger.error("Profiling with pyinstrument requires pyinstrument, install it with `pip install "
+                         "pyinstrument`.")
+            raise
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, name):
+    filename = re.sub(r"[^\w.-]+", "-", name)
+    _metrics_path.parent.mkdir(parents=True, exist_ok=True)
+    if _profiler == "pyinstrument":
+        profiler.stop()
+        path = _metrics_path.with_name(f"{_metrics_path.stem}.{filename}.html")
+        path.write_text(profiler.output_html())
+    else:
+        profiler.disable()
+        path = _metrics_path.with_name(f"{_metrics_path.stem}.{filename}.prof")
+        profiler.dump_stats(path)
+    logger.info(f"Profile of stage '{name}' saved to {path}.")
+
+
+def enable(metrics_path, profile_stage=None, profiler="cprofile"):
+    """
+    Starts recording metrics of stages, see `stage`. SQL statements are counted for every engine, including engines
+    created later by `utils.database.configure`.
+
+    :param metrics_path: Json file to which `save` writes the metrics.
+    :param profile_stage: Name of a stage to profile, e.g. `generate surveys`. Every run of the stage is profiled.
+    :param profiler: `cprofile` saves the profile in pstats format next to the metrics file, `pyinstrument` saves an
+        html report and requires pyinstrument.
+    :return: None
+    """
+    global _metrics_path, _profile_stage, _profiler
+    if profiler not in PROFILERS:
+        logger.error(f"Unknown profiler '{profiler}'. Supported profilers are {PROFILERS}.")
+        raise ValueError(f"Unknown profiler '{profiler}'. Supported profilers are {PROFILERS}.")
+    _metrics_path, _profile_stage, _profiler = Path(metrics_path), profile_stage, profiler
+    if not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+
+@contextmanager
+def stage(name):
+    """
+    Records wall and CPU time, peak memory, SQL statements and storage IO of the block as a stage. Does nothing unless
+    profiling was enabled with `enable`, so stages may be marked in code that runs for every command:
+
+        with stage("insert questions"):
+            Questions.bulk_insert(questions)
+
+    Stages can be nested, an inner stage is recorded as `<outer name>/<inner name>`.
+
+    :param name: Name of the stage.
+    :return: A context manager.
+    """
+    if _metrics_path is None:
+        yield
+        return
+
+    if len(_open_stages) > 0:
+        # resetting the peak below loses the peak of the enclosing stage so far
+        _open_stages[-1]["peak_rss"] = max(_open_stages[-1]["peak_rss"], _read_peak_rss())
+        name = f"{_open_stages[-1]['name']}/{name}"
+    _reset_peak_rss()
+    read_bytes, write_bytes = _read_io()
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    record = {"name": name, "peak_rss": 0}
+    _open_stages.append(record)
+    profiler = _start_profiler() if name == _profile_stage else None
+    sql_statements, sql_seconds = _sql["statements"], _sql["seconds"]
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        if profiler is not None:
+            _stop_profiler(profiler, name)
+        _open_stages.pop()
+        end_read_bytes, end_write_bytes = _read_io()
+        end_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        record.update({
+            "wall_seconds": wall,
+            "cpu_seconds": cpu,
+            # worker processes are counted when they exit, e.g. when a process pool is shut down
+            "children_cpu_seconds": (end_children.ru_utime + end_children.ru_stime) -
+                                    (children.ru_utime + children.ru_stime),
+            "peak_rss": max(record["peak_rss"], _read_peak_rss()),
+            "sql_statements": _sql["statements"] - sql_statements,
+            "sql_seconds": _sql["seconds"] - sql_seconds,
+            "read_bytes": None if read_bytes is None else end_read_bytes - read_bytes,
+            "write_bytes": None if write_bytes is None else end_write_bytes - write_bytes
+        })
+        if len(_open_stages) > 0:
+            _open_stages[-1]["peak_rss"] = max(_open_stages[-1]["peak_rss"], record["peak_rss"])
+        _stages.append(record)
+
+
+def get_stages():
+    """
+    Returns metrics of finished stages in the order they finished, inner stages before the stages enclosing them.
+
+    :return: A list of dictionaries.
+    """
+    return list(_stages)
+
+
+def save():
+    """
+    Writes metrics of finished stages to the metrics file given to `enable`.
+
+    :return: None
+    """
+    if _metrics_path is None:
+        return
+    _metrics_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(_metrics_path, "w") as fout:
+        json.dump({
+            "command": sys.argv,
+            "created_at": datetime.now().isoformat(),
+            "process": os.getpid(),
+            "stages": _stages
+        }, fout, indent=2)
+    logger.info(f"Saved metrics of {len(_stages)} stages to {_metrics_path}.")
@@ -3,6 +3,11 @@ import re
 
 from random import randint
 
+from utils.logger import get_logger
+
+
+logger = get_logger(__name__)
+
 
 def minify_json(json_str):
     """
@@ -26,3 +31,117 @@ def fisher_yates_shuffle(arr):
         j = randint(0, i)
         arr[i], arr[j] = arr[j], arr[i]
     return arr
+
+
+def format_bytes(n_bytes):
+    """
+    Formats a number of bytes as a human readable string, e.g. 1536 -> '1.5 KB'.
+    :param n_bytes:
+    :return:
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n_bytes) < 1024 or unit == "GB":
+            break
+        n_bytes /= 1024
+    return f"{n_bytes:.1f} {unit}"
+
+
+def log_payload_reduction(what, before, after):
+    """
+    Logs how the payload of `what` changed after optimization, e.g. "reduced from 10.0 KB to 8.0 KB (-20.0%)".
+    :param what:
+    :param before: Payload size in bytes before optimization.
+    :param after: Payload size in bytes after optimization.
+    :return:
+    """
+    if after == before:
+        logger.info(f"{what} payload unchanged at {format_bytes(before)}.")
+        return
+    verb = "reduced" if after < before else "grew"
+    change = ""
+    if before != 0:
+        percent = 100 * (after - before) / before
+        # a change smaller than the shown precision would be rounded to a signed zero
+        change = f" ({percent:+.1f}%)" if abs(percent) >= 0.05 else " (<0.1%)"
+    logger.info(f"{what} payload {verb} from {format_bytes(before)} to {format_bytes(after)}{change}.")
+
+
+# tokens of a javascript object literal: string literals, object keys followed by a colon and everything in between
+JS_TOKEN_RE = re.compile(r'(?P<string>"[^"\\]*(?:\\.[^"\\]*)*")|(?P<key>[A-Za-z_$][\w$]*)(?P<colon>\s*:)|'
+                         r'(?P<other>[^"A-Za-z_$]+|[A-Za-z_$][\w$]*)', re.S)
+
+# a comma directly before a closing bracket, e.g. [1, 2, ]
+TRAILING_COMMA_RE = re.compile(r",(\s*[\]}])")
+
+
+def js_object_to_json(js_str):
+    """
+    Converts a javascript object literal, like the ones stored in question and survey json fields, to a valid json
+    string by quoting object keys and removing trailing commas. String literals are copied unchanged.
+    :param js_str:
+    :return:
+    """
+    tokens = list()
+    for match in JS_TOKEN_RE.finditer(js_str):
+        if match.group("string") is not None:
+            tokens.append(match.group("string"))
+        elif match.group("key") is not None:
+            tokens.append(f'"{match.group("key")}"{match.group("colon")}')
+        else:
+            tokens.append(TRAILING_COMMA_RE.sub(r"\1", match.group("other")))
+    return "".join(tokens)
+
+
+# separators between items of a json array
+JSON_ARRAY_SEPARATOR_RE = re.compile(r"[\s,]*")
+
+
+def iter_json_array(fileobj, key, chunk_size=1 << 16):
+    """
+    Incrementally parses a json array stored under `key` in a json file and yields its items one at a time, so that
+    only a single item and one chunk of the file are held in memory. The first array stored under `key` found in the
+    file is parsed, the rest of the file is ignored.
+    :param fileobj: A json file opened in text mode.
+    :param key: A name of the array, e.g. "Data".
+    :param chunk_size: Number of characters read from the file at once.
+    :return: A generator of array items.
+    """
+    decoder = json.JSONDecoder(strict=False)
+    array_start_re = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+
+    # skip everything before the beginning of the array
+    buffer = ""
+    while True:
+        match = array_start_re.search(buffer)
+        if match is not None:
+            buffer = buffer[match.end():]
+            break
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            raise ValueError(f"Cannot find json array '{key}'.")
+        # keep the end of the buffer in case the key is split between two chunks
+        buffer = buffer[-(len(key) + 64):] + chunk
+
+    pos = 0
+    while True:
+        pos = JSON_ARRAY_SEPARATOR_RE.match(buffer, pos).end()
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+            if end == len(buffer) and not isinstance(item, (dict, list)):
+                # a number at the end of the buffer may continue in the next chunk
+                raise ValueError("Item may be incomplete.")
+        except ValueError:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                raise ValueError(f"Unexpected end of file while parsing json array '{key}'.")
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield item
+        pos = end
+        # drop already parsed items from the buffer
+        if pos > chunk_size:
+            buffer = buffer[pos:]
+            pos = 0